@@ -0,0 +1,82 @@
+'''
+Micro-benchmark of the per-request overhead of the `env` view decorator
+compared to bare Django views
+
+Run from the root of the repository::
+
+    python benchmarks/view_decorators.py --number 10000
+'''
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django import http  # noqa: E402
+from django.test import client  # noqa: E402
+
+from django_utils import view_decorators  # noqa: E402
+
+
+def bare_view(request):
+    return http.HttpResponse('spam')
+
+
+def bare_json_view(request):
+    return http.HttpResponse(
+        json.dumps({'spam': 'eggs'}), content_type='text/plain')
+
+
+@view_decorators.env
+def env_view(request):
+    return 'spam'
+
+
+@view_decorators.env
+def env_json_view(request):
+    return {'spam': 'eggs'}
+
+
+VIEWS = [
+    ('bare', bare_view, {}),
+    ('env', env_view, {}),
+    ('bare json', bare_json_view, {}),
+    ('env json', env_json_view, {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}),
+]
+
+
+def main(number, repeat):
+    factory = client.RequestFactory()
+
+    def benchmark(view, headers):
+        # Create the requests up front so only the view is measured
+        requests = iter([
+            factory.get('/', **headers) for _ in range(number)])
+        return timeit.timeit(lambda: view(next(requests)), number=number)
+
+    results = {}
+    for name, view, headers in VIEWS:
+        results[name] = min(
+            benchmark(view, headers) for _ in range(repeat)
+        ) / number * 1e6
+
+    print(f'{"view":<12}{"us/request":>12}{"overhead":>12}')
+    for name, us in results.items():
+        bare = results['bare json' if 'json' in name else 'bare']
+        print(f'{name:<12}{us:>12.2f}{us - bare:>12.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--number', type=int, default=10000)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+    main(args.number, args.repeat)
@@ -0,0 +1,191 @@
+'''
+Throttled and resumable backfills of (large) querysets
+
+The queryset is iterated in chunks using the keyset based queryset iterators,
+every chunk is processed in a separate transaction and the amount of rows per
+second can be limited so the backfill doesn't saturate the database (and the
+replicas). After every committed chunk the ordering values of the last row are
+stored in a checkpoint so an interrupted backfill continues where it stopped:
+
+.. code-block:: python
+
+    from django_utils import backfill
+
+    def update(rows):
+        for row in rows:
+            row.slug = slugify(row.name)
+
+        Spam.objects.bulk_update(rows, ['slug'])
+
+    backfill.backfill(
+        Spam.objects.filter(slug=''),
+        update,
+        rows_per_second=500,
+        checkpoint=backfill.FileCheckpoint('spam-slug.json'),
+    )
+'''
+import datetime
+import json
+import logging
+import os
+import time
+
+from django.core import cache as django_cache
+from django.core.serializers import json as django_json
+from django.db import transaction
+
+from . import queryset as queryset_utils
+
+logger = logging.getLogger(__name__)
+
+
+class _CheckpointEncoder(django_json.DjangoJSONEncoder):
+    '''JSON encoder which keeps the microseconds of times, the Django
+    encoder truncates them to milliseconds which would process rows twice'''
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+
+        return super(_CheckpointEncoder, self).default(o)
+
+
+class FileCheckpoint(object):
+    '''Store the checkpoint as JSON in a file
+
+    :param path: The file to store the checkpoint in
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        '''Return the stored ordering values, `None` if there are none'''
+        try:
+            with open(self.path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return None
+
+    def save(self, values):
+        # Write to a temporary file first so a killed process never leaves a
+        # partially written checkpoint behind
+        path = f'{self.path}.tmp'
+        with open(path, 'w') as fh:
+            json.dump(list(values), fh, cls=_CheckpointEncoder)
+
+        os.replace(path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.path}>'
+
+
+class CacheCheckpoint(object):
+    '''Store the checkpoint in the Django cache
+
+    :param key: The cache key
+    :param cache: The alias of the cache to use
+    :param timeout: The timeout of the checkpoint in seconds, `None` to
+        never expire
+    '''
+
+    def __init__(self, key, cache='default', timeout=None):
+        self.key = key
+        self.cache = cache
+        self.timeout = timeout
+
+    def load(self):
+        '''Return the stored ordering values, `None` if there are none'''
+        return django_cache.caches[self.cache].get(self.key)
+
+    def save(self, values):
+        django_cache.caches[self.cache].set(
+            self.key, list(values), self.timeout)
+
+    def clear(self):
+        django_cache.caches[self.cache].delete(self.key)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.cache}:{self.key}>'
+
+
+def backfill(
+        queryset, function, rows_per_second=None, chunksize=1000,
+        checkpoint=None, atomic=True, sleep=time.sleep, **kwargs):
+    '''
+    Run `function` for every chunk of the queryset with an optional rate
+    limit and checkpoint
+
+    The rate limit is applied per chunk: if a chunk was processed faster than
+    `rows_per_second` allows, the backfill sleeps for the remaining time
+    before fetching the next chunk. The checkpoint is saved after the
+    transaction of the chunk has been committed and cleared once the
+    backfill is finished.
+
+    Note that the rows are selected by their ordering values, updating the
+    ordering fields of the rows within `function` can cause rows to be
+    skipped or processed twice.
+
+    :param queryset: The queryset to backfill, see
+        :py:func:`django_utils.queryset.queryset_iterator` for the supported
+        orderings
+    :param function: Callable which is called with the list of rows of every
+        chunk
+    :param rows_per_second: The maximum amount of rows to process per second,
+        `None` for no limit
+    :param chunksize: The amount of rows per chunk (and transaction)
+    :param checkpoint: A :py:class:`FileCheckpoint`,
+        :py:class:`CacheCheckpoint` or any object with `load()`, `save()` and
+        `clear()` methods
+    :param atomic: Process every chunk in a transaction
+    :param sleep: The function used to wait for the rate limit
+    :param kwargs: Passed to
+        :py:func:`django_utils.queryset.queryset_chunk_iterator`
+    :return: The amount of processed rows
+    '''
+    _, columns, getfunc = queryset_utils._prepare_keyset(
+        queryset, kwargs.get('getfunc', getattr))
+
+    start_after = None
+    if checkpoint is not None:
+        start_after = checkpoint.load()
+        if start_after is not None:
+            logger.info('Resuming %s after %r', checkpoint, start_after)
+
+    total = 0
+    start = time.perf_counter()
+    for rows in queryset_utils.queryset_chunk_iterator(
+            queryset, chunksize, start_after=start_after, **kwargs):
+        if atomic:
+            with transaction.atomic(using=queryset.db):
+                function(rows)
+        else:
+            function(rows)
+
+        total += len(rows)
+        if checkpoint is not None:
+            checkpoint.save(
+                [getfunc(rows[-1], column.key) for column in columns])
+
+        now = time.perf_counter()
+        logger.debug(
+            'Processed %d rows (%d total) in %.3fs', len(rows), total,
+            now - start)
+
+        if rows_per_second:
+            remaining = len(rows) / rows_per_second - (now - start)
+            if remaining > 0:
+                sleep(remaining)
+
+        start = time.perf_counter()
+
+    if checkpoint is not None:
+        checkpoint.clear()
+
+    return total
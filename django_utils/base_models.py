@@ -52,6 +52,18 @@ class CreatedAtModelBase(ModelBase):
         abstract = True
 
 
+def updated_at_index(name, field='updated_at', pk='id', **kwargs):
+    '''Create an index on `(updated_at, pk)` so the
+    :py:class:`django_utils.queryset.ChangeFeed` chunks are index range scans
+
+    :param name: The name of the index
+    :param field: The name of the change timestamp field
+    :param pk: The name of the primary key field
+    :param kwargs: Passed to `models.Index`
+    '''
+    return models.Index(fields=[field, pk], name=name, **kwargs)
+
+
 class NameMixin(object):
 
     '''Mixin to automatically get a unicode and repr string base on the name
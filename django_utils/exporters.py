@@ -0,0 +1,168 @@
+'''
+Streaming exports of querysets to CSV and JSON Lines
+
+The rows are fetched in chunks using the keyset based queryset iterators (or
+the database cursor if the queryset can't use keyset pagination) and written
+incrementally, the memory usage is constant regardless of the size of the
+table. The exports can be written to files, file objects (i.e. stdout) or
+returned as `StreamingHttpResponse`:
+
+.. code-block:: python
+
+    from django_utils import exporters
+
+    exporters.export_queryset(Spam.objects.all(), 'spam.csv.gz',
+                              fields=['pk', 'name'], compress=True)
+
+    def export_view(request):
+        return exporters.export_response(
+            Spam.objects.all(), format='jsonl', filename='spam.jsonl')
+'''
+import csv
+import io
+import os
+import zlib
+
+from django import http
+from . import json_backends
+from . import serializers
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/jsonl',
+}
+
+
+def _csv_chunks(fields, chunks, header):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(fields)
+
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    # The header for empty querysets
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _jsonl_chunks(fields, chunks):
+    # Unlike the `DjangoJSONEncoder` the JSON backends keep the microseconds
+    # of times and datetimes
+    for rows in chunks:
+        yield ''.join(
+            json_backends.dumps(dict(zip(fields, row))) + '\n'
+            for row in rows
+        )
+
+
+def _compress(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+def export_iterator(
+        queryset, fields=None, format='csv', header=True, compress=False,
+        chunksize=1000, encoding='utf-8'):
+    '''
+    Export the queryset as a stream of encoded chunks (bytes), one chunk per
+    queryset chunk
+
+    :param queryset: The queryset to export, the ordering of the queryset
+        is retained
+    :param fields: The fields (or `values_list()` lookups) to export, all
+        concrete fields if not given
+    :param format: Either `csv` or `jsonl` (JSON Lines)
+    :param header: Write a header with the field names to CSV exports
+    :param compress: Compress the output using gzip
+    :param chunksize: The amount of rows to fetch and write at once
+    :param encoding: The encoding of the output
+    '''
+    if not fields:
+        fields = [
+            field.attname for field in queryset.model._meta.concrete_fields]
+
+    chunks = serializers._get_queryset_chunks(queryset, chunksize, fields)
+    if format == 'csv':
+        chunks = _csv_chunks(fields, chunks, header)
+    elif format == 'jsonl':
+        chunks = _jsonl_chunks(fields, chunks)
+    else:
+        raise ValueError(
+            f'Unknown format {format!r}, choose from: {", ".join(FORMATS)}')
+
+    chunks = (chunk.encode(encoding) for chunk in chunks)
+    if compress:
+        chunks = _compress(chunks)
+
+    return chunks
+
+
+def export_queryset(queryset, output, **kwargs):
+    '''
+    Export the queryset to a file or file object
+
+    :param queryset: The queryset to export
+    :param output: A filename, a binary file object or a text file object.
+        Compressed exports to text file objects are written to the `buffer`
+        of the file object (e.g. `sys.stdout.buffer`)
+    :param kwargs: See :py:func:`export_iterator`
+    :return: The amount of bytes written
+    '''
+    if isinstance(output, (str, os.PathLike)):
+        with open(output, 'wb') as fh:
+            return export_queryset(queryset, fh, **kwargs)
+
+    if not isinstance(output, io.TextIOBase):
+        write = output.write
+    elif kwargs.get('compress'):
+        write = output.buffer.write
+    else:
+        encoding = kwargs.get('encoding', 'utf-8')
+
+        def write(chunk):
+            output.write(chunk.decode(encoding))
+
+    written = 0
+    for chunk in export_iterator(queryset, **kwargs):
+        write(chunk)
+        written += len(chunk)
+
+    return written
+
+
+def export_response(queryset, filename=None, **kwargs):
+    '''
+    Export the queryset as a `StreamingHttpResponse`
+
+    :param queryset: The queryset to export
+    :param filename: Send the export as attachment with the given filename
+    :param kwargs: See :py:func:`export_iterator`
+    '''
+    format = kwargs.get('format', 'csv')
+    if format not in FORMATS:
+        raise ValueError(
+            f'Unknown format {format!r}, choose from: {", ".join(FORMATS)}')
+
+    encoding = kwargs.get('encoding', 'utf-8')
+    response = http.StreamingHttpResponse(
+        export_iterator(queryset, **kwargs),
+        content_type=f'{FORMATS[format]}; charset={encoding}',
+    )
+    if kwargs.get('compress'):
+        response['Content-Encoding'] = 'gzip'
+
+    if filename:
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+
+    return response
+
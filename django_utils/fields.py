@@ -1,35 +1,669 @@
+import collections
 import functools
 
+from django.core import exceptions
+from django.db import connections, router, transaction
+from django.db.models import functions, query, signals, F, Value
+
+#: The database backends which support recursive common table expressions
+CTE_VENDORS = {'sqlite', 'postgresql'}
+
+#: The field types for which `0` is an empty value
+NUMERIC_FIELDS = {
+    'AutoField', 'BigAutoField', 'BigIntegerField', 'DecimalField',
+    'FloatField', 'IntegerField', 'PositiveBigIntegerField',
+    'PositiveIntegerField', 'PositiveSmallIntegerField', 'SmallAutoField',
+    'SmallIntegerField',
+}
+
+#: The maximum depth of the recursive queries, prevents endless recursion for
+#: cyclic trees
+MAX_DEPTH = 1000
+
 
 class RecursiveField(object):
+    '''Get the value of a field from the instance or the closest parent which
+    has a (truthy) value
+
+    By default the parents are walked in Python, which executes a query for
+    every parent that is not cached yet. With `strategy='cte'` the uncached
+    part of the chain is fetched in a single recursive query which stops at
+    the first parent with a value. The fetched parents are stored in the
+    foreign key caches so later lookups on the same chain are free. The
+    recursive query is only used for self referential foreign keys on
+    SQLite and PostgreSQL, other cases use the Python walk.
+
+    For deep and read heavy trees `strategy='path'` maintains a materialized
+    path in `path_field` (a `CharField` with an index): the primary keys of
+    all ancestors, root first, separated by `/` (e.g. `1/5/`). The path is
+    updated on save, including the paths of all descendants when a node is
+    moved. The ancestors are fetched with a single `pk IN (...)` query and
+    :py:meth:`descendants` is a single indexed prefix query. Bulk changes
+    which bypass `save()` can be repaired with :py:meth:`rebuild` or the
+    `recursive_field` management command. The primary keys can't contain
+    the separator.
+
+    To resolve the value for many instances at once, use
+    :py:meth:`resolve_many` or :py:meth:`annotate` on the field of the
+    model class:
+
+    .. code-block:: python
+
+        nodes = Node.get_currency.annotate(Node.objects.all())
+        for node in nodes:
+            print(node.inherited_currency)
+
+    With `cache=True` the resolved values are cached per row (shared between
+    all instances of the row) for the node and all parents it inherits the
+    value from. The cache is process local and reflects the saved state of
+    the rows: saving or deleting a row evicts the row and all descendants
+    which inherited their value through it, which includes re-parenting.
+    Changes made through `QuerySet.update()` don't send signals and are not
+    noticed.
+
+    To filter, order or select on the inherited value in the database, use
+    :py:meth:`expression`:
+
+    .. code-block:: python
+
+        Node.objects.alias(
+            currency=Node.get_currency.expression(max_depth=5),
+        ).filter(currency='EUR')
+
+    :param field_name: The name of the field, defaults to the attribute name
+        without the `get_` prefix
+    :param parent_field: The name of the foreign key to the parent
+    :param default: The value to return if no value is found
+    :param strategy: Either `python`, `cte` or `path`
+    :param cache: Cache the resolved values
+    :param path_field: The name of the materialized path field, required for
+        the `path` strategy
+    '''
 
     PREFIX = 'get_'
+    STRATEGIES = 'python', 'cte', 'path'
+    PATH_SEPARATOR = '/'
+    #: The maximum amount of cached values, the cache is cleared when full
+    CACHE_SIZE = 100000
+
+    def __init__(self, field_name=None, parent_field='parent', default=None,
+                 strategy='python', cache=False, path_field=None):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(
+                f'Unknown strategy {strategy!r}, choose from: '
+                f'{", ".join(self.STRATEGIES)}')
+        elif strategy == 'path' and not path_field:
+            raise ValueError('The `path` strategy requires a `path_field`')
 
-    def __init__(self, field_name=None, parent_field='parent', default=None):
         self.field_name = field_name
         self.parent_field = parent_field
         self.default = default
+        self.strategy = strategy
+        self.cache = cache
+        self.path_field = path_field
+        self.model = None
+        # The cached values and the rows which depend on a row, both keyed
+        # by `(concrete model label, database, pk)`
+        self._values = {}
+        self._dependents = collections.defaultdict(set)
 
     def contribute_to_class(self, cls, name):
         if not self.field_name:
             assert name.startswith(self.PREFIX)
             self.field_name = name.replace(self.PREFIX, '', 1)
 
+        self.model = cls
         setattr(cls, name, self)
+        if self.path_field:
+            # Connect once per path, multiple fields can share the same path.
+            # Proxies and subclasses send signals with their own sender so
+            # listen to all senders
+            dispatch_uid = f'{cls._meta.label}.{self.path_field}'
+            signals.pre_save.connect(
+                self._update_path, weak=False, dispatch_uid=dispatch_uid)
+            signals.post_save.connect(
+                self._update_descendant_paths, weak=False,
+                dispatch_uid=dispatch_uid)
+        if self.cache:
+            # Parents can be of a different model so listen to all senders
+            dispatch_uid = f'{cls._meta.label}.{name}'
+            signals.post_save.connect(
+                self._invalidate, weak=False, dispatch_uid=dispatch_uid)
+            signals.post_delete.connect(
+                self._invalidate, weak=False, dispatch_uid=dispatch_uid)
 
     def get(self, instance):
+        assert self.field_name
+
+        key = self.cache and self._get_key(instance)
+        if key and key in self._values:
+            return self._values[key]
+
+        value = self._resolve(instance)
+        if key:
+            self._store(instance, value)
+
+        return value
+
+    def _resolve(self, instance):
         name = self.field_name
-        assert name
+        if self.strategy == 'cte' and self._supports_cte(instance):
+            value = self._walk_fetched(instance, self._fetch_parents)
+        elif self.strategy == 'path' and self._is_self_referential(instance):
+            value = self._walk_fetched(instance, self._fetch_path_parents)
+        else:
+            value = None
+            while instance:
+                value = getattr(instance, name, None)
+                if value:
+                    break
 
-        value = None
-        while instance and not value:
-            value = getattr(instance, name, None)
-            instance = getattr(instance, self.parent_field, None)
+                instance = getattr(instance, self.parent_field, None)
 
         if value is None:
             value = self.default
 
         return value
 
+    def _get_key(self, instance):
+        if instance is None or instance.pk is None or not instance._state.db:
+            return None
+
+        label = instance._meta.concrete_model._meta.label
+        return label, instance._state.db, instance.pk
+
+    def _store(self, instance, value):
+        '''Cache the value for the instance and the (cached) parents it
+        inherited the value from'''
+        path = []
+        while instance is not None:
+            key = self._get_key(instance)
+            if key is None:
+                # Unsaved parents can change at any time
+                return
+
+            path.append(key)
+            field = self._get_parent_field(instance)
+            if getattr(instance, self.field_name, None) or field is None:
+                break
+
+            instance = field.get_cached_value(instance, None)
+
+        if len(self._values) + len(path) > self.CACHE_SIZE:
+            self.clear_cache()
+
+        for i, key in enumerate(path):
+            self._values[key] = value
+            self._dependents[key].update(path[:i + 1])
+
+    def _invalidate(self, sender, instance, using=None, **kwargs):
+        label = instance._meta.concrete_model._meta.label
+        key = label, using, instance.pk
+        for dependent in self._dependents.pop(key, ()):
+            self._values.pop(dependent, None)
+
+    def clear_cache(self):
+        '''Clear all cached values'''
+        self._values.clear()
+        self._dependents.clear()
+
+    def _is_self_referential(self, instance):
+        if instance is None:
+            return False
+
+        field = instance._meta.get_field(self.parent_field)
+        return field.related_model is instance.__class__
+
+    def _supports_cte(self, instance):
+        if not self._is_self_referential(instance):
+            return False
+
+        using = self._get_database(instance)
+        return connections[using].vendor in CTE_VENDORS
+
+    def _get_database(self, instance):
+        return instance._state.db or router.db_for_read(
+            instance.__class__, instance=instance)
+
+    def _walk_fetched(self, instance, fetch):
+        '''Walk the cached parents and fetch the uncached parents using
+        `fetch`, which returns the chain of parents, closest first'''
+        field = instance._meta.get_field(self.parent_field)
+        value = None
+        while instance is not None:
+            value = getattr(instance, self.field_name, None)
+            if value:
+                break
+            elif field.is_cached(instance):
+                instance = field.get_cached_value(instance)
+                continue
+
+            parent_id = getattr(instance, field.attname)
+            if parent_id is None:
+                break
+
+            parents = fetch(instance, field, parent_id)
+            for child, parent in zip([instance] + parents, parents):
+                field.set_cached_value(child, parent)
+
+            instance = parents[0] if parents else None
+
+        return value
+
+    def _fetch_parents(self, instance, field, parent_id):
+        '''Fetch the parent chain starting at `parent_id` up to and including
+        the first parent with a non-null value'''
+        opts = instance._meta
+        using = self._get_database(instance)
+        quote = connections[using].ops.quote_name
+
+        table = quote(opts.db_table)
+        pk = quote(opts.pk.column)
+        parent = quote(field.column)
+        columns = ', '.join(
+            quote(field_.column) for field_ in opts.concrete_fields)
+
+        # Stop at the first non-null value if the value is a database column,
+        # falsy values such as `''` are handled by walking further in Python
+        try:
+            value_field = opts.get_field(self.field_name)
+            value_column = getattr(value_field, 'column', None)
+        except exceptions.FieldDoesNotExist:
+            value_column = None
+
+        condition = f'a._depth < {MAX_DEPTH:d}'
+        if value_column:
+            condition += f' AND a.{quote(value_column)} IS NULL'
+
+        sql = f'''
+        WITH RECURSIVE _ancestors AS (
+            SELECT t.*, 0 AS _depth FROM {table} t WHERE t.{pk} = %s
+            UNION ALL
+            SELECT t.*, a._depth + 1 FROM {table} t
+            INNER JOIN _ancestors a ON t.{pk} = a.{parent}
+            WHERE {condition}
+        )
+        SELECT {columns} FROM _ancestors ORDER BY _depth
+        '''
+        # Raw queries don't convert the parameters, i.e. UUIDs on SQLite
+        parent_id = field.target_field.get_db_prep_value(
+            parent_id, connections[using])
+        manager = instance.__class__._base_manager.db_manager(using)
+        return list(manager.raw(sql, [parent_id]))
+
+    def _get_path_ids(self, instance):
+        '''Return the primary keys of the ancestors from the path, root
+        first'''
+        path = getattr(instance, self.path_field) or ''
+        pk = instance._meta.pk
+        return [
+            pk.to_python(value)
+            for value in path.split(self.PATH_SEPARATOR) if value
+        ]
+
+    def _fetch_path_parents(self, instance, field, parent_id):
+        '''Fetch all ancestors using the materialized path'''
+        ids = self._get_path_ids(instance)
+        if not ids or ids[-1] != parent_id:
+            # The path is outdated, the parent was changed but not saved yet
+            return [getattr(instance, field.name)]
+
+        manager = instance.__class__._base_manager.db_manager(
+            self._get_database(instance))
+        ancestors = manager.in_bulk(ids)
+
+        parents = []
+        for id_ in reversed(ids):
+            if id_ not in ancestors or getattr(instance, field.attname) != id_:
+                # The path is inconsistent, the rest is walked normally
+                break
+
+            instance = ancestors[id_]
+            parents.append(instance)
+
+        return parents
+
+    def _get_path_manager(self, using):
+        # The model which has the path field, for multi-table inheritance the
+        # paths of all subclasses are stored in the parent table
+        model = self.model._meta.get_field(self.path_field).model
+        return model._base_manager.db_manager(using)
+
+    def _update_path(self, sender, instance, raw=False, using=None,
+                     **kwargs):
+        '''Update the materialized path of the instance, the paths of the
+        descendants of moved instances are updated after the save'''
+        if not isinstance(instance, self.model):
+            return
+        elif raw:
+            instance.__dict__.pop(self._old_path_attname, None)
+            return
+
+        field = self._get_parent_field(instance)
+        parent_id = getattr(instance, field.attname)
+        if parent_id is None and instance._state.adding:
+            setattr(instance, self.path_field, '')
+            return
+
+        # The path ends with the parent it was built for, if the parent didn't
+        # change there is nothing to update. The descendants of a move of
+        # which the save failed are still updated by the next save
+        last_id = self._get_path_ids(instance)[-1:]
+        if not instance._state.adding and last_id == (
+                [] if parent_id is None else [parent_id]):
+            return
+
+        manager = self._get_path_manager(using)
+
+        # Fetch the path of the parent and the current path from the database
+        # since the instances in memory could be outdated
+        ids = [id_ for id_ in (parent_id, instance.pk) if id_ is not None]
+        paths = dict(manager.filter(pk__in=ids).values_list(
+            'pk', self.path_field))
+
+        if parent_id is None:
+            path = ''
+        else:
+            path = paths.get(parent_id, '')
+            path = f'{path}{parent_id}{self.PATH_SEPARATOR}'
+
+        if instance.pk is not None and str(instance.pk) in path.split(
+                self.PATH_SEPARATOR):
+            raise ValueError(
+                f'{instance!r} can not be a descendant of itself')
+
+        setattr(instance, self.path_field, path)
+
+        # Keep the previous path of a moved instance for the post save signal
+        old_path = paths.get(instance.pk)
+        if instance._state.adding or old_path is None or old_path == path:
+            instance.__dict__.pop(self._old_path_attname, None)
+        else:
+            instance.__dict__[self._old_path_attname] = old_path
+
+    def _update_descendant_paths(self, sender, instance, using=None,
+                                 update_fields=None, **kwargs):
+        '''Update the materialized paths of the descendants of a moved
+        instance once the instance itself was saved successfully'''
+        old_path = instance.__dict__.pop(self._old_path_attname, None)
+        if old_path is None:
+            return
+
+        path = getattr(instance, self.path_field)
+        manager = self._get_path_manager(using)
+        old_prefix = f'{old_path}{instance.pk}{self.PATH_SEPARATOR}'
+        new_prefix = f'{path}{instance.pk}{self.PATH_SEPARATOR}'
+        with transaction.atomic(using=using, savepoint=False):
+            if update_fields is not None and \
+                    self.path_field not in update_fields:
+                manager.filter(pk=instance.pk).update(
+                    **{self.path_field: path})
+
+            manager.filter(**{
+                f'{self.path_field}__startswith': old_prefix,
+            }).update(**{
+                self.path_field: functions.Concat(
+                    Value(new_prefix),
+                    functions.Substr(self.path_field, len(old_prefix) + 1),
+                ),
+            })
+
+    @property
+    def _old_path_attname(self):
+        return f'_{self.path_field}_before_move'
+
+    def ancestors(self, instance):
+        '''Return the ancestors of the instance as a queryset, closest
+        first, using the materialized path'''
+        assert self.path_field
+        queryset = instance.__class__._default_manager.db_manager(
+            self._get_database(instance))
+        return queryset.filter(pk__in=self._get_path_ids(instance)).order_by(
+            functions.Length(self.path_field).desc())
+
+    def descendants(self, instance):
+        '''Return all descendants of the instance as a queryset using the
+        materialized path'''
+        assert self.path_field
+        path = getattr(instance, self.path_field) or ''
+        queryset = instance.__class__._default_manager.db_manager(
+            self._get_database(instance))
+        return queryset.filter(**{
+            f'{self.path_field}__startswith':
+                f'{path}{instance.pk}{self.PATH_SEPARATOR}',
+        })
+
+    def _iterate_paths(self, using=None, batch_size=500):
+        '''Yield `(pk, path, expected path)` for all nodes which can be
+        reached from the roots, level by level'''
+        attname = self._get_parent_field(self.model).attname
+        manager = self.model._base_manager.db_manager(using)
+        values = 'pk', attname, self.path_field
+
+        rows = manager.filter(**{f'{attname}__isnull': True}).values_list(
+            *values)
+        prefixes = {None: ''}
+        while prefixes:
+            children = {}
+            for pk, parent_id, path in rows:
+                expected = prefixes[parent_id]
+                yield pk, path, expected
+                children[pk] = f'{expected}{pk}{self.PATH_SEPARATOR}'
+
+            prefixes = children
+            ids = list(children)
+            rows = (
+                row
+                for i in range(0, len(ids), batch_size)
+                for row in manager.filter(**{
+                    f'{attname}__in': ids[i:i + batch_size],
+                }).values_list(*values)
+            )
+
+    def rebuild(self, using=None, batch_size=500):
+        '''Rebuild the materialized paths of all nodes
+
+        :param using: The database to use
+        :param batch_size: The amount of rows to update per query
+        :return: The amount of updated nodes
+        '''
+        assert self.path_field
+        manager = self.model._base_manager.db_manager(using)
+        updated = []
+        for pk, path, expected in self._iterate_paths(using, batch_size):
+            if path != expected:
+                updated.append(self.model(
+                    pk=pk, **{self.path_field: expected}))
+
+        manager.bulk_update(updated, [self.path_field], batch_size)
+        return len(updated)
+
+    def verify(self, using=None, batch_size=500):
+        '''Verify the materialized paths of all nodes
+
+        :param using: The database to use
+        :param batch_size: The amount of nodes to fetch per query
+        :return: A tuple with the primary keys of the nodes with an incorrect
+            path and the amount of verified nodes. Nodes which are part of a
+            cycle can't be reached from a root and are not verified.
+        '''
+        assert self.path_field
+        invalid = []
+        verified = 0
+        for pk, path, expected in self._iterate_paths(using, batch_size):
+            verified += 1
+            if path != expected:
+                invalid.append(pk)
+
+        return invalid, verified
+
+    def resolve_many(self, instances):
+        '''Resolve the value for all instances using a query per level of
+        the tree
+
+        The parents which are not cached yet are fetched level by level with
+        a single query per level, parents shared by multiple instances are
+        only fetched once. The parents are stored in the foreign key caches.
+
+        :param instances: The instances to resolve the value for
+        :return: A list with the value for every instance
+        '''
+        instances = list(instances)
+        pending = [
+            instance for instance in instances
+            if instance is not None and not (
+                self.cache and self._get_key(instance) in self._values)
+        ]
+        while pending:
+            parents = {}
+            missing = collections.defaultdict(
+                lambda: collections.defaultdict(list))
+            for instance in pending:
+                field = self._get_parent_field(instance)
+                if field is None or getattr(instance, self.field_name, None):
+                    continue
+                elif field.is_cached(instance):
+                    parent = field.get_cached_value(instance)
+                    if parent is not None:
+                        parents[id(parent)] = parent
+                    continue
+
+                parent_id = getattr(instance, field.attname)
+                if parent_id is not None:
+                    key = field, self._get_database(instance)
+                    missing[key][parent_id].append(instance)
+
+            for (field, using), children in missing.items():
+                manager = field.related_model._base_manager.using(using)
+                fetched = manager.in_bulk(
+                    list(children), field_name=field.target_field.name)
+                for parent_id, instances_ in children.items():
+                    parent = fetched.get(parent_id)
+                    for instance in instances_:
+                        field.set_cached_value(instance, parent)
+
+                    if parent is not None:
+                        parents[id(parent)] = parent
+
+            pending = list(parents.values())
+
+        return [self.get(instance) for instance in instances]
+
+    def annotate(self, queryset, name=None):
+        '''Return a clone of the queryset which resolves the value for all
+        fetched instances using :py:meth:`resolve_many`
+
+        :param queryset: A queryset which returns model instances
+        :param name: The attribute to store the value in, defaults to
+            `inherited_<field_name>`
+        '''
+        iterable_class = type(
+            'RecursiveFieldIterable', (_RecursiveFieldIterable,), dict(
+                resolve_many=self.resolve_many,
+                name=name or f'inherited_{self.field_name}',
+            ))
+        queryset = queryset.all()
+        queryset._iterable_class = iterable_class
+        return queryset
+
+    def expression(self, max_depth=10):
+        '''Return a query expression which resolves the value in the
+        database
+
+        The expression is a `Coalesce` over the value of the node and the
+        parents up to `max_depth` levels, joined through the parent foreign
+        keys. Like the Python walk, empty values (`''`, `0` and `False`) are
+        skipped, if none of the levels has a value the `default` is used.
+
+        :param max_depth: The amount of parent levels to include
+        '''
+        assert self.model is not None and self.field_name
+
+        terms = []
+        model = self.model
+        path = ''
+        for _ in range(max_depth + 1):
+            try:
+                field = model._meta.get_field(self.field_name)
+            except exceptions.FieldDoesNotExist:
+                field = None
+
+            if not getattr(field, 'concrete', False):
+                raise ValueError(
+                    f'{model._meta.label}.{self.field_name} is not a '
+                    f'database field')
+
+            empty = _get_empty_value(field)
+            term = F(path + self.field_name)
+            if empty is not None:
+                term = functions.NullIf(term, Value(empty, output_field=field))
+            terms.append(term)
+
+            parent_field = self._get_parent_field(model)
+            if parent_field is None:
+                break
+
+            path += f'{parent_field.name}__'
+            model = parent_field.related_model
+
+        if self.default is not None:
+            terms.append(Value(self.default, output_field=field))
+
+        if len(terms) == 1:
+            return terms[0]
+        else:
+            return functions.Coalesce(*terms, output_field=field)
+
+    def _get_parent_field(self, instance):
+        try:
+            field = instance._meta.get_field(self.parent_field)
+        except exceptions.FieldDoesNotExist:
+            return None
+
+        return field if field.many_to_one else None
+
+    def __call__(self, instance=None):
+        return self.get(instance)
+
     def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
         return functools.partial(self.get, instance)
+
+
+def _get_empty_value(field):
+    '''Return the falsy non-null value of a field, if any'''
+    if field.is_relation:
+        field = field.target_field
+
+    internal_type = field.get_internal_type()
+    if internal_type in NUMERIC_FIELDS:
+        return 0
+    elif internal_type == 'BooleanField':
+        return False
+    elif field.empty_strings_allowed:
+        return ''
+
+
+class _RecursiveFieldIterable(query.ModelIterable):
+    '''Model iterable which resolves a :py:class:`RecursiveField` for every
+    batch of instances'''
+    resolve_many = None
+    name = None
+
+    def __iter__(self):
+        instances = []
+        for instance in super(_RecursiveFieldIterable, self).__iter__():
+            instances.append(instance)
+            if self.chunked_fetch and len(instances) >= self.chunk_size:
+                yield from self._resolve(instances)
+                instances = []
+
+        yield from self._resolve(instances)
+
+    def _resolve(self, instances):
+        for instance, value in zip(
+                instances, self.resolve_many(instances)):
+            setattr(instance, self.name, value)
+            yield instance
@@ -0,0 +1,134 @@
+'''
+Pluggable JSON encoding for the views
+
+JSON encoding of the view responses is done through :py:func:`dumps` which
+uses `orjson` when it is installed and falls back to the standard library
+`json` module otherwise. All backends produce the same compact output and
+support the same types as :py:func:`django_utils.view_decorators
+.json_default_handler` and the :py:class:`~django.core.serializers.json
+.DjangoJSONEncoder`:
+
+ - Dates, times and datetimes through their `isoformat()` (so including
+   microseconds)
+ - `timedelta` as ISO 8601 duration
+ - `Decimal`, `UUID` and lazy translation strings as strings
+
+The backend can be selected with the `DJANGO_UTILS_JSON_BACKEND` setting or
+the `backend` argument of :py:func:`dumps`:
+
+>>> dumps({'spam': [1, 2.5, None]}, backend='json')
+'{"spam":[1,2.5,null]}'
+
+Compared to a plain `json.dumps()` the output has no spaces after the
+separators and non-ASCII characters are written as UTF-8 instead of `\\u`
+escapes, `orjson` can't write anything else so the standard library backend
+uses the same format.
+
+Note that `orjson` writes floats with an exponent as `1e16` instead of
+`1e+16` and refuses `NaN` which the standard library writes as invalid JSON.
+Values which `orjson` cannot encode (integers over 64 bits, timezone aware
+times, non-string dictionary keys) are encoded by the standard library
+instead.
+
+`ujson` can be selected explicitly but it is never used automatically since
+it encodes `Decimal` values as numbers instead of strings.
+'''
+import datetime
+import decimal
+import json
+import uuid
+
+from django.conf import settings
+from django.utils import duration, functional
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+
+def default(obj):
+    '''Convert the types which JSON does not support natively
+
+    >>> default(decimal.Decimal('1.10'))
+    '1.10'
+    >>> default(datetime.timedelta(hours=1))
+    'P0DT01H00M00S'
+    '''
+    if isinstance(obj, datetime.timedelta):
+        return duration.duration_iso_string(obj)
+    elif hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    elif isinstance(obj, (decimal.Decimal, uuid.UUID, functional.Promise)):
+        return str(obj)
+    else:
+        raise TypeError(
+            f'Object of type {type(obj)} with value of {obj!r} is not JSON '
+            'serializable'
+        )
+
+
+_encoder = json.JSONEncoder(
+    separators=(',', ':'),
+    ensure_ascii=False,
+    default=default,
+)
+
+
+def _json_dumps(data):
+    return _encoder.encode(data)
+
+
+def _orjson_dumps(data):
+    try:
+        return orjson.dumps(data, default=default).decode()
+    except TypeError:
+        return _encoder.encode(data)
+
+
+def _ujson_dumps(data):
+    return ujson.dumps(
+        data,
+        ensure_ascii=False,
+        escape_forward_slashes=False,
+        default=default,
+    )
+
+
+#: The available backends, the backend names can be used for the
+#: `DJANGO_UTILS_JSON_BACKEND` setting
+BACKENDS = dict(json=_json_dumps)
+if ujson is not None:  # pragma: no branch
+    BACKENDS['ujson'] = _ujson_dumps
+if orjson is not None:  # pragma: no branch
+    BACKENDS['orjson'] = _orjson_dumps
+
+#: The backend to use if the `DJANGO_UTILS_JSON_BACKEND` setting is not set
+DEFAULT_BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+def dumps(data, backend=None):
+    '''Encode `data` as (compact) JSON string
+
+    :param data: The data to encode
+    :param backend: The name of the backend from :py:data:`BACKENDS`,
+        defaults to the `DJANGO_UTILS_JSON_BACKEND` setting or
+        :py:data:`DEFAULT_BACKEND`
+    '''
+    if backend is None:
+        backend = getattr(
+            settings, 'DJANGO_UTILS_JSON_BACKEND', DEFAULT_BACKEND)
+
+    try:
+        function = BACKENDS[backend]
+    except KeyError:
+        raise ValueError(
+            f'Unknown JSON backend {backend!r}, available backends: '
+            f'{", ".join(BACKENDS)}')
+
+    return function(data)
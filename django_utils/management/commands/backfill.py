@@ -0,0 +1,70 @@
+from django import apps
+from django.utils import module_loading
+
+from . import base_command
+from ... import backfill
+
+
+class Command(base_command.CustomBaseCommand):
+    help = '''Run a function over all rows of a model in throttled chunks.
+    Every chunk is processed in a transaction and the progress can be
+    checkpointed so an interrupted run resumes where it stopped.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='The model as `app_label.Model`')
+        parser.add_argument(
+            'function',
+            help='Dotted path to the function which is called with the '
+                 'list of rows of every chunk')
+        parser.add_argument(
+            '-r', '--rate', type=float, default=None,
+            help='The maximum amount of rows per second')
+        parser.add_argument(
+            '--checkpoint', help='Store the checkpoint in this file')
+        parser.add_argument(
+            '--cache-key', help='Store the checkpoint in the cache')
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Ignore the existing checkpoint and start from the start')
+        parser.add_argument(
+            '--no-atomic', action='store_true',
+            help='Do not process every chunk in a transaction')
+        parser.add_argument(
+            '--order-by', nargs='+', default=(),
+            help='The fields to order (and resume) by, defaults to the '
+                 'primary key')
+        parser.add_argument(
+            '--chunksize', type=int, default=1000,
+            help='The amount of rows per chunk and transaction')
+        parser.add_argument(
+            '--database', default=None,
+            help='The database to use, defaults to the default database')
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+
+        model = apps.apps.get_model(options['model'])
+        function = module_loading.import_string(options['function'])
+        queryset = model._default_manager.using(options['database'])
+        queryset = queryset.order_by(*options['order_by'])
+
+        if options['checkpoint']:
+            checkpoint = backfill.FileCheckpoint(options['checkpoint'])
+        elif options['cache_key']:
+            checkpoint = backfill.CacheCheckpoint(options['cache_key'])
+        else:
+            checkpoint = None
+
+        if checkpoint is not None and options['restart']:
+            checkpoint.clear()
+
+        rows = backfill.backfill(
+            queryset,
+            function,
+            rows_per_second=options['rate'],
+            chunksize=options['chunksize'],
+            checkpoint=checkpoint,
+            atomic=not options['no_atomic'],
+        )
+        self.log.info('Processed %d rows of %s', rows, model._meta.label)
@@ -0,0 +1,67 @@
+import io
+
+from django import apps
+from django.core.management import base
+
+from . import base_command
+from ... import exporters
+
+
+class Command(base_command.CustomBaseCommand):
+    help = '''Export a model to CSV or JSON Lines. The rows are streamed in
+    chunks so the memory usage is constant regardless of the table size.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='The model as `app_label.Model`')
+        parser.add_argument(
+            '-f', '--fields', nargs='+',
+            help='The fields to export, defaults to all fields')
+        parser.add_argument(
+            '--format', default='csv', choices=sorted(exporters.FORMATS))
+        parser.add_argument(
+            '-o', '--output', help='The output file, defaults to stdout')
+        parser.add_argument(
+            '-z', '--gzip', action='store_true', help='Compress using gzip')
+        parser.add_argument(
+            '--no-header', action='store_true',
+            help='Do not write a header with the field names to CSV exports')
+        parser.add_argument(
+            '--order-by', nargs='+', default=(),
+            help='The fields to order by, defaults to the primary key')
+        parser.add_argument(
+            '--chunksize', type=int, default=1000,
+            help='The amount of rows to fetch and write at once')
+        parser.add_argument(
+            '--database', default=None,
+            help='The database to use, defaults to the default database')
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+
+        model = apps.apps.get_model(options['model'])
+        queryset = model._default_manager.using(options['database'])
+        queryset = queryset.order_by(*options['order_by'])
+
+        output = options['output']
+        if not output and options['gzip']:
+            # Compressed data has to be written to the binary stream of the
+            # (text) stdout the command was called with
+            output = getattr(self.stdout._out, 'buffer', self.stdout._out)
+            if isinstance(output, io.TextIOBase):
+                raise base.CommandError(
+                    'Compressed output requires a binary stdout, use '
+                    '--output instead')
+        elif not output:
+            output = self.stdout
+
+        written = exporters.export_queryset(
+            queryset,
+            output,
+            fields=options['fields'],
+            format=options['format'],
+            header=not options['no_header'],
+            compress=options['gzip'],
+            chunksize=options['chunksize'],
+        )
+        self.log.info('Exported %s (%d bytes)', model._meta.label, written)
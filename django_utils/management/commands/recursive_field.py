@@ -0,0 +1,82 @@
+import copy
+import time
+
+from django import apps, db
+
+from . import base_command
+from ... import queryset as queryset_utils
+
+
+class Command(base_command.CustomBaseCommand):
+    help = '''Verify or rebuild the materialized paths of a RecursiveField and
+    benchmark the resolution strategies.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='The model as `app_label.Model`')
+        parser.add_argument(
+            'field', help='The name of the RecursiveField on the model')
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help='Rebuild the materialized paths')
+        parser.add_argument(
+            '--verify', action='store_true',
+            help='Verify the materialized paths')
+        parser.add_argument(
+            '--benchmark', type=int, default=0, metavar='NODES',
+            help='Resolve the value for the given amount of nodes using '
+                 'every available strategy')
+        parser.add_argument('--database', default=None)
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+
+        model = apps.apps.get_model(options['model'])
+        field = getattr(model, options['field'])
+        using = options['database']
+
+        if options['rebuild']:
+            updated = field.rebuild(using)
+            self.log.info('Rebuilt %d paths of %s', updated,
+                          model._meta.label)
+
+        if options['verify']:
+            invalid, verified = field.verify(using)
+            total = model._base_manager.using(using).count()
+            self.log.info('Verified %d nodes of %s, %d invalid paths',
+                          verified, model._meta.label, len(invalid))
+            if invalid:
+                self.log.warning('Invalid paths: %r', invalid[:100])
+            if verified != total:
+                self.log.warning(
+                    '%d nodes can not be reached from a root node',
+                    total - verified)
+
+        if options['benchmark']:
+            self.benchmark(field, using, options['benchmark'])
+
+    def benchmark(self, field, using, nodes):
+        manager = field.model._base_manager.using(using)
+        pks = list(manager.order_by('-pk').values_list(
+            'pk', flat=True)[:nodes])
+
+        strategies = ['python', 'cte']
+        if field.path_field:
+            strategies.append('path')
+
+        for strategy in strategies:
+            field_ = copy.copy(field)
+            field_.strategy = strategy
+            field_.cache = False
+
+            instances = list(manager.filter(pk__in=pks))
+            timer = queryset_utils._QueryTimer()
+            start = time.perf_counter()
+            with db.connections[manager.db].execute_wrapper(timer):
+                for instance in instances:
+                    field_.get(instance)
+
+            self.log.info(
+                '%s: %d nodes, %d queries, %.3fs (%.3fs in the database)',
+                strategy, len(instances), timer.queries,
+                time.perf_counter() - start, timer.time)
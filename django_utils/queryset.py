@@ -1,29 +1,1509 @@
+import array
+import asyncio
+import collections
+import copy
+import functools
 import gc
+import heapq
+import logging
+import operator
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from concurrent import futures
 
+import django
+from asgiref import sync
+from django import apps, db
+from django.core import exceptions
+from django.db.models import aggregates, constants, expressions, query, Q
+from django.utils import timezone
 
-def queryset_iterator(queryset, chunksize=1000, getfunc=getattr):
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+INTEGER_FIELDS = {
+    'AutoField',
+    'BigAutoField',
+    'BigIntegerField',
+    'IntegerField',
+    'PositiveBigIntegerField',
+    'PositiveIntegerField',
+    'PositiveSmallIntegerField',
+    'SmallAutoField',
+    'SmallIntegerField',
+}
+
+#: The `array.array` typecodes used for the columns of
+#: :py:func:`queryset_column_iterator`, other fields are returned as lists
+ARRAY_TYPECODES = dict.fromkeys(INTEGER_FIELDS, 'q')
+ARRAY_TYPECODES.update(
+    BooleanField='b',
+    FloatField='d',
+)
+
+
+class _KeysetColumn(collections.namedtuple(
+        '_KeysetColumn', 'name key descending nulls_first')):
+    '''A single column of the keyset used to paginate a queryset
+
+    :param name: The name used for filtering and ordering the queryset
+    :param key: The name passed to `getfunc` to read the value from a row
+    :param descending: Whether the column is sorted in descending order
+    :param nulls_first: Whether `NULL` values are sorted before all other
+        values, `None` if the column is not nullable
+    '''
+
+    def order_by(self):
+        if self.nulls_first is None:
+            kwargs = dict()
+        elif self.nulls_first:
+            kwargs = dict(nulls_first=True)
+        else:
+            kwargs = dict(nulls_last=True)
+
+        expression = expressions.F(self.name)
+        if self.descending:
+            return expression.desc(**kwargs)
+        else:
+            return expression.asc(**kwargs)
+
+    def equal(self, value):
+        if value is None:
+            return Q(**{f'{self.name}__isnull': True})
+        else:
+            return Q(**{self.name: value})
+
+    def after(self, value):
+        '''Return a `Q` object matching all values sorted after `value`, or
+        `None` if no values can follow it'''
+        lookup = 'lt' if self.descending else 'gt'
+        if value is None:
+            if self.nulls_first:
+                return Q(**{f'{self.name}__isnull': False})
+            else:
+                return None
+        elif self.nulls_first is False:
+            return Q(**{f'{self.name}__{lookup}': value}) | Q(
+                **{f'{self.name}__isnull': True})
+        else:
+            return Q(**{f'{self.name}__{lookup}': value})
+
+    def bound(self, value):
+        '''Return an inclusive range condition for the leading column so the
+        database can use a single index range scan, `None` if not possible'''
+        if value is None or self.nulls_first is False:
+            return None
+
+        lookup = 'lte' if self.descending else 'gte'
+        return Q(**{f'{self.name}__{lookup}': value})
+
+
+def _get_keyset_columns(queryset):
+    '''Convert the ordering of the queryset to a list of keyset columns
+
+    Querysets without an explicit `order_by()` are ordered by the primary key
+    and the primary key is always added as the final column to make the
+    ordering unique.
+    '''
+    if queryset.query.combinator:
+        raise ValueError(
+            f'Unable to iterate over a {queryset.query.combinator}() of '
+            'querysets, combined querysets can not be filtered')
+
+    opts = queryset.model._meta
+    columns = []
+    for order in queryset.query.order_by:
+        nulls_first = None
+        if isinstance(order, str):
+            descending = order.startswith('-')
+            name = order.lstrip('-')
+        elif isinstance(order, expressions.OrderBy) and isinstance(
+                order.expression, expressions.F):
+            descending = order.descending
+            name = order.expression.name
+            if order.nulls_first:
+                nulls_first = True
+            elif order.nulls_last:
+                nulls_first = False
+        elif isinstance(order, expressions.F):
+            descending = False
+            name = order.name
+        else:
+            raise ValueError(
+                f'Unable to iterate over {order!r}, only fields are '
+                'supported for ordered querysets'
+            )
+
+        if name == 'pk':
+            field = opts.pk
+        else:
+            try:
+                field = opts.get_field(name)
+            except exceptions.FieldDoesNotExist:
+                raise ValueError(
+                    f'Unable to iterate over {order!r}, only concrete fields '
+                    f'of {opts.label} are supported for ordered querysets'
+                )
+
+        if not field.concrete or field.many_to_many:
+            raise ValueError(
+                f'Unable to iterate over {order!r}, only concrete fields '
+                f'of {opts.label} are supported for ordered querysets'
+            )
+
+        if field.primary_key:
+            columns.append(_KeysetColumn('pk', 'pk', descending, None))
+            # The primary key is unique so the following columns can never
+            # influence the ordering
+            return columns
+
+        if field.null and nulls_first is None:
+            # Make the `NULL` ordering explicit since it differs between
+            # databases. Like PostgreSQL, `NULL` is sorted as the largest
+            # value by default
+            nulls_first = descending
+
+        columns.append(_KeysetColumn(
+            field.attname, field.attname, descending,
+            nulls_first if field.null else None,
+        ))
+
+    columns.append(_KeysetColumn('pk', 'pk', False, None))
+    return columns
+
+
+def _get_selected_names(query):
+    '''Return the names of the selected columns of a `values()` or
+    `values_list()` query in the order they are returned'''
+    selected = getattr(query, 'selected', None)
+    if not selected:
+        return [
+            *query.extra_select,
+            *query.values_select,
+            *query.annotation_select,
+        ]
+
+    # Since Django 5.2 the query keeps the selected names in order
+    return list(selected)  # pragma: no cover
+
+
+def _get_selected_alias(opts, column, names):
+    '''Return the name under which the keyset column is selected or `None`
+    if the column is not selected'''
+    if column.name == 'pk':
+        aliases = 'pk', opts.pk.name, opts.pk.attname
+    else:
+        aliases = column.name, opts.get_field(column.name).name
+
+    for alias in aliases:
+        if alias in names:
+            return alias
+
+
+def _get_row_getter(queryset, columns):
+    '''Get the `getfunc` and the keyset columns with matching keys to read
+    the ordering values from the rows of the queryset
+
+    For `values()` and `values_list()` querysets the values are read from the
+    dicts/tuples so the ordering fields (including the primary key) need to
+    be selected.
+    '''
+    iterable_class = queryset._iterable_class
+    if not issubclass(iterable_class, (
+            query.ValuesIterable,
+            query.ValuesListIterable,
+            query.FlatValuesListIterable)):
+        return getattr, columns
+
+    opts = queryset.model._meta
+    names = _get_selected_names(queryset.query)
+    keyed_columns = []
+    for column in columns:
+        alias = _get_selected_alias(opts, column, names)
+        if alias is None:
+            raise ValueError(
+                f'The ordering field {column.name!r} needs to be selected '
+                'to iterate over values querysets, selected fields: '
+                f'{names!r}'
+            )
+
+        if issubclass(iterable_class, query.ValuesIterable):
+            keyed_columns.append(column._replace(key=alias))
+        else:
+            keyed_columns.append(column._replace(key=names.index(alias)))
+
+    if issubclass(iterable_class, query.FlatValuesListIterable):
+        return _get_flat_value, keyed_columns
+    else:
+        return operator.getitem, keyed_columns
+
+
+def _get_flat_value(row, key):
+    return row
+
+
+def _keyset_filter(columns, values):
+    '''Create the filter for all rows sorted after the given values
+
+    The generated condition looks like this (with an optional range condition
+    for the first column):
+
+        a >= x AND (a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z))
+    '''
+    conditions = Q()
+    equal = Q()
+    for column, value in zip(columns, values):
+        after = column.after(value)
+        if after is not None:
+            conditions |= equal & after
+
+        equal &= column.equal(value)
+
+    bound = columns[0].bound(values[0])
+    if bound is not None and len(columns) > 1:
+        conditions = bound & conditions
+
+    return conditions
+
+
+class GCPolicy(object):
+    '''Garbage collection policy for the queryset iterators, called after
+    every chunk
+
+    :param generation: The generation to collect, see `gc.collect`
+    :param every: Collect after every N chunks, `0` to never collect
+    '''
+
+    def __init__(self, generation=2, every=1):
+        self.generation = generation
+        self.every = every
+
+    def __call__(self, chunk):
+        if self.every and not chunk % self.every:
+            gc.collect(self.generation)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} generation={self.generation} ' \
+               f'every={self.every}>'
+
+
+#: Run a full garbage collection after every chunk
+GC_ALWAYS = GCPolicy()
+#: Never run the garbage collector from the iterator
+GC_NEVER = GCPolicy(every=0)
+#: Only collect the youngest generation after every chunk
+GC_GENERATION_0 = GCPolicy(generation=0)
+
+
+class AdaptiveChunkSize(object):
+    '''Chunk size which adapts to a target fetch time and memory usage per
+    chunk
+
+    Pass an instance as the `chunksize` argument of the queryset iterators.
+    After every full chunk the size is recalculated using the measured fetch
+    time and the estimated memory usage of the rows, the size is changed by
+    at most a factor of 2 per chunk to prevent oscillation. The instance is
+    copied for every iteration so it can be shared.
+
+    :param initial: The size of the first chunk
+    :param target_time: The target time in seconds to fetch a chunk,
+        including the creation of the model instances
+    :param max_memory: The maximum estimated memory usage per chunk in bytes
+    :param minimum: The minimum chunk size
+    :param maximum: The maximum chunk size
+    '''
+
+    def __init__(
+            self, initial=1000, target_time=0.5, max_memory=None,
+            minimum=10, maximum=100000):
+        self.size = initial
+        self.target_time = target_time
+        self.max_memory = max_memory
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def __int__(self):
+        return self.size
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} size={self.size}>'
+
+    def update(self, rows, elapsed):
+        '''Calculate the size of the next chunk
+
+        :param rows: The rows of the previous chunk
+        :param elapsed: The time it took to fetch the rows in seconds
+        '''
+        if len(rows) < self.size:
+            return self.size
+
+        sizes = [self.size * 2]
+        if self.target_time and elapsed > 0:
+            sizes.append(self.size * self.target_time / elapsed)
+
+        if self.max_memory:
+            sizes.append(self.max_memory / _estimate_row_size(rows))
+
+        size = max(min(sizes), self.size // 2)
+        self.size = int(min(max(size, self.minimum), self.maximum))
+        return self.size
+
+
+def _estimate_row_size(rows):
+    '''Estimate the memory size of a row in bytes by sampling a few rows'''
+    samples = rows[0], rows[len(rows) // 2], rows[-1]
+    size = 0
+    for row in samples:
+        size += sys.getsizeof(row)
+        if isinstance(row, dict):
+            values = row.values()
+        elif isinstance(row, tuple):
+            values = row
+        elif hasattr(row, '__dict__'):
+            size += sys.getsizeof(row.__dict__)
+            values = row.__dict__.values()
+        else:
+            values = ()
+
+        size += sum(sys.getsizeof(value) for value in values)
+
+    return size / len(samples)
+
+
+def _prepare_keyset(queryset, getfunc):
+    '''Return the ordered queryset, the keyset columns and the `getfunc`'''
+    columns = _get_keyset_columns(queryset)
+    if getfunc is getattr:
+        getfunc, columns = _get_row_getter(queryset, columns)
+
+    queryset = queryset.order_by(*[column.order_by() for column in columns])
+    return queryset, columns, getfunc
+
+
+def _get_chunk(queryset, conditions, chunksize):
+    if conditions is None:
+        return queryset[:chunksize]
+    else:
+        return queryset.filter(conditions)[:chunksize]
+
+
+# Async iteration was added in Django 4.1 and supports `prefetch_related()`
+# since Django 5.0. Only one of the versions runs per Django version so both
+# are excluded from the coverage, the tests cover `_aget_rows` either way
+if django.VERSION >= (5, 0):  # pragma: no cover
+    async def _aget_rows(queryset):
+        return [row async for row in queryset]
+else:  # pragma: no cover
+    async def _aget_rows(queryset):
+        return await sync.sync_to_async(list)(queryset)
+
+
+class ChunkStats(object):
+    '''Statistics of a single chunk passed to the `observers` of
+    :py:func:`queryset_chunk_iterator`
+
+    All times are in seconds and the memory sizes in bytes.
+    '''
+
+    def __init__(
+            self, chunk, rows, total_rows, queries, db_time, fetch_time,
+            consumer_time, last_pk, rss_delta):
+        #: The (1-based) index of the chunk
+        self.chunk = chunk
+        #: The amount of rows in this chunk
+        self.rows = rows
+        #: The amount of rows in this and the previous chunks
+        self.total_rows = total_rows
+        #: The amount of queries, including `prefetch_related()` queries
+        self.queries = queries
+        #: The time spent executing the queries
+        self.db_time = db_time
+        #: The time spent fetching the rows, including the database time
+        self.fetch_time = fetch_time
+        #: The time the consumer spent processing the rows
+        self.consumer_time = consumer_time
+        #: The primary key of the last row
+        self.last_pk = last_pk
+        #: The change of the resident memory size, `None` if not available
+        self.rss_delta = rss_delta
+
+    @property
+    def hydration_time(self):
+        '''The time spent fetching the rows and creating the instances'''
+        return self.fetch_time - self.db_time
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}[{self.chunk}] rows={self.rows} ' \
+               f'db={self.db_time:.3f}s fetch={self.fetch_time:.3f}s ' \
+               f'consumer={self.consumer_time:.3f}s ' \
+               f'last_pk={self.last_pk!r}>'
+
+
+class ProgressReporter(object):
+    '''Observer for :py:func:`queryset_chunk_iterator` which logs the
+    progress and the estimated time remaining
+
+    For querysets ordered by an integer primary key the progress is estimated
+    from the position of the last primary key within the primary key range.
+    Otherwise the amount of rows is counted before starting.
+
+    .. code-block:: python
+
+        reporter = ProgressReporter(queryset)
+        for row in queryset_iterator(queryset, observers=[reporter]):
+            ...
+
+    :param queryset: The queryset that is iterated
+    :param logger: The logger to use, defaults to the logger of this module
+    :param interval: The minimum amount of seconds between log messages
+    '''
+
+    def __init__(self, queryset, logger=None, interval=10):
+        self.logger = logger or logging.getLogger(__name__)
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.logged = None
+        self.fraction = 0
+        self.eta = None
+        self.minimum = self.maximum = self.total = None
+
+        columns = _get_keyset_columns(queryset)
+        pk_type = queryset.model._meta.pk.get_internal_type()
+        if len(columns) == 1 and pk_type in INTEGER_FIELDS:
+            self.descending = columns[0].descending
+            limits = queryset.aggregate(
+                minimum=aggregates.Min('pk'), maximum=aggregates.Max('pk'))
+            self.minimum = limits['minimum']
+            self.maximum = limits['maximum']
+        else:
+            self.total = queryset.count()
+
+    def __call__(self, stats):
+        if self.total is not None:
+            self.fraction = stats.total_rows / max(self.total, 1)
+        elif self.maximum == self.minimum:
+            self.fraction = 1
+        else:
+            self.fraction = (stats.last_pk - self.minimum) / (
+                self.maximum - self.minimum)
+            if self.descending:
+                self.fraction = 1 - self.fraction
+
+        self.fraction = min(max(self.fraction, 0), 1)
+        now = time.perf_counter()
+        elapsed = now - self.start
+        if self.fraction:
+            self.eta = elapsed / self.fraction - elapsed
+
+        if self.logged is None or now - self.logged >= self.interval:
+            self.logged = now
+            self.logger.info(
+                'Processed %d rows (%.1f%%) in %.1fs, last pk: %r, '
+                'remaining: %s',
+                stats.total_rows, self.fraction * 100, elapsed,
+                stats.last_pk,
+                'unknown' if self.eta is None else f'{self.eta:.1f}s',
+            )
+
+
+class _QueryTimer(object):
+    '''Database execute wrapper which measures the query time'''
+
+    def __init__(self):
+        self.queries = 0
+        self.time = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.time += time.perf_counter() - start
+
+
+def _get_rss():
+    '''Return the resident memory size in bytes, `None` if unknown'''
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):  # pragma: no cover
+        return None
+
+
+def _release_prefetched(rows, lookups):
+    '''Remove the `prefetch_related()` caches from the rows'''
+    names = set()
+    for lookup in lookups:
+        path = getattr(lookup, 'prefetch_to', lookup)
+        names.add(path.split(constants.LOOKUP_SEP)[0])
+
+    for row in rows:
+        row.__dict__.pop('_prefetched_objects_cache', None)
+        fields_cache = row._state.fields_cache
+        for name in names:
+            # Prefetched foreign keys are stored in the fields cache and
+            # `Prefetch(to_attr=...)` results as attribute
+            fields_cache.pop(name, None)
+            row.__dict__.pop(name, None)
+
+
+def queryset_chunk_iterator(
+        queryset, chunksize=1000, getfunc=getattr, gc_policy=GC_ALWAYS,
+        reset_queries=False, release_prefetched=True, observers=(),
+        start_after=None):
+    '''
+    Iterate over a Django Queryset in chunks (lists) of at most `chunksize`
+    rows
+
+    See :py:func:`queryset_iterator` for the supported arguments, the only
+    difference is that this function yields the lists of rows instead of the
+    individual rows.
+    '''
+    queryset, columns, getfunc = _prepare_keyset(queryset, getfunc)
+    if isinstance(chunksize, AdaptiveChunkSize):
+        adaptive = copy.copy(chunksize)
+    else:
+        adaptive = None
+
+    if release_prefetched:
+        lookups = queryset._prefetch_related_lookups
+    else:
+        lookups = ()
+
+    if start_after is None:
+        conditions = None
+    elif len(start_after) != len(columns):
+        raise ValueError(
+            f'Expected {len(columns)} values for `start_after` '
+            f'({", ".join(column.name for column in columns)}), got '
+            f'{len(start_after)}')
+    else:
+        conditions = _keyset_filter(columns, start_after)
+
+    chunk = 0
+    total_rows = 0
+    while True:
+        chunk += 1
+        size = int(chunksize) if adaptive is None else adaptive.size
+        if observers:
+            rss = _get_rss()
+            timer = _QueryTimer()
+            start = time.perf_counter()
+            with db.connections[queryset.db].execute_wrapper(timer):
+                rows = list(_get_chunk(queryset, conditions, size))
+        else:
+            start = time.perf_counter()
+            rows = list(_get_chunk(queryset, conditions, size))
+
+        fetched = time.perf_counter()
+        if adaptive is not None and rows:
+            adaptive.update(rows, fetched - start)
+
+        if rows:
+            values = [getfunc(rows[-1], column.key) for column in columns]
+            conditions = _keyset_filter(columns, values)
+            yield rows
+
+            if lookups:
+                _release_prefetched(rows, lookups)
+
+            if observers:
+                total_rows += len(rows)
+                rss_delta = _get_rss()
+                if rss_delta is not None and rss is not None:
+                    rss_delta -= rss
+
+                stats = ChunkStats(
+                    chunk=chunk,
+                    rows=len(rows),
+                    total_rows=total_rows,
+                    queries=timer.queries,
+                    db_time=timer.time,
+                    fetch_time=fetched - start,
+                    consumer_time=time.perf_counter() - fetched,
+                    # The primary key is always the last keyset column
+                    last_pk=values[-1],
+                    rss_delta=rss_delta,
+                )
+                for observer in observers:
+                    observer(stats)
+
+        if len(rows) < size:
+            return
+
+        del rows
+        if reset_queries:
+            db.reset_queries()
+
+        if gc_policy:
+            gc_policy(chunk)
+
+
+def queryset_iterator(
+        queryset, chunksize=1000, getfunc=getattr, gc_policy=GC_ALWAYS,
+        reset_queries=False, release_prefetched=True, observers=(),
+        start_after=None):
     '''''
-    Iterate over a Django Queryset ordered by the primary key
+    Iterate over a Django Queryset ordered by the primary key or the ordering
+    of the queryset
 
     This method loads a maximum of chunksize (default: 1000) rows in it's
     memory at the same time while django normally would load all rows in it's
     memory. Using the iterator() method only causes it to not preload all the
     classes.
 
-    Note that the implementation of the iterator does not support ordered
-    query sets.
+    Ordered querysets are iterated using keyset pagination so every chunk is
+    a single (index) range query instead of an ever growing `OFFSET` scan.
+    The ordering can consist of multiple fields in mixed ascending/descending
+    order and nullable fields, the primary key is automatically added as the
+    last column to make the ordering unique. Only fields of the model itself
+    are supported, foreign keys are ordered by the raw `<field>_id` column.
+
+    For `values()` and `values_list()` querysets the dicts/tuples are yielded
+    without creating model instances. The ordering values are read from the
+    rows directly so the ordering fields (including the primary key) need to
+    be part of the selected fields.
+
+    The `select_related()` and `prefetch_related()` lookups (including
+    `Prefetch` objects) of the queryset are applied to every chunk so the
+    amount of queries per chunk is constant. Once the next chunk is requested
+    the prefetched objects of the previous chunk are released, pass
+    `release_prefetched=False` if the rows are still used after that.
+
+    For long running iterations the `chunksize` can adapt to a target fetch
+    time and memory usage per chunk by passing an
+    :py:class:`AdaptiveChunkSize`:
+
+    .. code-block:: python
+
+        queryset_iterator(
+            queryset,
+            chunksize=AdaptiveChunkSize(target_time=0.2, max_memory=2 ** 26),
+            gc_policy=GC_GENERATION_0,
+            reset_queries=True,
+        )
+
+    :param queryset: The queryset to iterate, querysets without an explicit
+        `order_by()` are ordered by the primary key
+    :param chunksize: The maximum amount of rows to fetch per query or an
+        :py:class:`AdaptiveChunkSize`
+    :param getfunc: The function used to read the ordering values (i.e. the
+        primary key) from the rows, automatically chosen for `values()` and
+        `values_list()` querysets
+    :param gc_policy: The :py:class:`GCPolicy` to apply after every chunk,
+        `None` to disable garbage collection
+    :param reset_queries: Reset the query log of the database connections
+        after every chunk, the log keeps growing with `DEBUG` enabled
+    :param release_prefetched: Release the `prefetch_related()` caches of
+        the rows after every chunk
+    :param observers: Callables which are called with the
+        :py:class:`ChunkStats` after every chunk has been processed, see
+        :py:class:`ProgressReporter` for a progress logger
+    :param start_after: Resume the iteration after the row with these
+        ordering values, a value for every ordering column with the primary
+        key as the last value (e.g. `(last_pk,)` for the default ordering)
+    '''
+    for rows in queryset_chunk_iterator(
+            queryset, chunksize, getfunc, gc_policy, reset_queries,
+            release_prefetched, observers, start_after):
+        for row in rows:
+            yield row
+
+
+async def aqueryset_chunk_iterator(
+        queryset, chunksize=1000, getfunc=getattr, read_ahead=1,
+        release_prefetched=True):
+    '''
+    Asynchronously iterate over a Django Queryset in chunks (lists) of at
+    most `chunksize` rows
+
+    The next chunks are fetched in the background using the async ORM (or
+    `sync_to_async` before Django 5.0) while the current chunk is being
+    processed so the database latency and the processing time overlap. The
+    amount of chunks fetched ahead is limited by `read_ahead`, fetching
+    pauses until the consumer asks for the next chunk.
+
+    See :py:func:`queryset_iterator` for the other arguments.
+
+    :param read_ahead: The maximum amount of chunks to fetch before they
+        are requested, `0` to only fetch on request
     '''
-    pk = 0
+    queryset, columns, getfunc = _prepare_keyset(queryset, getfunc)
+    if isinstance(chunksize, AdaptiveChunkSize):
+        adaptive = copy.copy(chunksize)
+    else:
+        adaptive = None
+
+    chunks = asyncio.Queue()
+    available = asyncio.Semaphore(read_ahead)
+
+    async def fetch():
+        try:
+            conditions = None
+            while True:
+                await available.acquire()
+                size = int(chunksize) if adaptive is None else adaptive.size
+                start = time.perf_counter()
+                rows = await _aget_rows(
+                    _get_chunk(queryset, conditions, size))
+                if adaptive is not None and rows:
+                    adaptive.update(rows, time.perf_counter() - start)
+
+                if rows:
+                    conditions = _keyset_filter(columns, [
+                        getfunc(rows[-1], column.key) for column in columns])
+                    await chunks.put(rows)
 
+                if len(rows) < size:
+                    break
+        except Exception as exception:
+            await chunks.put(exception)
+
+        await chunks.put(None)
+
+    task = asyncio.ensure_future(fetch())
     try:
-        '''In the case of an empty list, return'''
-        last_pk = getfunc(queryset.order_by('-pk')[0], 'pk')
-    except IndexError:
-        return
-
-    queryset = queryset.order_by('pk')
-    while pk < last_pk:
-        for row in queryset.filter(pk__gt=pk)[:chunksize]:
-            pk = getfunc(row, 'pk')
+        while True:
+            # The previous chunk has been processed so we can fetch the next
+            available.release()
+            rows = await chunks.get()
+            if rows is None:
+                break
+            elif isinstance(rows, Exception):
+                raise rows
+            else:
+                yield rows
+
+                if release_prefetched and queryset._prefetch_related_lookups:
+                    _release_prefetched(
+                        rows, queryset._prefetch_related_lookups)
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+async def aqueryset_iterator(
+        queryset, chunksize=1000, getfunc=getattr, read_ahead=1,
+        release_prefetched=True):
+    '''
+    Asynchronous version of :py:func:`queryset_iterator` which fetches the
+    next chunks in the background
+
+    .. code-block:: python
+
+        async for row in aqueryset_iterator(queryset, read_ahead=2):
+            await process(row)
+
+    See :py:func:`aqueryset_chunk_iterator` for the arguments.
+    '''
+    async for rows in aqueryset_chunk_iterator(
+            queryset, chunksize, getfunc, read_ahead, release_prefetched):
+        for row in rows:
+            yield row
+
+
+def _to_column(values, typecode, use_numpy):
+    if typecode and None in values:
+        typecode = None
+
+    if use_numpy:
+        if typecode:
+            return numpy.array(values, dtype=bool if typecode == 'b' else
+                               typecode)
+        else:
+            return numpy.array(values, dtype=object)
+    elif typecode:
+        return array.array(typecode, values)
+    else:
+        return list(values)
+
+
+def _values_list_chunk_iterator(queryset, fields, chunksize, **kwargs):
+    '''Iterate over the `values_list()` of the given fields in chunks
+
+    The ordering fields which were not requested are fetched so the keyset
+    can be read from the rows, they are stripped from the results.
+    '''
+    opts = queryset.model._meta
+    extra = [
+        column.name for column in _get_keyset_columns(queryset)
+        if _get_selected_alias(opts, column, fields) is None
+    ]
+
+    queryset = queryset.prefetch_related(None).values_list(*fields, *extra)
+    for rows in queryset_chunk_iterator(queryset, chunksize, **kwargs):
+        if extra:
+            rows = [row[:len(fields)] for row in rows]
+        yield rows
+
+
+def queryset_column_iterator(
+        queryset, *fields, chunksize=1000, use_numpy=None):
+    '''
+    Iterate over the given fields of a Django Queryset in columnar chunks
+
+    For every chunk a dictionary of field name to column is yielded. Integer,
+    float and boolean fields are returned as `numpy` arrays if `numpy` is
+    installed and `array.array` otherwise. Other fields (and columns
+    containing `NULL` values) are returned as `numpy` object arrays or lists.
+    No model instances are created so aggregations can be done per chunk:
+
+    .. code-block:: python
+
+        for columns in queryset_column_iterator(queryset, 'price'):
+            total += sum(columns['price'])
+
+    :param queryset: The queryset to iterate, see
+        :py:func:`queryset_iterator` for the supported ordering
+    :param fields: The fields to return, all concrete fields if not given
+    :param chunksize: The maximum amount of rows per chunk
+    :param use_numpy: Return `numpy` arrays, defaults to `True` if `numpy`
+        is installed
+    '''
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    elif use_numpy and numpy is None:  # pragma: no cover
+        raise ImportError('numpy is required for `use_numpy`')
+
+    opts = queryset.model._meta
+    if not fields:
+        fields = [field.attname for field in opts.concrete_fields]
+
+    typecodes = []
+    for name in fields:
+        try:
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+            typecodes.append(ARRAY_TYPECODES.get(field.get_internal_type()))
+        except exceptions.FieldDoesNotExist:
+            typecodes.append(None)
+
+    for rows in _values_list_chunk_iterator(queryset, fields, chunksize):
+        values = list(zip(*rows))
+        yield {
+            name: _to_column(values[i], typecodes[i], use_numpy)
+            for i, name in enumerate(fields)
+        }
+
+
+#: The position of a :py:class:`ChangeFeed`, the change timestamp and the
+#: primary key of the last processed row
+Watermark = collections.namedtuple('Watermark', 'timestamp pk')
+
+
+class ChangeFeed(object):
+    '''
+    Iterate over the rows changed since a watermark, ordered by
+    `(updated_at, pk)`
+
+    The rows are fetched using keyset chunks (see
+    :py:func:`queryset_chunk_iterator`) starting after the
+    :py:class:`Watermark`. Since the primary key is part of the watermark,
+    rows with the same timestamp are never skipped or returned twice, even
+    if a chunk ends halfway through them. After every processed chunk the
+    `watermark` attribute is updated, store it to continue from there during
+    the next run:
+
+    .. code-block:: python
+
+        feed = ChangeFeed(Spam.objects.all(), watermark=cache.get('spam'))
+        for spam in feed:
+            search_index.update(spam)
+
+        cache.set('spam', feed.watermark)
+
+    The scan is an index range scan if the model has an index on
+    `(updated_at, pk)`, see
+    :py:func:`django_utils.base_models.updated_at_index`.
+
+    Rows are returned once their transaction is committed, which can be
+    after rows with a later timestamp were already processed. Use `delay`
+    to exclude the most recent changes that could still be in flight.
+
+    :param queryset: The queryset to iterate, the ordering is replaced
+    :param watermark: A :py:class:`Watermark` (or a `(timestamp, pk)`
+        sequence) to start after, a `datetime` to return the rows changed
+        after that time or `None` to return all rows
+    :param field: The name of the change timestamp field
+    :param chunksize: The maximum amount of rows to fetch per query
+    :param delay: A `timedelta`, only return rows changed before
+        `now() - delay`
+    :param kwargs: Passed to :py:func:`queryset_chunk_iterator`
+    '''
+
+    def __init__(
+            self, queryset, watermark=None, field='updated_at',
+            chunksize=1000, delay=None, **kwargs):
+        self.field = field
+        self.chunksize = chunksize
+        self.delay = delay
+        self.kwargs = kwargs
+        self.queryset = queryset.order_by(field, 'pk')
+        if watermark is None or isinstance(watermark, Watermark):
+            self.watermark = watermark
+        elif isinstance(watermark, (list, tuple)):
+            self.watermark = Watermark(*watermark)
+        else:
+            self.queryset = self.queryset.filter(**{f'{field}__gt': watermark})
+            self.watermark = None
+
+    def chunks(self):
+        '''Yield the lists of changed rows, the watermark is updated once
+        the consumer requests the next chunk'''
+        queryset = self.queryset
+        if self.delay is not None:
+            queryset = queryset.filter(**{
+                f'{self.field}__lt': timezone.now() - self.delay})
+
+        queryset, columns, getfunc = _prepare_keyset(
+            queryset, self.kwargs.get('getfunc', getattr))
+        for rows in queryset_chunk_iterator(
+                queryset, self.chunksize, start_after=self.watermark,
+                **self.kwargs):
+            yield rows
+            self.watermark = Watermark(*[
+                getfunc(rows[-1], column.key) for column in columns])
+
+    def __iter__(self):
+        for rows in self.chunks():
+            for row in rows:
+                yield row
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.queryset.model.__name__} ' \
+               f'watermark={self.watermark!r}>'
+
+
+@functools.total_ordering
+class _Reversed(object):
+    '''Reverse the ordering of a value for descending merge keys'''
+    __slots__ = 'value',
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def _get_merge_key(columns, getfunc):
+    '''Create a key function which sorts rows in the same order as the
+    database, the `NULL` values are sorted using a separate flag'''
+    def key(row):
+        values = []
+        for column in columns:
+            value = getfunc(row, column.key)
+            if value is None:
+                values.append((-1 if column.nulls_first else 1, None))
+            elif column.descending:
+                values.append((0, _Reversed(value)))
+            else:
+                values.append((0, value))
+
+        return values
+
+    return key
+
+
+def _fetch_chunks(queryset, chunks, stop, kwargs):
+    '''Fetch the chunks of a queryset in a thread and put them in the
+    `chunks` queue, `None` marks the end'''
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+    try:
+        for rows in queryset_chunk_iterator(queryset, **kwargs):
+            if not put(rows):
+                return
+
+        put(None)
+    except Exception as exception:
+        put(exception)
+    finally:
+        db.connections[queryset.db].close()
+
+
+def _get_queued_rows(chunks):
+    while True:
+        rows = chunks.get()
+        if rows is None:
+            return
+        elif isinstance(rows, Exception):
+            raise rows
+
+        for row in rows:
             yield row
-        gc.collect()
+
+
+def queryset_merge_iterator(
+        queryset, using, chunksize=1000, getfunc=getattr, read_ahead=1,
+        **kwargs):
+    '''
+    Iterate over a Django Queryset on multiple databases, merged on the
+    ordering of the queryset
+
+    Every database is iterated using :py:func:`queryset_chunk_iterator` in a
+    separate thread which fetches up to `read_ahead` chunks in advance, so
+    the databases are queried in parallel. The rows are merged with a heap so
+    the result is ordered as if the tables were a single table.
+
+    .. code-block:: python
+
+        for row in queryset_merge_iterator(
+                Spam.objects.order_by('created_at'), ['shard_1', 'shard_2']):
+            ...
+
+    :param queryset: The queryset to iterate, see
+        :py:func:`queryset_iterator` for the supported ordering
+    :param using: The database aliases to iterate
+    :param chunksize: The maximum amount of rows per query
+    :param getfunc: The function used to read the ordering values
+    :param read_ahead: The maximum amount of chunks to fetch in advance per
+        database
+    :param kwargs: Passed to :py:func:`queryset_chunk_iterator`
+    '''
+    _, columns, key_getfunc = _prepare_keyset(queryset, getfunc)
+    key = _get_merge_key(columns, key_getfunc)
+    kwargs.update(chunksize=chunksize, getfunc=getfunc)
+
+    stop = threading.Event()
+    threads = []
+    iterators = []
+    try:
+        for alias in using:
+            chunks = queue.Queue(maxsize=max(read_ahead, 1))
+            thread = threading.Thread(
+                target=_fetch_chunks,
+                args=(queryset.using(alias), chunks, stop, kwargs),
+                name=f'queryset_merge_iterator-{alias}',
+                daemon=True,
+            )
+            thread.start()
+            threads.append(thread)
+            iterators.append(_get_queued_rows(chunks))
+
+        for row in heapq.merge(*iterators, key=key):
+            yield row
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+class ShardResult(object):
+    '''The result of processing a single shard with
+    :py:func:`queryset_parallel_map`
+
+    :param index: The index of the shard
+    :param start: The inclusive lower primary key bound, `None` for no bound
+    :param stop: The exclusive upper primary key bound, `None` for no bound
+    '''
+
+    def __init__(self, index, start=None, stop=None):
+        self.index = index
+        self.start = start
+        self.stop = stop
+        self.rows = 0
+        self.results = []
+        self.error = None
+        self.traceback = None
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}[{self.index}] {self.start!r} - ' \
+               f'{self.stop!r}: {self.rows} rows>'
+
+
+class ParallelResult(object):
+    '''The aggregated results of :py:func:`queryset_parallel_map`'''
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    @property
+    def rows(self):
+        '''The total amount of rows processed'''
+        return sum(shard.rows for shard in self.shards)
+
+    @property
+    def results(self):
+        '''The results of all chunks, ordered by shard and chunk'''
+        return [result for shard in self.shards for result in shard.results]
+
+    @property
+    def errors(self):
+        '''A dictionary of shard index to exception for all failed shards'''
+        return {
+            shard.index: shard.error
+            for shard in self.shards
+            if shard.error is not None
+        }
+
+
+class _PickledQueryset(object):
+    '''Picklable queryset representation, pickling a queryset normally
+    fetches all rows'''
+
+    def __init__(self, queryset):
+        self.model = queryset.model
+        self.db = queryset.db
+        self.query = queryset.query
+        self.iterable_class = queryset._iterable_class
+        # The names of `values()` and `values_list()` querysets, before
+        # Django 5.2 these determine the order of annotated columns
+        self.fields = queryset._fields
+        # The prefetch lookups are stored on the queryset, not the query
+        self.prefetch_related_lookups = queryset._prefetch_related_lookups
+
+    def restore(self):
+        queryset = self.model._base_manager.db_manager(self.db).all()
+        queryset.query = self.query
+        queryset._iterable_class = self.iterable_class
+        queryset._fields = self.fields
+        queryset._prefetch_related_lookups = self.prefetch_related_lookups
+        return queryset
+
+
+#: The amount of primary keys to sample per shard for the `sample` boundaries
+SAMPLES_PER_SHARD = 100
+
+
+def _get_shard_boundaries(queryset, shards, boundaries):
+    if boundaries == 'minmax':
+        limits = queryset.aggregate(
+            minimum=aggregates.Min('pk'), maximum=aggregates.Max('pk'))
+        if limits['minimum'] is None:
+            return []
+
+        step = (limits['maximum'] - limits['minimum'] + 1) / shards
+        values = [limits['minimum'] + round(i * step)
+                  for i in range(1, shards)]
+    elif boundaries == 'sample':
+        # A single query for a random sample of the primary keys, the
+        # quantiles of the sample approximate equally sized shards. Note
+        # that the database still has to read and sort all primary keys of
+        # the queryset for `ORDER BY RANDOM()`
+        sample = sorted(queryset.order_by('?').values_list(
+            'pk', flat=True)[:shards * SAMPLES_PER_SHARD])
+        values = [sample[len(sample) * i // shards] for i in range(1, shards)
+                  if len(sample) * i // shards]
+    else:
+        raise ValueError(f'Unknown boundaries method: {boundaries!r}')
+
+    return sorted(set(values))
+
+
+def _initialize_process():
+    '''Process pool initializer, the database connections are shared with
+    the parent process so new connections need to be created'''
+    if not apps.apps.ready:  # pragma: no cover
+        django.setup()
+
+    db.connections.close_all()
+
+
+def _process_shard(queryset, function, shard, chunksize):
+    try:
+        if isinstance(queryset, _PickledQueryset):
+            queryset = queryset.restore()
+
+        if shard.start is not None:
+            queryset = queryset.filter(pk__gte=shard.start)
+        if shard.stop is not None:
+            queryset = queryset.filter(pk__lt=shard.stop)
+
+        for rows in queryset_chunk_iterator(queryset, chunksize):
+            shard.rows += len(rows)
+            shard.results.append(function(rows))
+    except Exception as exception:
+        shard.error = exception
+        shard.traceback = traceback.format_exc()
+    finally:
+        # Every worker thread/process has its own database connection which
+        # would otherwise remain open
+        db.connections.close_all()
+
+    return shard
+
+
+def queryset_parallel_map(
+        queryset, function, shards=None, workers=None, executor='thread',
+        chunksize=1000, boundaries=None):
+    '''
+    Process a Django Queryset in parallel by splitting the primary key range
+    into shards which are processed with a thread or process pool
+
+    Every shard is iterated using :py:func:`queryset_chunk_iterator` and
+    `function` is called with every chunk (list of rows). The return values
+    are collected per shard and returned together with the errors as a
+    :py:class:`ParallelResult`, a failing shard does not stop the other
+    shards.
+
+    When using the `process` executor the database connections are closed
+    before forking and `function` needs to be picklable (i.e. a module level
+    function). Since closing the connections breaks running transactions,
+    this is not allowed within an atomic block.
+
+    :param queryset: The queryset to process
+    :param function: The function to call with every chunk of rows
+    :param shards: The amount of primary key ranges, defaults to `workers`
+    :param workers: The amount of workers, defaults to the amount of CPUs
+    :param executor: Either `thread` or `process`
+    :param chunksize: The maximum amount of rows per chunk
+    :param boundaries: The method to calculate the shard boundaries, `minmax`
+        to split the range between the minimum and maximum primary key into
+        equal parts or `sample` to take the quantiles of a random sample of
+        the primary keys so every shard has roughly the same amount of rows.
+        The sample is a single `ORDER BY RANDOM() LIMIT` query which still
+        reads and sorts all primary keys, for very large tables `minmax` is
+        considerably cheaper. Defaults to `minmax` for integer primary keys
+        and `sample` otherwise
+    '''
+    workers = workers or shards or os.cpu_count()
+    shards = shards or workers
+
+    if boundaries is None:
+        if queryset.model._meta.pk.get_internal_type() in INTEGER_FIELDS:
+            boundaries = 'minmax'
+        else:
+            boundaries = 'sample'
+
+    values = _get_shard_boundaries(queryset, shards, boundaries)
+    values = [None] + values + [None]
+
+    if executor == 'thread':
+        pool = futures.ThreadPoolExecutor(max_workers=workers)
+    elif executor == 'process':
+        for connection in db.connections.all():
+            if connection.in_atomic_block:
+                raise RuntimeError(
+                    'Process based parallel processing is not possible '
+                    f'within a transaction on database {connection.alias!r}'
+                )
+
+        db.connections.close_all()
+        pool = futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_initialize_process,
+        )
+        queryset = _PickledQueryset(queryset)
+    else:
+        raise ValueError(f'Unknown executor: {executor!r}')
+
+    with pool:
+        tasks = []
+        for index, (start, stop) in enumerate(zip(values, values[1:])):
+            shard = ShardResult(index, start, stop)
+            tasks.append((shard, pool.submit(
+                _process_shard, queryset, function, shard, chunksize)))
+
+        results = []
+        for shard, task in tasks:
+            try:
+                results.append(task.result())
+            except Exception as exception:
+                # Errors within the pool itself such as a crashed process or
+                # an unpicklable function
+                shard.error = exception
+                results.append(shard)
+
+    return ParallelResult(results)
+
+
+class BulkWriter(object):
+    '''
+    Collect modified and new model instances and write them in batches using
+    `bulk_update()` and `bulk_create()` instead of one query per `save()`
+
+    Instances returned by :py:meth:`iterate` are tracked automatically, the
+    changed fields are detected by comparing the fields with the values at
+    the time the instance was yielded. The changes are written at every
+    chunk boundary and when leaving the context manager:
+
+    .. code-block:: python
+
+        with BulkWriter(batch_size=500) as writer:
+            for spam in writer.iterate(Spam.objects.all()):
+                spam.name = spam.name.title()
+
+            writer.create(Spam(name='eggs'))
+
+    Note that `save()` is not called so no signals are sent, `auto_now`
+    fields are updated for all changed instances though.
+
+    :param batch_size: The maximum amount of rows per query, pending changes
+        are written automatically when this amount is reached
+    :param using: The database to write to, defaults to the database the
+        instance was loaded from or the router's write database
+    '''
+
+    def __init__(self, batch_size=1000, using=None):
+        self.batch_size = batch_size
+        self.using = using
+        self.created = 0
+        self.updated = 0
+        self._tracked = []
+        self._saved = []
+        self._new = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def __len__(self):
+        '''The amount of pending instances'''
+        return len(self._tracked) + len(self._saved) + len(self._new)
+
+    @classmethod
+    def _snapshot(cls, instance):
+        values = dict()
+        for field in instance._meta.concrete_fields:
+            if field.attname in instance.__dict__ and not field.primary_key:
+                value = instance.__dict__[field.attname]
+                if isinstance(value, (dict, list, set)):
+                    value = copy.deepcopy(value)
+                values[field.attname] = value
+
+        return values
+
+    def _get_db(self, instance):
+        return self.using or instance._state.db or db.router.db_for_write(
+            instance.__class__, instance=instance)
+
+    def track(self, instance):
+        '''Track the instance so changes will be written on flush'''
+        self._tracked.append((instance, self._snapshot(instance)))
+
+    def save(self, instance, fields=None):
+        '''Write the given fields (defaults to all fields) of the instance on
+        the next flush, new instances are created'''
+        if instance._state.adding:
+            self.create(instance)
+        else:
+            if fields is None:
+                fields = [
+                    field.name for field in instance._meta.concrete_fields
+                    if not field.primary_key
+                ]
+            self._saved.append((instance, set(fields)))
+            self._check_batch_size()
+
+    def create(self, instance):
+        '''Create the instance on the next flush'''
+        self._new.append(instance)
+        self._check_batch_size()
+
+    def _check_batch_size(self):
+        if len(self._saved) + len(self._new) >= self.batch_size:
+            self.flush()
+
+    def iterate(self, queryset, chunksize=None, **kwargs):
+        '''Iterate over the queryset using :py:func:`queryset_chunk_iterator`
+        and track all instances, the changes are flushed after every chunk
+
+        Since the rows are selected by their ordering values, the ordering
+        fields should not be modified while iterating. Orderings on
+        `auto_now` fields (i.e. `updated_at`) are refused since every
+        written row would move past the keyset and be returned again.
+
+        :param queryset: The queryset to iterate
+        :param chunksize: The chunk size, defaults to the `batch_size`
+        :param kwargs: Passed to :py:func:`queryset_chunk_iterator`
+        '''
+        opts = queryset.model._meta
+        for column in _get_keyset_columns(queryset):
+            if column.name != 'pk' and getattr(
+                    opts.get_field(column.name), 'auto_now', False):
+                raise ValueError(
+                    f'Unable to iterate over {opts.label} ordered by the '
+                    f'`auto_now` field {column.name!r}, the writer updates '
+                    'it for every changed row')
+
+        for rows in queryset_chunk_iterator(
+                queryset, chunksize or self.batch_size, **kwargs):
+            for row in rows:
+                self.track(row)
+                yield row
+
+            self.flush()
+
+    def _get_updates(self):
+        updates = collections.defaultdict(dict)
+        for instance, snapshot in self._tracked:
+            fields = set()
+            for field in instance._meta.concrete_fields:
+                if field.attname in snapshot and snapshot[
+                        field.attname] != instance.__dict__.get(
+                        field.attname):
+                    fields.add(field.name)
+
+            if fields:
+                self._add_update(updates, instance, fields)
+
+        for instance, fields in self._saved:
+            self._add_update(updates, instance, fields)
+
+        return updates
+
+    def _add_update(self, updates, instance, fields):
+        for field in instance._meta.concrete_fields:
+            if getattr(field, 'auto_now', False):
+                field.pre_save(instance, False)
+                fields.add(field.name)
+
+        # Use a dict to deduplicate the instances while retaining the order
+        key = instance.__class__, self._get_db(instance)
+        updates[key].setdefault(id(instance), (instance, set()))[1].update(
+            fields)
+
+    def flush(self):
+        '''Write all pending changes, every model and database is written in a
+        separate transaction'''
+        updates = self._get_updates()
+        creates = collections.defaultdict(list)
+        for instance in self._new:
+            creates[instance.__class__, self._get_db(instance)].append(
+                instance)
+
+        self._tracked = []
+        self._saved = []
+        self._new = []
+
+        for (model, using), instances in updates.items():
+            fields = set()
+            for instance, instance_fields in instances.values():
+                fields.update(instance_fields)
+
+            with db.transaction.atomic(using=using):
+                model._base_manager.db_manager(using).bulk_update(
+                    [instance for instance, _ in instances.values()],
+                    sorted(fields),
+                    batch_size=self.batch_size,
+                )
+            self.updated += len(instances)
+
+        for (model, using), instances in creates.items():
+            with db.transaction.atomic(using=using):
+                model._base_manager.db_manager(using).bulk_create(
+                    instances, batch_size=self.batch_size)
+            self.created += len(instances)
@@ -0,0 +1,267 @@
+'''
+Fast serialization of (large) querysets
+
+The Django serializers create a model instance for every row and introspect
+every field of every instance. The serializers in this module are compiled
+once per model and set of fields, they fetch the rows as tuples through
+`values_list()` in chunks and only convert the values which are not
+JSON-ready. The output is identical to the Django `python` serializer:
+
+.. code-block:: python
+
+    from django_utils import serializers
+
+    serializers.serialize(Spam.objects.all(), fields=['name'])
+
+    serializer = serializers.get_serializer(Spam)
+    for objects in serializer.chunks(Spam.objects.all()):
+        ...
+
+Many to many fields are fetched with a single query per chunk and field.
+'''
+import itertools
+import types
+
+from django import db
+from django.utils import encoding
+
+from . import queryset as queryset_utils
+
+#: Fields of which the database values are always JSON-ready (or handled
+#: by :py:mod:`django_utils.json_backends`) and need no conversion
+NATIVE_FIELDS = {
+    'AutoField',
+    'BigAutoField',
+    'BigIntegerField',
+    'BooleanField',
+    'CharField',
+    'DateField',
+    'DateTimeField',
+    'DecimalField',
+    'EmailField',
+    'FilePathField',
+    'FloatField',
+    'GenericIPAddressField',
+    'IntegerField',
+    'NullBooleanField',
+    'PositiveBigIntegerField',
+    'PositiveIntegerField',
+    'PositiveSmallIntegerField',
+    'SlugField',
+    'SmallAutoField',
+    'SmallIntegerField',
+    'TextField',
+    'TimeField',
+    'URLField',
+}
+
+
+def _get_converter(field):
+    '''Return the function to convert the values of the field like the Django
+    serializers do or `None` if the values can be used as is'''
+    target = field.target_field if field.remote_field else field
+    if target.get_internal_type() in NATIVE_FIELDS and not hasattr(
+            target, 'from_db_value'):
+        return None
+
+    attname = field.attname
+
+    def convert(value):
+        if encoding.is_protected_type(value):
+            return value
+        else:
+            return field.value_to_string(
+                types.SimpleNamespace(**{attname: value}))
+
+    return convert
+
+
+def _get_queryset_chunks(queryset, chunksize, fields=None):
+    '''Yield the rows of the queryset in chunks, using keyset pagination
+    when the ordering allows it and the database cursor otherwise
+
+    :param fields: Yield the `values_list()` of these fields instead of the
+        rows of the queryset
+    '''
+    query = queryset.query
+    keyset = not query.low_mark and query.high_mark is None \
+        and not query.combinator
+    if keyset:
+        if not query.order_by and query.default_ordering \
+                and queryset.model._meta.ordering:
+            queryset = queryset.order_by(*queryset.model._meta.ordering)
+
+        try:
+            queryset_utils._prepare_keyset(queryset, getattr)
+        except ValueError:
+            keyset = False
+
+    if keyset and fields is None:
+        yield from queryset_utils.queryset_chunk_iterator(
+            queryset, chunksize, gc_policy=None)
+    elif keyset:
+        yield from queryset_utils._values_list_chunk_iterator(
+            queryset, fields, chunksize, gc_policy=None)
+    else:
+        if fields is not None:
+            # Combined querysets don't support `prefetch_related()`
+            if not query.combinator:
+                queryset = queryset.prefetch_related(None)
+            queryset = queryset.values_list(*fields)
+
+        rows = queryset.iterator(chunk_size=chunksize)
+        while True:
+            chunk = list(itertools.islice(rows, chunksize))
+            if not chunk:
+                return
+
+            yield chunk
+
+
+class ModelSerializer(object):
+    '''
+    Serializer for the rows of a model, use :py:func:`get_serializer` to get
+    a cached instance
+
+    :param model: The model to serialize
+    :param fields: The names of the fields to serialize, all serializable
+        fields if not given
+    '''
+
+    def __init__(self, model, fields=None):
+        self.model = model
+        self.label = str(model._meta)
+
+        opts = model._meta.concrete_model._meta
+        self.pk_converter = _get_converter(opts.pk)
+
+        #: The `values_list()` lookups, the primary key is always first
+        self.columns = ['pk']
+        self.names = []
+        self.converters = []
+        for field in opts.local_fields:
+            if not field.serialize or (
+                    fields is not None and field.name not in fields):
+                continue
+
+            converter = _get_converter(field)
+            if converter is not None:
+                self.converters.append((field.name, converter))
+
+            self.columns.append(field.attname)
+            self.names.append(field.name)
+
+        self.many_to_many = []
+        for field in opts.local_many_to_many:
+            if not field.serialize or (
+                    fields is not None and field.name not in fields):
+                continue
+
+            # Like the Django serializers, only the automatically created
+            # relations are serialized
+            if field.remote_field.through._meta.auto_created:
+                self.many_to_many.append((field, _get_converter(
+                    field.remote_field.model._meta.pk)))
+
+    def _get_related(self, field, converter, pks, using):
+        '''Return the (converted) related primary keys per primary key'''
+        through = field.remote_field.through
+        source = field.m2m_field_name()
+        target = field.m2m_reverse_field_name()
+
+        related = {pk: [] for pk in pks}
+        rows = through._base_manager.using(using).filter(**{
+            f'{source}__in': pks,
+        }).order_by('pk').values_list(source, target)
+        for pk, value in rows:
+            if converter is not None:
+                value = converter(value)
+
+            related[pk].append(value)
+
+        return related
+
+    def serialize_rows(self, rows, using=db.DEFAULT_DB_ALIAS):
+        '''
+        Serialize the `values_list()` rows of :py:attr:`columns`
+
+        :param rows: The rows (tuples) to serialize
+        :param using: The database to fetch the many to many relations from
+        :return: A list of dicts in the format of the Django `python`
+            serializer
+        '''
+        objects = []
+        for row in rows:
+            fields = dict(zip(self.names, row[1:]))
+            for name, converter in self.converters:
+                fields[name] = converter(fields[name])
+
+            pk = row[0]
+            if self.pk_converter is not None:
+                pk = self.pk_converter(pk)
+
+            objects.append(dict(model=self.label, pk=pk, fields=fields))
+
+        if self.many_to_many and rows:
+            pks = [row[0] for row in rows]
+            for field, converter in self.many_to_many:
+                related = self._get_related(field, converter, pks, using)
+                for object_, pk in zip(objects, pks):
+                    object_['fields'][field.name] = related[pk]
+
+        return objects
+
+    def chunks(self, queryset, chunksize=1000):
+        '''
+        Serialize the queryset in chunks without creating model instances
+
+        The rows are fetched using keyset pagination if the ordering of the
+        queryset allows it, see
+        :py:func:`django_utils.queryset.queryset_iterator`.
+
+        :param queryset: The queryset to serialize
+        :param chunksize: The amount of rows to fetch at once
+        :return: An iterator of lists of dicts
+        '''
+        for rows in _get_queryset_chunks(queryset, chunksize, self.columns):
+            yield self.serialize_rows(rows, queryset.db)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.label}>'
+
+
+_serializers = {}
+
+
+def get_serializer(model, fields=None):
+    '''
+    Return the (cached) :py:class:`ModelSerializer` for the model and fields
+
+    :param model: The model to serialize
+    :param fields: The names of the fields to serialize, all serializable
+        fields if not given
+    '''
+    key = model, None if fields is None else frozenset(fields)
+    try:
+        return _serializers[key]
+    except KeyError:
+        serializer = _serializers[key] = ModelSerializer(model, fields)
+        return serializer
+
+
+def serialize(queryset, fields=None, chunksize=1000):
+    '''
+    Serialize the queryset to a list of dicts, identical to
+    `django.core.serializers.serialize('python', queryset, fields=fields)`
+
+    :param queryset: The queryset to serialize
+    :param fields: The names of the fields to serialize, all serializable
+        fields if not given
+    :param chunksize: The amount of rows to fetch at once
+    '''
+    serializer = get_serializer(queryset.model, fields)
+    objects = []
+    for chunk in serializer.chunks(queryset, chunksize):
+        objects += chunk
+
+    return objects
@@ -2,6 +2,8 @@ import json
 
 from django import http
 
+from . import json_backends
+
 
 def to_json(request, data):
     if request.GET.get('debug'):  # pragma: no cover
@@ -19,5 +21,5 @@ def to_json(request, data):
             return http.HttpResponse(response, content_type='text/plain')
     else:
         return http.HttpResponse(
-            json.dumps(data), content_type='application/json'
+            json_backends.dumps(data), content_type='application/json'
         )
@@ -1,10 +1,27 @@
+import calendar
+import collections
+import hashlib
+import inspect
 import json
+import uuid
 
+import django
+from asgiref import sync
 from django import http, urls
 from django.contrib.auth import decorators
+from django.core import cache as django_cache
 from django.core import serializers
 from django.db import models
 from django.template import loader as django_loader
+from django.utils import cache as cache_utils
+from django.utils import functional
+from django.utils import http as http_utils
+
+from . import json_backends
+from . import serializers as serializer_utils
+
+#: The amount of rows fetched at once when streaming querysets as JSON
+QUERYSET_CHUNKSIZE = 1000
 
 
 class ViewError(Exception):
@@ -45,19 +62,312 @@ REQUEST_PROPERTIES = {
 }
 
 
-def _prepare_request(request, app, view):
-    '''Add context and extra methods to the request'''
-    request.context = dict()
-    request.context['view'] = view
-    request.context['app'] = app
-    request.context['request'] = request
+def _is_ajax(request):
+    '''Check the `X-Requested-With` header and the `ajax` query parameter
+    and only fall back to the `ajax` POST parameter if the body is already
+    parsed or is a (small) urlencoded form'''
+    if request.META.get('HTTP_X_REQUESTED_WITH') == 'XMLHttpRequest':
+        return True
+    elif int(request.GET.get('ajax', 0)):
+        return True
+    elif request.stream_upload:
+        return False
+    elif hasattr(request, '_post') or request.content_type \
+            == 'application/x-www-form-urlencoded':
+        return bool(int(request.POST.get('ajax', 0)))
+    else:
+        return False
+
+
+_request_classes = {}
+
+
+def _get_request_class(class_, stream_upload=False):
+    '''Return the (cached) subclass of the request class which offers the
+    `REQUEST_PROPERTIES` as methods and `ajax` as lazy property'''
+    key = class_, stream_upload
+    try:
+        return _request_classes[key]
+    except KeyError:
+        attrs = {k: staticmethod(v) for k, v in REQUEST_PROPERTIES.items()}
+        attrs['__module__'] = class_.__module__
+        attrs['ajax'] = functional.cached_property(_is_ajax)
+        attrs['stream_upload'] = stream_upload
+        subclass = _request_classes[key] = type(
+            class_.__name__, (class_,), attrs)
+        return subclass
+
+
+#: The amount of cache hits and misses of a cached :py:func:`env` view
+CacheInfo = collections.namedtuple('CacheInfo', 'hits misses')
+
+#: The request methods of which the responses are cached
+CACHE_METHODS = {'GET', 'HEAD'}
+
+#: The `request.META` flags which Django sets when the CSRF token was used,
+#: `CSRF_COOKIE_USED` before and `CSRF_COOKIE_NEEDS_UPDATE` since Django 4.1
+CSRF_META_KEYS = 'CSRF_COOKIE_USED', 'CSRF_COOKIE_NEEDS_UPDATE'
+
 
-    for k, v in REQUEST_PROPERTIES.items():
-        setattr(request, k, v)
+#: The supported values for the `etag` argument of :py:func:`env`
+ETAGS = None, 'strong', 'weak'
 
+
+async def _acall(function, *args, **kwargs):
+    '''Call a sync or async callback from async code'''
+    if inspect.iscoroutinefunction(function):
+        return await function(*args, **kwargs)
+    else:
+        return await sync.sync_to_async(function)(*args, **kwargs)
+
+
+def _new_version():
+    return uuid.uuid4().hex
+
+
+class _View(object):
+    '''The information of an :py:func:`env` view which is computed once
+    when decorating instead of for every request'''
+
+    __slots__ = (
+        'function', 'name', 'app', 'template', 'response_class',
+        'stream_upload', 'cache_timeout', 'vary_on', 'cache', 'cache_prefix',
+        'hits', 'misses', 'etag', 'etag_func', 'last_modified_func',
+    )
+
+    def __init__(
+            self, function, response_class, stream_upload=False,
+            cache_timeout=None, vary_on=None, cache='default', etag=None,
+            etag_func=None, last_modified_func=None):
+        if etag not in ETAGS:
+            raise ValueError(
+                f'Unknown etag {etag!r}, choose from: {ETAGS!r}')
+
+        self.function = function
+        self.name = function.__name__
+        self.app = function.__module__.split('.')[0]
+        self.template = f'{self.app}/{self.name}.html'
+        self.response_class = response_class
+        self.stream_upload = stream_upload
+        self.cache_timeout = cache_timeout
+        self.vary_on = vary_on
+        self.cache = cache
+        self.cache_prefix = \
+            f'django_utils.env:{function.__module__}.{function.__qualname__}'
+        self.hits = 0
+        self.misses = 0
+        self.etag = etag
+        self.etag_func = etag_func
+        self.last_modified_func = last_modified_func
+
+    def _get_digest(self, request, args, kwargs):
+        '''Return the hash of everything the cached response depends on or
+        `None` if the response of the request can't be cached'''
+        if self.cache_timeout is None or request.method not in CACHE_METHODS \
+                or request.GET.get('debug'):
+            return None
+
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            user = user.pk
+        else:
+            user = None
+
+        if self.vary_on is None:
+            params = sorted(request.GET.lists())
+        else:
+            params = [request.GET.getlist(name) for name in self.vary_on]
+
+        parts = (
+            args,
+            sorted(kwargs.items()),
+            params,
+            request.GET.get('callback'),
+            user,
+            request.ajax,
+        )
+        return hashlib.md5(repr(parts).encode()).hexdigest()
+
+    def get_cache_key(self, request, args, kwargs):
+        '''Return the cache key of the request or `None` if the response
+        can't be cached'''
+        digest = self._get_digest(request, args, kwargs)
+        if digest is not None:
+            version = django_cache.caches[self.cache].get_or_set(
+                f'{self.cache_prefix}:version', _new_version, None)
+            return f'{self.cache_prefix}:{version}:{digest}'
+
+    async def aget_cache_key(self, request, args, kwargs):
+        digest = self._get_digest(request, args, kwargs)
+        if digest is not None:
+            version = await django_cache.caches[self.cache].aget_or_set(
+                f'{self.cache_prefix}:version', _new_version, None)
+            return f'{self.cache_prefix}:{version}:{digest}'
+
+    def load(self, cached):
+        '''Return the response for the cached value (if any) and count the
+        cache hits and misses'''
+        if cached is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            content, content_type = cached
+            return self.response_class(content, content_type=content_type)
+
+    @staticmethod
+    def dump(request, result, response):
+        '''Return the value to cache for the processed response of the view
+        or `None` if the response can't be cached
+
+        Responses which used the CSRF token (i.e. `{% csrf_token %}`) or the
+        session are specific to the visitor and are never cached.
+        '''
+        if any(request.META.get(key) for key in CSRF_META_KEYS):
+            return None
+
+        session = getattr(request, 'session', None)
+        if session is not None and session.accessed:
+            return None
+
+        if (result is None or isinstance(result, (dict, list, str))) \
+                and not response.streaming and response.status_code == 200:
+            return response.content, response['Content-Type']
+
+    @staticmethod
+    def _get_validators(etag, last_modified):
+        if etag is not None:
+            etag = cache_utils.quote_etag(etag)
+
+        if last_modified is not None:
+            last_modified = calendar.timegm(last_modified.utctimetuple())
+
+        return etag, last_modified
+
+    def get_validators(self, request, args, kwargs):
+        '''Return the (quoted) ETag and the last modified timestamp of the
+        `etag_func` and `last_modified_func` callbacks'''
+        etag = last_modified = None
+        if self.etag_func is not None:
+            etag = self.etag_func(request, *args, **kwargs)
+
+        if self.last_modified_func is not None:
+            last_modified = self.last_modified_func(request, *args, **kwargs)
+
+        return self._get_validators(etag, last_modified)
+
+    async def aget_validators(self, request, args, kwargs):
+        etag = last_modified = None
+        if self.etag_func is not None:
+            etag = await _acall(self.etag_func, request, *args, **kwargs)
+
+        if self.last_modified_func is not None:
+            last_modified = await _acall(
+                self.last_modified_func, request, *args, **kwargs)
+
+        return self._get_validators(etag, last_modified)
+
+    def set_validators(self, request, response, etag, last_modified):
+        '''Add the ETag and Last-Modified headers to successful GET and
+        HEAD responses and return 304 Not Modified if the validators of the
+        request match'''
+        if self.etag is None and etag is None and last_modified is None:
+            return response
+        elif request.method not in CACHE_METHODS \
+                or response.status_code != 200:
+            return response
+
+        if response.has_header('ETag'):
+            # The ETag of the view itself takes precedence
+            etag = response['ETag']
+        elif etag is None and self.etag is not None \
+                and not response.streaming:
+            etag = f'"{hashlib.md5(response.content).hexdigest()}"'
+            if self.etag == 'weak':
+                etag = f'W/{etag}'
+
+        if etag is not None:
+            response['ETag'] = etag
+
+        if last_modified is not None \
+                and not response.has_header('Last-Modified'):
+            response['Last-Modified'] = http_utils.http_date(last_modified)
+
+        return cache_utils.get_conditional_response(
+            request, etag=etag, last_modified=last_modified,
+            response=response)
+
+    def invalidate_cache(self):
+        '''Invalidate all cached responses of the view'''
+        django_cache.caches[self.cache].set(
+            f'{self.cache_prefix}:version', _new_version(), None)
+
+    def cache_info(self):
+        '''Return the cache hits and misses of the view in this process'''
+        return CacheInfo(self.hits, self.misses)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.app}.{self.name}>'
+
+
+def _prepare_request(request, view):
+    '''Add context and extra methods to the request
+
+    The methods are offered by a subclass of the request class so they don't
+    have to be added to (and removed from) every request'''
+    request.context = {
+        'view': view.name,
+        'app': view.app,
+        'request': request,
+    }
+    request.template = view.template
+    request.__class__ = _get_request_class(
+        request.__class__, view.stream_upload)
     return request
 
 
+def _stream_queryset(queryset, callback=None):
+    '''Yield the queryset as JSON array, chunk by chunk
+
+    Model rows are written in the format of the Django JSON serializer using
+    the compiled serializers of :py:mod:`django_utils.serializers`, the rows
+    of `values()` and `values_list()` querysets as they are.
+    '''
+    if issubclass(queryset._iterable_class, models.query.ModelIterable):
+        chunks = serializer_utils.get_serializer(queryset.model).chunks(
+            queryset, QUERYSET_CHUNKSIZE)
+    else:
+        chunks = serializer_utils._get_queryset_chunks(
+            queryset, QUERYSET_CHUNKSIZE)
+
+    if callback:
+        yield f'{callback}(['
+    else:
+        yield '['
+
+    separator = ''
+    for rows in chunks:
+        yield separator + ','.join(json_backends.dumps(row) for row in rows)
+        separator = ','
+
+    if callback:
+        yield '])'
+    else:
+        yield ']'
+
+
+async def _astream_queryset(queryset, callback=None):
+    '''Async version of :py:func:`_stream_queryset`, the chunks are fetched
+    in a thread since the database access is synchronous'''
+    chunks = _stream_queryset(queryset, callback)
+    next_ = sync.sync_to_async(next)
+    while True:
+        chunk = await next_(chunks, None)
+        if chunk is None:
+            return
+
+        yield chunk
+
+
 def _process_response(request, response, response_class):
     '''Generic response processing function, always returns HttpResponse'''
 
@@ -65,7 +375,14 @@ def _process_response(request, response, response_class):
     if isinstance(response, (dict, list, models.query.QuerySet)):
         if request.ajax:
             if isinstance(response, models.query.QuerySet):
-                output = serializers.serialize('json', response)
+                if not request.GET.get('debug'):
+                    return http.StreamingHttpResponse(
+                        _stream_queryset(
+                            response, request.GET.get('callback')),
+                        content_type='text/plain',
+                    )
+
+                output = serializers.serialize('json', response, indent=4)
             elif request.GET.get('debug'):
                 from django.core.serializers import json as django_json
                 output = json.dumps(
@@ -76,7 +393,7 @@ def _process_response(request, response, response_class):
                     default=json_default_handler,
                 )
             else:
-                output = json.dumps(response, default=json_default_handler)
+                output = json_backends.dumps(response)
 
             callback = request.GET.get('callback', False)
             if callback:
@@ -140,58 +457,193 @@ def _process_response(request, response, response_class):
         )
 
 
-def env(function=None, login_required=False, response_class=http.HttpResponse):
+async def _aprocess_response(request, response, response_class):
+    '''Async version of :py:func:`_process_response`
+
+    Serialized and plain responses are processed in the event loop, only
+    template rendering and querysets (which can touch the database) are
+    processed in a thread'''
+    if isinstance(response, models.query.QuerySet):
+        if request.ajax and not request.GET.get('debug'):
+            callback = request.GET.get('callback')
+            if django.VERSION >= (4, 2):
+                return http.StreamingHttpResponse(
+                    _astream_queryset(response, callback),
+                    content_type='text/plain',
+                )
+            else:  # pragma: no cover
+                # Async iterators can only be streamed since Django 4.2
+                output = await sync.sync_to_async(list)(
+                    _stream_queryset(response, callback))
+                return response_class(
+                    ''.join(output), content_type='text/plain')
+    elif response is not None and (
+            request.ajax or not isinstance(response, (dict, list))):
+        return _process_response(request, response, response_class)
+
+    return await sync.sync_to_async(_process_response)(
+        request, response, response_class)
+
+
+def env(
+        function=None, login_required=False, response_class=http.HttpResponse,
+        stream_upload=False, cache_timeout=None, vary_on=None,
+        cache='default', etag=None, etag_func=None, last_modified_func=None):
     '''
     View decorator that automatically adds context and renders response
 
     Keyword arguments:
     login_required -- is everyone allowed or only authenticated users
+    stream_upload -- never read the request body to detect ajax requests so
+        the view can stream the (upload) body using request.read()
+    cache_timeout -- cache the rendered responses of GET and HEAD requests
+        for this amount of seconds, None to disable caching
+    vary_on -- the GET parameters the response depends on, all parameters
+        if not given
+    cache -- the alias of the cache to use
+    etag -- add a 'strong' or 'weak' ETag computed from the rendered
+        response and return 304 Not Modified if it matches If-None-Match
+    etag_func -- function(request, *args, **kwargs) returning the ETag,
+        evaluated before the view
+    last_modified_func -- function(request, *args, **kwargs) returning the
+        last modified datetime, evaluated before the view
+
+    If etag_func or last_modified_func is given and the validators of the
+    request match, the view is not called at all and 304 Not Modified (or
+    412 Precondition Failed) is returned. The callbacks can be coroutine
+    functions for async views
+
+    Cached responses are stored per view arguments, GET parameters, user (or
+    anonymous) and ajax flag. Only the responses env renders itself (from
+    dicts, lists, strings and templates) are cached. The cached views offer
+    invalidate_cache() to invalidate all cached responses (by changing the
+    cache version of the view) and cache_info() to get the cache hits and
+    misses in this process
+
+    Ajax requests are detected lazily (request.ajax) from the
+    X-Requested-With header or the ajax GET parameter. The ajax POST
+    parameter is only used for urlencoded forms or if the view already
+    parsed request.POST so uploads are never parsed by the decorator
 
     Adds a RequestContext (request.context) with the following context items:
     name -- current function name
 
     Stores the template in request.template and assumes it to be in
     <app>/<view>.html
+
+    Within the view the REQUEST_PROPERTIES are available as methods of the
+    request (i.e. request.redirect('/'))
+
+    Querysets returned to ajax requests are streamed as JSON array in chunks
+    of QUERYSET_CHUNKSIZE rows so the memory usage doesn't depend on the
+    size of the result
+
+    Coroutine functions get an async wrapper with the same return
+    conventions, templates are rendered in a thread so the event loop isn't
+    blocked
     '''
 
     def _env(request, *args, **kwargs):
-        request.ajax = bool(
-            max(
-                request.headers.get('x-requested-with') == 'XMLHttpRequest',
-                int(request.POST.get('ajax', 0)),
-                int(request.GET.get('ajax', 0)),
-            )
-        )
-        request.context = None
+        class_ = request.__class__
         try:
-            name = function.__name__
-            app = function.__module__.split('.')[0]
-            request = _prepare_request(request, app, name)
-            request.template = f'{app}/{name}.html'
-            response = function(request, *args, **kwargs)
-            response = _process_response(request, response, response_class)
-            return response  # pragma: no branch
+            request = _prepare_request(request, view)
+            etag, last_modified = view.get_validators(request, args, kwargs)
+            if etag is not None or last_modified is not None:
+                response = cache_utils.get_conditional_response(
+                    request, etag=etag, last_modified=last_modified)
+                if response is not None:
+                    return response
+
+            key = view.get_cache_key(request, args, kwargs)
+            response = None
+            if key is not None:
+                cache = django_cache.caches[view.cache]
+                response = view.load(cache.get(key))
+
+            if response is None:
+                result = function(request, *args, **kwargs)
+                response = _process_response(request, result, response_class)
+                if key is not None:
+                    cached = view.dump(request, result, response)
+                    if cached is not None:
+                        cache.set(key, cached, view.cache_timeout)
+
+            return view.set_validators(
+                request, response, etag, last_modified)
+        finally:
+            # Remove the context reference from the request to prevent
+            # leaking and restore the original class
+            request.__class__ = class_
+            request.__dict__.pop('context', None)
+            request.__dict__.pop('template', None)
+
+    async def _aenv(request, *args, **kwargs):
+        class_ = request.__class__
+        try:
+            request = _prepare_request(request, view)
+            etag, last_modified = await view.aget_validators(
+                request, args, kwargs)
+            if etag is not None or last_modified is not None:
+                response = cache_utils.get_conditional_response(
+                    request, etag=etag, last_modified=last_modified)
+                if response is not None:
+                    return response
+
+            key = await view.aget_cache_key(request, args, kwargs)
+            response = None
+            if key is not None:
+                cache = django_cache.caches[view.cache]
+                response = view.load(await cache.aget(key))
+
+            if response is None:
+                result = await function(request, *args, **kwargs)
+                response = await _aprocess_response(
+                    request, result, response_class)
+                if key is not None:
+                    cached = view.dump(request, result, response)
+                    if cached is not None:
+                        await cache.aset(key, cached, view.cache_timeout)
+
+            return view.set_validators(
+                request, response, etag, last_modified)
         finally:
-            '''Remove the context reference from request to prevent leaking'''
-            try:
-                del request.context, request.template
-                for k in REQUEST_PROPERTIES.keys():  # pragma: no branch
-                    delattr(request, k)
-            except AttributeError:
-                pass  # pragma: no branch
+            request.__class__ = class_
+            request.__dict__.pop('context', None)
+            request.__dict__.pop('template', None)
 
     if function:
-        _env.__name__ = function.__name__
-        _env.__doc__ = function.__doc__
-        _env.__module__ = function.__module__
-        _env.__dict__ = function.__dict__
+        view = _View(
+            function, response_class, stream_upload, cache_timeout, vary_on,
+            cache, etag, etag_func, last_modified_func)
+        if not inspect.iscoroutinefunction(function):
+            wrapper = _env
+        elif login_required and django.VERSION < (5, 1):  # pragma: no cover
+            raise ViewError(
+                '`login_required` for async views requires Django 5.1')
+        elif cache_timeout is not None \
+                and django.VERSION < (4, 0):  # pragma: no cover
+            raise ViewError(
+                '`cache_timeout` for async views requires Django 4.0')
+        else:
+            wrapper = _aenv
+
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        wrapper.__module__ = function.__module__
+        wrapper.__dict__ = function.__dict__
+        if cache_timeout is not None:
+            wrapper.invalidate_cache = view.invalidate_cache
+            wrapper.cache_info = view.cache_info
 
         if login_required:
-            return decorators.login_required(_env)
+            return decorators.login_required(wrapper)
         else:
-            return _env
+            return wrapper
     else:
         def inner(function):
-            return env(function, login_required, response_class)
+            return env(
+                function, login_required, response_class, stream_upload,
+                cache_timeout, vary_on, cache, etag, etag_func,
+                last_modified_func)
 
         return inner
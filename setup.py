@@ -41,7 +41,10 @@ if __name__ == '__main__':
                 'pytest-cov',
                 'pytest-django',
                 'jinja2',
+                'numpy',
+                'orjson',
                 'pygments',
+                'ujson',
             ],
         },
         long_description=long_description,
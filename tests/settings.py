@@ -22,7 +22,12 @@ DATABASES = {
         # localhost through TCP.
         'HOST': '',
         'PORT': '',                      # Set to empty string for default.
-    }
+    },
+    # Used to test the iteration over multiple databases
+    'other': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'other.sqlite3',
+    },
 }
 
 # Hosts/domain names that are valid for this site; required if DEBUG is False
@@ -1,10 +1,15 @@
+import uuid
+
 from django.db import models
-from django_utils import base_models
+from django_utils import base_models, fields
 
 
 class Spam(base_models.SlugCreatedAtModelBase):
     a = models.CharField(max_length=50)
 
+    class Meta:
+        indexes = [base_models.updated_at_index('spam_updated_at')]
+
 
 class Eggs(Spam):
     b = models.CharField(max_length=100)
@@ -12,3 +17,68 @@ class Eggs(Spam):
 
 class RecursionTest(models.Model):
     parent = models.ForeignKey(Spam, on_delete=models.CASCADE)
+
+
+class KeysetTest(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    tenant = models.IntegerField()
+    value = models.IntegerField(blank=True, null=True)
+    name = models.CharField(max_length=50)
+    data = models.JSONField(blank=True, default=dict)
+
+
+class NamedKeysetTest(models.Model):
+    name = models.CharField(max_length=50, primary_key=True)
+    parent = models.ForeignKey(
+        KeysetTest, blank=True, null=True, on_delete=models.CASCADE)
+
+
+class TreeNode(models.Model):
+    name = models.CharField(max_length=50)
+    currency = models.CharField(max_length=3, blank=True, null=True)
+    parent = models.ForeignKey(
+        'self', blank=True, null=True, on_delete=models.CASCADE,
+        related_name='children')
+    path = models.CharField(
+        max_length=255, blank=True, default='', db_index=True)
+
+    get_currency = fields.RecursiveField()
+    get_currency_cte = fields.RecursiveField(
+        'currency', strategy='cte', default='USD')
+    get_name_cte = fields.RecursiveField('name', strategy='cte')
+    get_label_cte = fields.RecursiveField('label', strategy='cte')
+    get_currency_cached = fields.RecursiveField('currency', cache=True)
+    get_currency_path = fields.RecursiveField(
+        'currency', strategy='path', path_field='path')
+    get_name_path = fields.RecursiveField(
+        'name', strategy='path', path_field='path')
+
+    @property
+    def label(self):
+        return self.name.upper() if self.currency else None
+
+
+class UUIDTreeNode(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    currency = models.CharField(max_length=3, blank=True, null=True)
+    parent = models.ForeignKey(
+        'self', blank=True, null=True, on_delete=models.CASCADE)
+
+    get_currency_cte = fields.RecursiveField('currency', strategy='cte')
+
+
+class ProxyTreeNode(TreeNode):
+    class Meta:
+        proxy = True
+
+
+class SerializerTest(models.Model):
+    keysets = models.ManyToManyField(KeysetTest, blank=True)
+    nodes = models.ManyToManyField(
+        TreeNode, blank=True, through='SerializerNode')
+
+
+class SerializerNode(models.Model):
+    serializer_test = models.ForeignKey(
+        SerializerTest, on_delete=models.CASCADE)
+    node = models.ForeignKey(TreeNode, on_delete=models.CASCADE)
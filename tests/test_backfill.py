@@ -0,0 +1,141 @@
+import decimal
+
+import pytest
+from django.core import management
+
+from django_utils import backfill
+
+
+@pytest.fixture
+def spams():
+    from tests.test_app import models
+
+    return [
+        models.Spam.objects.create(name=f'spam {i}', a=str(i % 3))
+        for i in range(10)
+    ]
+
+
+def uppercase_names(rows):
+    from tests.test_app import models
+
+    for row in rows:
+        row.name = row.name.upper()
+
+    models.Spam.objects.bulk_update(rows, ['name'])
+
+
+def _count_upper():
+    from tests.test_app import models
+
+    names = models.Spam.objects.values_list('name', flat=True)
+    return sum(name.isupper() for name in names)
+
+
+class _Interrupt(Exception):
+    pass
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('checkpoint', [
+    lambda tmp_path: backfill.FileCheckpoint(str(tmp_path / 'spam.json')),
+    lambda tmp_path: backfill.CacheCheckpoint('spam-backfill'),
+])
+def test_backfill_resume(tmp_path, spams, checkpoint):
+    from tests.test_app import models
+
+    checkpoint = checkpoint(tmp_path)
+    processed = []
+
+    def update(rows):
+        if len(processed) == 2:
+            # Simulate a killed process, the chunk is rolled back
+            uppercase_names(rows)
+            raise _Interrupt()
+
+        processed.append([row.pk for row in rows])
+        uppercase_names(rows)
+
+    with pytest.raises(_Interrupt):
+        backfill.backfill(
+            models.Spam.objects.all(), update, chunksize=3,
+            checkpoint=checkpoint)
+
+    assert checkpoint.load() == [spams[5].pk]
+    assert _count_upper() == 6
+    assert repr(checkpoint)
+
+    processed.append(None)
+    rows = backfill.backfill(
+        models.Spam.objects.all(), update, chunksize=3,
+        checkpoint=checkpoint)
+    assert rows == 4
+    assert processed[3] == [spam.pk for spam in spams[6:9]]
+    assert _count_upper() == 10
+    assert checkpoint.load() is None
+    # Clearing a missing checkpoint is a no-op
+    checkpoint.clear()
+
+
+@pytest.mark.django_db()
+def test_backfill_rate_limit(spams):
+    from tests.test_app import models
+
+    sleeps = []
+    rows = backfill.backfill(
+        models.Spam.objects.order_by('-a'), uppercase_names,
+        rows_per_second=10, chunksize=4, atomic=False, sleep=sleeps.append)
+    assert rows == len(spams)
+    assert len(sleeps) == 3
+    assert all(0 < sleep <= 0.4 for sleep in sleeps)
+
+    # Fast enough limits never sleep
+    backfill.backfill(
+        models.Spam.objects.all(), uppercase_names, rows_per_second=1e9,
+        sleep=sleeps.append)
+    assert len(sleeps) == 3
+
+
+@pytest.mark.django_db()
+def test_backfill_command(tmp_path, spams):
+    path = tmp_path / 'checkpoint.json'
+    backfill.FileCheckpoint(str(path)).save([spams[4].pk])
+    management.call_command(
+        'backfill', 'test_app.Spam', 'tests.test_backfill.uppercase_names',
+        checkpoint=str(path), chunksize=3, verbosity=0)
+    assert _count_upper() == 5
+    assert not path.exists()
+
+    backfill.CacheCheckpoint('spam').save([spams[4].pk])
+    management.call_command(
+        'backfill', 'test_app.Spam', 'tests.test_backfill.uppercase_names',
+        cache_key='spam', restart=True, no_atomic=True, rate=1e9,
+        order_by=['-pk'], verbosity=0)
+    assert _count_upper() == 10
+
+    management.call_command(
+        'backfill', 'test_app.Spam', 'tests.test_backfill.uppercase_names',
+        verbosity=0)
+
+
+@pytest.mark.django_db()
+def test_file_checkpoint_microseconds(tmp_path, spams):
+    from tests.test_app import models
+
+    checkpoint = backfill.FileCheckpoint(str(tmp_path / 'spam.json'))
+    updated_at = spams[4].updated_at.replace(microsecond=123456)
+    models.Spam.objects.filter(pk=spams[4].pk).update(updated_at=updated_at)
+    models.Spam.objects.filter(pk=spams[5].pk).update(
+        updated_at=updated_at.replace(microsecond=123999))
+
+    checkpoint.save([decimal.Decimal('1.50'), updated_at.time()])
+    assert checkpoint.load() == ['1.50', updated_at.time().isoformat()]
+    checkpoint.save([updated_at, spams[4].pk])
+    assert checkpoint.load() == [updated_at.isoformat(), spams[4].pk]
+
+    # The row within the same millisecond is not processed again
+    processed = []
+    backfill.backfill(
+        models.Spam.objects.filter(pk__in=[spams[4].pk, spams[5].pk])
+        .order_by('updated_at'), processed.extend, checkpoint=checkpoint)
+    assert processed == [spams[5]]
@@ -34,3 +34,14 @@ class ModelBaseProxyTest(ModelBaseTest):
     class Meta:
         proxy = True
         app_label = 'tests'
+
+
+def test_updated_at_index():
+    index = base_models.updated_at_index('spam_updated_at')
+    assert index.fields == ['updated_at', 'id']
+    assert index.name == 'spam_updated_at'
+
+    index = base_models.updated_at_index(
+        'spam_changed_at', field='changed_at', pk='uuid')
+    assert index.fields == ['changed_at', 'uuid']
+    assert index.name == 'spam_changed_at'
@@ -0,0 +1,173 @@
+import csv
+import datetime
+import gzip
+import io
+import json
+
+import pytest
+from django.core import management
+
+from django_utils import exporters
+
+
+@pytest.fixture
+def spams():
+    from tests.test_app import models
+
+    return [
+        models.Spam.objects.create(name=f'spam, "{i}"', a=str(i % 3))
+        for i in range(10)
+    ]
+
+
+def _read_csv(data):
+    return list(csv.reader(io.StringIO(data.decode())))
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('chunksize', [3, 1000])
+def test_export_csv(spams, chunksize):
+    from tests.test_app import models
+
+    queryset = models.Spam.objects.order_by('-a')
+    chunks = list(exporters.export_iterator(
+        queryset, fields=['name', 'a'], chunksize=chunksize))
+    assert len(chunks) == (4 if chunksize == 3 else 1)
+
+    rows = _read_csv(b''.join(chunks))
+    assert rows[0] == ['name', 'a']
+    assert rows[1:] == [
+        [name, a] for name, a in queryset.order_by('-a', 'pk').values_list(
+            'name', 'a')]
+
+
+@pytest.mark.django_db()
+def test_export_csv_empty():
+    from tests.test_app import models
+
+    queryset = models.Spam.objects.all()
+    assert _read_csv(b''.join(exporters.export_iterator(queryset))) == [[
+        'id', 'updated_at', 'created_at', 'name', 'slug', 'a']]
+    assert not b''.join(exporters.export_iterator(queryset, header=False))
+
+
+@pytest.mark.django_db()
+def test_export_jsonl(spams):
+    from tests.test_app import models
+
+    data = b''.join(exporters.export_iterator(
+        models.Spam.objects.all(), format='jsonl', compress=True))
+    rows = [json.loads(line) for line in gzip.decompress(data).splitlines()]
+    assert len(rows) == len(spams)
+    assert rows[0]['id'] == spams[0].pk
+    assert rows[0]['created_at'].startswith(str(spams[0].created_at.year))
+
+
+@pytest.mark.django_db()
+def test_export_jsonl_microseconds(spams):
+    from tests.test_app import models
+
+    created_at = datetime.datetime(
+        2020, 1, 2, 3, 4, 5, 123456, tzinfo=datetime.timezone.utc)
+    models.Spam.objects.update(created_at=created_at)
+
+    data = b''.join(exporters.export_iterator(
+        models.Spam.objects.all(), fields=['created_at'], format='jsonl'))
+    rows = [json.loads(line) for line in data.splitlines()]
+    assert {
+        datetime.datetime.fromisoformat(row['created_at']) for row in rows
+    } == {created_at}
+
+
+@pytest.mark.django_db()
+def test_export_union(spams):
+    from tests.test_app import models
+
+    queryset = models.Spam.objects.filter(a='0').union(
+        models.Spam.objects.filter(a='1')).order_by('-name')
+    data = b''.join(exporters.export_iterator(
+        queryset, fields=['name'], header=False, chunksize=3))
+    assert _read_csv(data) == [[spam.name] for spam in queryset]
+
+
+@pytest.mark.django_db()
+def test_export_queryset(tmp_path, spams):
+    from tests.test_app import models
+
+    queryset = models.Spam.objects.all()
+    path = tmp_path / 'spam.csv.gz'
+    written = exporters.export_queryset(
+        queryset, path, fields=['pk'], compress=True)
+    assert written == path.stat().st_size
+    assert _read_csv(gzip.decompress(path.read_bytes()))[1] == [
+        str(spams[0].pk)]
+
+    output = io.StringIO()
+    exporters.export_queryset(queryset, output, format='jsonl')
+    assert len(output.getvalue().splitlines()) == len(spams)
+
+    output = io.TextIOWrapper(io.BytesIO())
+    exporters.export_queryset(queryset, output, compress=True)
+    assert gzip.decompress(output.buffer.getvalue())
+
+
+@pytest.mark.django_db()
+def test_export_response(spams):
+    from tests.test_app import models
+
+    response = exporters.export_response(
+        models.Spam.objects.all(), filename='spam.jsonl', format='jsonl',
+        compress=True)
+    assert response['Content-Encoding'] == 'gzip'
+    assert 'spam.jsonl' in response['Content-Disposition']
+    assert response['Content-Type'].startswith('application/jsonl')
+    data = gzip.decompress(b''.join(response.streaming_content))
+    assert len(data.splitlines()) == len(spams)
+
+    response = exporters.export_response(models.Spam.objects.all())
+    assert len(_read_csv(b''.join(response.streaming_content))) == 11
+
+
+def test_export_invalid_format():
+    from tests.test_app import models
+
+    with pytest.raises(ValueError):
+        exporters.export_iterator(models.Spam.objects.all(), format='xml')
+
+    with pytest.raises(ValueError):
+        exporters.export_response(models.Spam.objects.all(), format='xml')
+
+
+@pytest.mark.django_db()
+def test_export_command(tmp_path, spams):
+    stdout = io.StringIO()
+    management.call_command(
+        'export', 'test_app.Spam', fields=['pk', 'name'], stdout=stdout,
+        order_by=['-pk'], verbosity=0)
+    rows = _read_csv(stdout.getvalue().encode())
+    assert rows[1][0] == str(spams[-1].pk)
+
+    path = tmp_path / 'spam.jsonl.gz'
+    management.call_command(
+        'export', 'test_app.Spam', output=str(path), gzip=True,
+        format='jsonl', no_header=True, chunksize=3, verbosity=0)
+    assert len(gzip.decompress(path.read_bytes()).splitlines()) == len(spams)
+
+
+@pytest.mark.django_db()
+def test_export_command_gzip_stdout(monkeypatch, spams):
+    # The stdout of the caller is used, not `sys.stdout`
+    monkeypatch.setattr('sys.stdout', io.StringIO())
+    output = io.TextIOWrapper(io.BytesIO())
+    management.call_command('export', 'test_app.Spam', gzip=True,
+                            stdout=output, verbosity=0)
+    assert len(_read_csv(gzip.decompress(output.buffer.getvalue()))) == 11
+
+    output = io.BytesIO()
+    management.call_command('export', 'test_app.Spam', gzip=True,
+                            stdout=output, verbosity=0)
+    assert gzip.decompress(output.getvalue())
+
+    with pytest.raises(management.CommandError):
+        management.call_command('export', 'test_app.Spam', gzip=True,
+                                stdout=io.StringIO(), verbosity=0)
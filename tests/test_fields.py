@@ -1,9 +1,17 @@
-from django.db import models
+import logging
+
+import pytest
+from django.core import management
+from django.db import connection, models, transaction
+from django.db.models import functions, F
+from django.test.utils import CaptureQueriesContext
+
 from django_utils import fields
 
 
 class A(models.Model):
     some_attribute = models.CharField(max_length=100, blank=True, null=True)
+    created_at = models.DateTimeField(blank=True, null=True)
 
     class Meta:
         app_label = 'tests'
@@ -11,6 +19,7 @@ class A(models.Model):
 
 class B(models.Model):
     some_attribute = models.CharField(max_length=100, blank=True, null=True)
+    created_at = models.DateTimeField(blank=True, null=True)
     parent = models.ForeignKey(A, on_delete=models.CASCADE)
 
     # By default the fieldname is assumed to be `get_<field_name>`
@@ -23,6 +32,8 @@ class B(models.Model):
     get_some_attribute_with_defaults = fields.RecursiveField(
         field_name='some_attribute', default='some default value')
 
+    get_created_at = fields.RecursiveField()
+
     class Meta:
         app_label = 'tests'
 
@@ -44,3 +55,468 @@ def test_recursive_field():
     assert e.get_some_attribute() is None
     assert e.some_attribute_with_other_name() is None
     assert e.get_some_attribute_with_defaults() == 'some default value'
+
+
+@pytest.fixture
+def tree():
+    from tests.test_app import models
+
+    root = models.TreeNode.objects.create(name='root', currency='EUR')
+    nodes = [root]
+    for i in range(8):
+        nodes.append(models.TreeNode.objects.create(
+            name=f'node {i}', parent=nodes[-1]))
+
+    return nodes
+
+
+def _reload(node):
+    return node.__class__.objects.get(pk=node.pk)
+
+
+@pytest.mark.django_db()
+def test_recursive_field_cte(tree):
+    leaf = _reload(tree[-1])
+    with CaptureQueriesContext(connection) as queries:
+        assert leaf.get_currency_cte() == 'EUR'
+    assert len(queries) == 1
+
+    # The parents are cached now
+    with CaptureQueriesContext(connection) as queries:
+        assert leaf.get_currency() == 'EUR'
+        assert leaf.parent.parent.name == 'node 5'
+    assert len(queries) == 0
+
+    # Without the CTE every parent is a query
+    leaf = _reload(tree[-1])
+    with CaptureQueriesContext(connection) as queries:
+        assert leaf.get_currency() == 'EUR'
+    assert len(queries) == len(tree) - 1
+
+
+@pytest.mark.django_db()
+def test_recursive_field_cte_partial(tree):
+    from tests.test_app import models
+
+    # The empty string is not null so the query stops there, the chain is
+    # continued with a second query
+    models.TreeNode.objects.filter(pk=tree[4].pk).update(currency='')
+    leaf = _reload(tree[-1])
+    with CaptureQueriesContext(connection) as queries:
+        assert leaf.get_currency_cte() == 'EUR'
+    assert len(queries) == 2
+
+    # Only the uncached part of the chain is fetched
+    tree[5].currency = 'GBP'
+    tree[5].save()
+    leaf = _reload(tree[-1])
+    leaf.parent = _reload(tree[-2])
+    with CaptureQueriesContext(connection) as queries:
+        assert leaf.get_currency_cte() == 'GBP'
+        assert leaf.parent.parent.parent.currency == 'GBP'
+    assert len(queries) == 1
+
+    # Values which are not database columns fetch the entire chain
+    leaf = _reload(tree[-1])
+    with CaptureQueriesContext(connection) as queries:
+        assert leaf.get_label_cte() == 'NODE 4'
+        # The parent of the fixture is cached already
+        assert tree[1].get_label_cte() == 'ROOT'
+    assert len(queries) == 1
+
+    # The default is used for empty chains
+    root = models.TreeNode.objects.create(name='')
+    node = models.TreeNode.objects.create(name='', parent=root)
+    assert _reload(node).get_currency_cte() == 'USD'
+    assert _reload(node).get_name_cte() == ''
+    assert models.TreeNode(name='x').get_currency_cte() == 'USD'
+    node = models.TreeNode(name='x', parent=None)
+    assert node.get_currency_cte() == 'USD'
+
+
+def test_recursive_field_fallback():
+    a = A(some_attribute='a')
+    b = B(parent=a)
+    assert fields.RecursiveField(
+        'some_attribute', strategy='cte').get(b) == 'a'
+    assert fields.RecursiveField(
+        'some_attribute', strategy='cte', default=1).get(None) == 1
+
+    with pytest.raises(ValueError):
+        fields.RecursiveField(strategy='spam')
+
+
+@pytest.fixture
+def forest():
+    from tests.test_app import models
+
+    roots = [
+        models.TreeNode.objects.create(name='eur', currency='EUR'),
+        models.TreeNode.objects.create(name='none'),
+    ]
+    leaves = []
+    for root in roots:
+        for i in range(3):
+            branch = models.TreeNode.objects.create(
+                name=f'{root.name} {i}', parent=root,
+                currency='GBP' if i == 2 else None)
+            for j in range(4):
+                leaves.append(models.TreeNode.objects.create(
+                    name=f'{branch.name} {j}', parent=branch))
+
+    return leaves
+
+
+@pytest.mark.django_db()
+def test_recursive_field_resolve_many(forest):
+    from tests.test_app import models
+
+    leaves = list(models.TreeNode.objects.filter(pk__in=[
+        leaf.pk for leaf in forest]).order_by('pk'))
+    # A query per level, regardless of the amount of leaves
+    with CaptureQueriesContext(connection) as queries:
+        values = models.TreeNode.get_currency.resolve_many(leaves + [None])
+    assert len(queries) == 2
+    assert values == ['EUR'] * 8 + ['GBP'] * 4 + [None] * 8 + ['GBP'] * 4 + [
+        None]
+
+    # The parents are shared between siblings
+    assert leaves[0].parent is leaves[1].parent
+    assert leaves[0].parent.parent is leaves[4].parent.parent
+
+    # Everything is cached now
+    with CaptureQueriesContext(connection) as queries:
+        assert models.TreeNode.get_currency_cte.resolve_many(leaves)[-9] == (
+            'USD')
+        assert models.TreeNode.get_currency(leaves[0]) == 'EUR'
+    assert len(queries) == 0
+
+    # Missing parents
+    node = models.TreeNode(name='orphan', parent_id=-1)
+    assert models.TreeNode.get_currency.resolve_many([node]) == [None]
+
+
+@pytest.mark.django_db()
+def test_recursive_field_annotate(forest):
+    from tests.test_app import models
+
+    queryset = models.TreeNode.get_currency_cte.annotate(
+        models.TreeNode.objects.order_by('pk'))
+    with CaptureQueriesContext(connection) as queries:
+        nodes = list(queryset)
+    assert len(queries) == 3
+    assert nodes[0].inherited_currency == 'EUR'
+    assert nodes[-1].inherited_currency == 'GBP'
+    assert nodes[-6].inherited_currency == 'USD'
+
+    nodes = list(models.TreeNode.get_currency.annotate(
+        models.TreeNode.objects.order_by('pk'), 'currency_',
+    ).iterator(chunk_size=5))
+    assert len(nodes) == len(forest) + 8
+    assert nodes[-6].currency_ is None
+
+
+def test_recursive_field_resolve_many_fallback():
+    a = A(some_attribute='a')
+    b = B(parent=a)
+    assert B.get_some_attribute_with_defaults.resolve_many([a, b]) == [
+        'a', 'a']
+    assert B.get_some_attribute(b) == 'a'
+    assert B.get_some_attribute() is None
+
+
+@pytest.mark.django_db()
+def test_recursive_field_cache(tree):
+    from tests.test_app import models
+
+    field = models.TreeNode.get_currency_cached
+    field.clear_cache()
+    leaf = _reload(tree[-1])
+    assert leaf.get_currency_cached() == 'EUR'
+
+    # Shared between instances and the parents on the path
+    with CaptureQueriesContext(connection) as queries:
+        assert _reload(tree[-1]).get_currency_cached() == 'EUR'
+        assert field.resolve_many([_reload(tree[3])]) == ['EUR']
+    assert len(queries) == 2
+
+    # Changing a parent evicts the descendants
+    tree[4].currency = 'GBP'
+    tree[4].save()
+    assert _reload(tree[-1]).get_currency_cached() == 'GBP'
+    assert _reload(tree[3]).get_currency_cached() == 'EUR'
+
+    # Re-parenting evicts the node and its descendants
+    other = models.TreeNode.objects.create(name='other', currency='CHF')
+    node = _reload(tree[6])
+    node.parent = other
+    node.save()
+    assert _reload(tree[-1]).get_currency_cached() == 'CHF'
+    assert _reload(tree[5]).get_currency_cached() == 'GBP'
+
+    other.delete()
+    assert not any(key[2] == tree[-1].pk for key in field._values)
+
+    # Unsaved parents are not cached
+    node = models.TreeNode(name='unsaved', currency='SEK')
+    assert node.get_currency_cached() == 'SEK'
+    child = models.TreeNode.objects.create(name='child')
+    child.parent = node
+    assert child.get_currency_cached() == 'SEK'
+    assert ('test_app.TreeNode', 'default', child.pk) not in field._values
+
+    # Chains without a value
+    node = _reload(models.TreeNode.objects.create(name='empty'))
+    assert node.get_currency_cached() is None
+    assert ('test_app.TreeNode', 'default', node.pk) in field._values
+
+
+@pytest.mark.django_db()
+def test_recursive_field_cache_size(monkeypatch, tree):
+    from tests.test_app import models
+
+    field = models.TreeNode.get_currency_cached
+    monkeypatch.setattr(field, 'CACHE_SIZE', 5)
+    field.clear_cache()
+    assert _reload(tree[3]).get_currency_cached() == 'EUR'
+    assert len(field._values) == 4
+    assert _reload(tree[-1]).get_currency_cached() == 'EUR'
+    assert len(field._values) == len(tree)
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('name', ['get_currency', 'get_currency_cte'])
+def test_recursive_field_expression(forest, name):
+    from tests.test_app import models
+
+    field = getattr(models.TreeNode, name)
+    models.TreeNode.objects.filter(name='eur 1').update(currency='')
+    nodes = list(models.TreeNode.objects.order_by('pk'))
+    expected = field.resolve_many(nodes)
+
+    queryset = models.TreeNode.objects.annotate(
+        currency_=field.expression(max_depth=2))
+    assert list(queryset.order_by('pk').values_list(
+        'currency_', flat=True)) == expected
+    assert queryset.filter(currency_='EUR').count() == expected.count('EUR')
+
+    # Too shallow for the leaves
+    queryset = models.TreeNode.objects.annotate(
+        currency_=field.expression(max_depth=1))
+    assert queryset.filter(currency_='EUR').count() == 3
+
+    with pytest.raises(ValueError):
+        models.TreeNode.get_label_cte.expression()
+
+
+def test_recursive_field_expression_models():
+    expression = B.get_some_attribute_with_defaults.expression()
+    assert len(expression.get_source_expressions()) == 3
+    expression = B.get_some_attribute.expression()
+    assert len(expression.get_source_expressions()) == 2
+    assert B.get_created_at.expression().get_source_expressions() == [
+        F('created_at'), F('parent__created_at')]
+    assert isinstance(B.get_some_attribute.expression(max_depth=0),
+                      functions.NullIf)
+
+
+@pytest.mark.parametrize('field,expected', [
+    (models.CharField(), ''),
+    (models.DecimalField(), 0),
+    (models.BooleanField(), False),
+    (models.DateTimeField(), None),
+    (B._meta.get_field('parent'), 0),
+])
+def test_recursive_field_empty_values(field, expected):
+    assert fields._get_empty_value(field) is expected
+
+
+@pytest.mark.django_db()
+def test_recursive_field_path(tree):
+    from tests.test_app import models
+
+    field = models.TreeNode.get_currency_path
+    leaf = _reload(tree[-1])
+    assert leaf.path == ''.join(f'{node.pk}/' for node in tree[:-1])
+    with CaptureQueriesContext(connection) as queries:
+        assert leaf.get_currency_path() == 'EUR'
+        assert leaf.parent.parent.parent.name == 'node 4'
+    assert len(queries) == 1
+
+    assert list(field.ancestors(leaf)) == tree[-2::-1]
+    assert list(field.descendants(tree[5]).order_by('pk')) == tree[6:]
+
+    # Moving a node updates the paths of the descendants
+    other = models.TreeNode.objects.create(name='other', currency='CHF')
+    node = _reload(tree[4])
+    node.parent = other
+    node.save(update_fields=['parent'])
+    assert _reload(tree[4]).path == f'{other.pk}/'
+    assert _reload(tree[-1]).get_currency_path() == 'CHF'
+    assert list(field.descendants(other).order_by('pk')) == tree[4:]
+    assert field.verify() == ([], len(tree) + 1)
+
+    # Unsaved changes of the parent are walked normally
+    leaf = _reload(tree[-1])
+    leaf.parent_id = tree[1].pk
+    assert leaf.get_currency_path() == 'EUR'
+
+    # Cycles are not allowed
+    node.parent = _reload(tree[-1])
+    with pytest.raises(ValueError):
+        node.save()
+
+    # Raw saves (fixtures) don't update the path
+    node = _reload(tree[3])
+    path = node.path
+    node.parent = None
+    models.TreeNode.save_base(node, raw=True)
+    assert _reload(tree[3]).path == path
+    assert _reload(tree[3]).parent_id is None
+
+
+@pytest.mark.django_db()
+def test_recursive_field_path_queries(tree):
+    # An unchanged parent doesn't need any path queries
+    node = _reload(tree[4])
+    node.name = 'renamed'
+    with CaptureQueriesContext(connection) as queries:
+        node.save()
+    assert len(queries) == 1
+
+    # Moving fetches the paths once and updates the descendants, even though
+    # multiple fields share the path
+    node.parent = tree[1]
+    with CaptureQueriesContext(connection) as queries:
+        node.save()
+    assert len(queries) == 3
+    assert _reload(tree[-1]).path.startswith(f'{tree[0].pk}/{tree[1].pk}/')
+
+    # Moving to the root
+    node.parent = None
+    node.save()
+    assert _reload(tree[4]).path == ''
+    assert _reload(tree[-1]).path.startswith(f'{tree[4].pk}/')
+
+
+@pytest.mark.django_db()
+def test_recursive_field_path_proxy(tree):
+    from tests.test_app import models
+
+    field = models.TreeNode.get_currency_path
+    node = models.ProxyTreeNode.objects.create(name='proxy', parent=tree[2])
+    assert _reload(node).path == f'{tree[0].pk}/{tree[1].pk}/{tree[2].pk}/'
+
+    # Moving a proxy updates the descendants as well
+    node = models.ProxyTreeNode.objects.get(pk=tree[4].pk)
+    node.parent_id = tree[0].pk
+    node.save()
+    assert _reload(tree[5]).path == f'{tree[0].pk}/{tree[4].pk}/'
+    assert field.verify() == ([], len(tree) + 1)
+
+
+@pytest.mark.django_db()
+def test_recursive_field_path_failed_save(monkeypatch, tree):
+    from tests.test_app import models
+
+    # The descendants are only updated once the instance is saved
+    path = _reload(tree[-1]).path
+    node = _reload(tree[4])
+    node.parent = None
+    monkeypatch.setattr(
+        models.TreeNode, '_do_update',
+        lambda *args, **kwargs: 1 / 0)
+    with pytest.raises(ZeroDivisionError), transaction.atomic():
+        node.save()
+    assert _reload(tree[-1]).path == path
+
+    monkeypatch.undo()
+    node.save()
+    assert _reload(tree[-1]).path.startswith(f'{tree[4].pk}/')
+    assert models.TreeNode.get_currency_path.verify() == ([], len(tree))
+
+
+@pytest.mark.django_db()
+def test_recursive_field_path_rebuild(tree):
+    from tests.test_app import models
+
+    field = models.TreeNode.get_currency_path
+    # An inconsistent path is only used as far as it's correct
+    models.TreeNode.objects.filter(pk=tree[-1].pk).update(
+        path=f'{tree[0].pk}/{tree[-2].pk}/')
+    models.TreeNode.objects.filter(pk=tree[3].pk).update(path='')
+    leaf = _reload(tree[-1])
+    with CaptureQueriesContext(connection) as queries:
+        assert leaf.get_currency_path() == 'EUR'
+    assert len(queries) == 2
+
+    assert field.verify() == ([tree[3].pk, tree[-1].pk], len(tree))
+    assert field.rebuild(batch_size=2) == 2
+    assert field.verify(batch_size=2) == ([], len(tree))
+    assert field.rebuild() == 0
+
+
+@pytest.mark.django_db()
+def test_recursive_field_command(caplog, tree):
+    from tests.test_app import models
+
+    models.TreeNode.objects.filter(pk=tree[3].pk).update(path='')
+    # A cycle, can't be reached from the roots
+    a = models.TreeNode.objects.create(name='a')
+    b = models.TreeNode.objects.create(name='b', parent=a)
+    models.TreeNode.objects.filter(pk=a.pk).update(parent=b)
+
+    with caplog.at_level(logging.INFO):
+        management.call_command(
+            'recursive_field', 'test_app.TreeNode', 'get_currency_path',
+            verify=True, verbosity=2)
+    assert 'Invalid paths' in caplog.text
+    assert '2 nodes can not be reached' in caplog.text
+
+    models.TreeNode.objects.filter(pk=a.pk).update(parent=None)
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        management.call_command(
+            'recursive_field', 'test_app.TreeNode', 'get_currency_path',
+            rebuild=True, verify=True, benchmark=5, verbosity=2)
+    assert 'Invalid paths' not in caplog.text
+    assert 'path: 5 nodes, 4 queries' in caplog.text
+
+    management.call_command(
+        'recursive_field', 'test_app.TreeNode', 'get_currency',
+        benchmark=5, verbosity=0)
+
+
+def test_recursive_field_path_required():
+    with pytest.raises(ValueError):
+        fields.RecursiveField(strategy='path')
+
+
+@pytest.mark.django_db()
+def test_recursive_field_cte_uuid():
+    from tests.test_app import models
+
+    node = models.UUIDTreeNode.objects.create(currency='EUR')
+    for i in range(3):
+        node = models.UUIDTreeNode.objects.create(parent=node)
+
+    node = models.UUIDTreeNode.objects.get(pk=node.pk)
+    with CaptureQueriesContext(connection) as queries:
+        assert node.get_currency_cte() == 'EUR'
+    assert len(queries) == 1
+
+
+@pytest.mark.django_db()
+def test_recursive_field_cache_proxy(tree):
+    from tests.test_app import models
+
+    field = models.TreeNode.get_currency_cached
+    field.clear_cache()
+    leaf = models.ProxyTreeNode.objects.get(pk=tree[-1].pk)
+    assert field.get(leaf) == 'EUR'
+
+    # Saving through the concrete model evicts the proxy rows
+    tree[0].currency = 'GBP'
+    tree[0].save()
+    leaf = models.ProxyTreeNode.objects.get(pk=tree[-1].pk)
+    assert field.get(leaf) == 'GBP'
@@ -0,0 +1,78 @@
+import datetime
+import decimal
+import json
+import uuid
+
+import pytest
+from django.core.serializers import json as django_json
+from django.utils.translation import gettext_lazy
+
+from django_utils import json_backends
+from django_utils import view_decorators
+
+BACKENDS = sorted(json_backends.BACKENDS)
+
+DATETIMES = [
+    datetime.datetime(2020, 1, 2, 3, 4, 5, 123456),
+    datetime.datetime(2020, 1, 2, 3, 4, 5),
+    datetime.datetime(2020, 1, 2, 3, 4, 5, 6, tzinfo=datetime.timezone.utc),
+    datetime.date(2020, 1, 2),
+    datetime.time(3, 4, 5, 6),
+    datetime.time(3, 4, tzinfo=datetime.timezone.utc),
+]
+
+
+def compact(data, **kwargs):
+    return json.dumps(
+        data, separators=(',', ':'), ensure_ascii=False, **kwargs)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('value', DATETIMES)
+def test_datetimes(backend, value):
+    expected = compact(
+        dict(value=value), default=view_decorators.json_default_handler)
+    assert json_backends.dumps(dict(value=value), backend=backend) == expected
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('value', [
+    decimal.Decimal('1.10'),
+    decimal.Decimal('-1E+3'),
+    uuid.UUID('12345678-1234-5678-1234-567812345678'),
+    gettext_lazy('spam'),
+    datetime.timedelta(days=1, seconds=2, microseconds=3),
+])
+def test_django_types(backend, value):
+    expected = compact([value], cls=django_json.DjangoJSONEncoder)
+    if backend == 'ujson' and isinstance(value, decimal.Decimal):
+        # `ujson` writes decimals as numbers
+        expected = compact([float(value)])
+
+    assert json_backends.dumps([value], backend=backend) == expected
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('value', [
+    {'spam': 'eggs', 'unicode': 'é ☃  ', 'nested': [1, 2.5, None]},
+    (True, False, -1, 0.1, ''),
+    {1: 'non string key'},
+    2 ** 70,
+])
+def test_builtin_types(backend, value):
+    assert json_backends.dumps(value, backend=backend) == compact(value)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_unsupported(backend):
+    with pytest.raises(TypeError):
+        json_backends.dumps(object(), backend=backend)
+
+
+def test_backend_setting(settings):
+    settings.DJANGO_UTILS_JSON_BACKEND = 'json'
+    assert json_backends.dumps({}) == '{}'
+
+    settings.DJANGO_UTILS_JSON_BACKEND = 'spam'
+    with pytest.raises(ValueError):
+        json_backends.dumps({})
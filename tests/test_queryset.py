@@ -1,4 +1,17 @@
+import array
+import asyncio
+import datetime
+import logging
+import pickle
+import sys
+
+import numpy
 import pytest
+from django.db import connection
+from django.db.models import F, Prefetch
+from django.db.models.functions import Length, Lower
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 from django_utils import queryset
 
@@ -15,3 +28,833 @@ def test_full_queryset():
     from django.contrib.contenttypes import models
     for user in queryset.queryset_iterator(models.ContentType.objects.all()):
         pass
+
+
+@pytest.fixture
+def keyset_rows():
+    from tests.test_app import models
+
+    rows = []
+    for i in range(25):
+        rows.append(models.KeysetTest.objects.create(
+            tenant=i % 3,
+            value=None if i % 4 == 0 else i % 5,
+            name=f'name {i % 7}',
+        ))
+
+    for i in range(10):
+        models.NamedKeysetTest.objects.create(
+            name=f'{i:03d}', parent=rows[i] if i % 2 else None)
+
+    return rows
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('chunksize', [1, 2, 7, 1000])
+@pytest.mark.parametrize('ordering', [
+    (),
+    ('pk',),
+    ('-pk',),
+    ('tenant',),
+    ('tenant', '-pk'),
+    ('-tenant', 'value'),
+    ('value',),
+    ('-value', 'name'),
+    ('name', '-value', 'tenant'),
+    (F('value').asc(nulls_first=True),),
+    (F('value').desc(nulls_last=True), F('tenant')),
+    (F('value').desc(), F('name').asc()),
+    ('tenant', 'id', 'value'),
+])
+def test_keyset_queryset(keyset_rows, chunksize, ordering):
+    from tests.test_app import models
+
+    queryset_ = models.KeysetTest.objects.order_by(*ordering)
+    columns = queryset._get_keyset_columns(queryset_)
+    expected = list(queryset_.order_by(*[c.order_by() for c in columns]))
+
+    result = list(queryset.queryset_iterator(queryset_, chunksize=chunksize))
+    assert result == expected
+    assert len(result) == len(keyset_rows)
+
+
+@pytest.mark.django_db()
+def test_keyset_nulls(keyset_rows):
+    from tests.test_app import models
+
+    values = [row.value for row in queryset.queryset_iterator(
+        models.KeysetTest.objects.order_by('value'), chunksize=3)]
+    assert values[-1] is None
+    assert values[0] is not None
+
+    values = [row.value for row in queryset.queryset_iterator(
+        models.KeysetTest.objects.order_by('-value'), chunksize=3)]
+    assert values[0] is None
+    assert values[-1] is not None
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('ordering', [(), ('-pk',), ('parent', 'pk')])
+def test_keyset_string_pk(keyset_rows, ordering):
+    from tests.test_app import models
+
+    queryset_ = models.NamedKeysetTest.objects.filter(
+        name__gt='000').order_by(*ordering)
+    columns = queryset._get_keyset_columns(queryset_)
+    expected = list(queryset_.order_by(*[c.order_by() for c in columns]))
+    assert len(expected) == 9
+    assert list(queryset.queryset_iterator(queryset_, chunksize=2)) == expected
+
+
+@pytest.mark.parametrize('model,ordering', [
+    ('NamedKeysetTest', ('?',)),
+    ('NamedKeysetTest', ('parent__name',)),
+    ('NamedKeysetTest', ('lower_name',)),
+    ('KeysetTest', ('namedkeysettest',)),
+    ('NamedKeysetTest', (Lower('name'),)),
+])
+def test_keyset_invalid_ordering(model, ordering):
+    from tests.test_app import models
+
+    queryset_ = getattr(models, model).objects.annotate(
+        lower_name=Lower('name')).order_by(*ordering)
+    with pytest.raises(ValueError):
+        list(queryset.queryset_iterator(queryset_))
+
+
+@pytest.mark.django_db()
+def test_keyset_combined_queryset():
+    from tests.test_app import models
+
+    queryset_ = models.KeysetTest.objects.all()
+    with pytest.raises(ValueError):
+        list(queryset.queryset_iterator(queryset_.union(queryset_)))
+
+
+def _count_rows(rows):
+    return len(rows)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('boundaries', [None, 'minmax', 'sample'])
+@pytest.mark.parametrize('shards', [1, 3, 50])
+def test_parallel_map_threads(shards, boundaries):
+    from django.contrib.contenttypes import models
+
+    queryset_ = models.ContentType.objects.all()
+    result = queryset.queryset_parallel_map(
+        queryset_, _count_rows, shards=shards, chunksize=2,
+        boundaries=boundaries)
+
+    assert result.rows == queryset_.count()
+    assert sum(result.results) == queryset_.count()
+    assert not result.errors
+    assert result.shards[0].start is None
+    assert result.shards[-1].stop is None
+    repr(result.shards[0])
+
+
+@pytest.mark.django_db(transaction=True)
+def test_parallel_map_sample_keys(keyset_rows):
+    from tests.test_app import models
+
+    def fail_on_row(rows):
+        if keyset_rows[0] in rows:
+            raise ValueError(keyset_rows[0])
+
+        return len(rows)
+
+    result = queryset.queryset_parallel_map(
+        models.KeysetTest.objects.all(), fail_on_row, shards=4, workers=2)
+    assert len(result.shards) == 4
+    assert len(result.errors) == 1
+    error, = result.errors.values()
+    assert isinstance(error, ValueError)
+    assert result.shards[min(result.errors)].traceback
+
+
+@pytest.mark.django_db(transaction=True)
+def test_parallel_map_processes():
+    from django.contrib.contenttypes import models
+
+    queryset_ = models.ContentType.objects.all()
+    result = queryset.queryset_parallel_map(
+        queryset_, _count_rows, shards=2, executor='process')
+    assert sum(result.results) == queryset_.count()
+
+    # Lambdas cannot be pickled so the errors are returned per shard
+    result = queryset.queryset_parallel_map(
+        queryset_, lambda rows: rows, shards=2, executor='process')
+    assert len(result.errors) == 2
+
+
+@pytest.mark.django_db()
+def test_pickled_queryset_fields():
+    from django.contrib.contenttypes import models
+
+    queryset_ = models.ContentType.objects.annotate(
+        name=F('model')).values_list('name', 'app_label').order_by('pk')
+    pickled = pickle.loads(pickle.dumps(
+        queryset._PickledQueryset(queryset_)))
+    assert list(pickled.restore()) == list(queryset_)
+
+
+@pytest.mark.django_db()
+def test_parallel_map_errors():
+    from django.contrib.contenttypes import models
+
+    queryset_ = models.ContentType.objects.all()
+    with pytest.raises(RuntimeError):
+        queryset.queryset_parallel_map(
+            queryset_, _count_rows, executor='process')
+
+    with pytest.raises(ValueError):
+        queryset.queryset_parallel_map(
+            queryset_, _count_rows, executor='spam')
+
+    with pytest.raises(ValueError):
+        queryset.queryset_parallel_map(
+            queryset_, _count_rows, boundaries='spam')
+
+    result = queryset.queryset_parallel_map(
+        queryset_.none(), _count_rows, boundaries='minmax')
+    assert len(result.shards) == 1
+    assert result.rows == 0
+
+
+@pytest.mark.django_db()
+def test_pickled_queryset():
+    from django.contrib.contenttypes import models
+
+    queryset_ = models.ContentType.objects.filter(pk__gt=1).values('pk')
+    pickled = pickle.loads(pickle.dumps(queryset._PickledQueryset(queryset_)))
+    assert list(pickled.restore()) == list(queryset_)
+
+    queryset._initialize_process()
+    pickled = queryset._PickledQueryset(models.ContentType.objects.all())
+    shard = queryset._process_shard(
+        pickled, _count_rows, queryset.ShardResult(0, stop=3), 1000)
+    assert shard.rows == 2
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('values', [
+    lambda qs: qs.values(),
+    lambda qs: qs.values('pk', 'tenant', 'value'),
+    lambda qs: qs.values('value', 'id', 'tenant'),
+    lambda qs: qs.values_list('pk', 'tenant', 'value'),
+    lambda qs: qs.values_list('value', 'tenant', 'id', named=True),
+])
+def test_values_queryset(keyset_rows, values):
+    from tests.test_app import models
+
+    queryset_ = values(models.KeysetTest.objects.order_by('-tenant', 'value'))
+    result = list(queryset.queryset_iterator(queryset_, chunksize=4))
+    assert result == list(queryset_.order_by(
+        '-tenant', F('value').asc(nulls_last=True), 'pk'))
+
+
+@pytest.mark.django_db()
+def test_flat_values_queryset(keyset_rows):
+    from tests.test_app import models
+
+    queryset_ = models.KeysetTest.objects.values_list('pk', flat=True)
+    result = list(queryset.queryset_iterator(queryset_, chunksize=4))
+    assert result == list(queryset_.order_by('pk'))
+
+    with pytest.raises(ValueError):
+        list(queryset.queryset_iterator(queryset_.order_by('tenant')))
+
+    with pytest.raises(ValueError):
+        list(queryset.queryset_iterator(
+            models.KeysetTest.objects.values('tenant')))
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('use_numpy', [None, False])
+def test_column_iterator(keyset_rows, use_numpy):
+    from tests.test_app import models
+
+    queryset_ = models.KeysetTest.objects.order_by('name')
+    chunks = list(queryset.queryset_column_iterator(
+        queryset_, 'tenant', 'value', 'name', chunksize=10,
+        use_numpy=use_numpy))
+    assert len(chunks) == 3
+    assert sum(sum(chunk['tenant']) for chunk in chunks) == sum(
+        row.tenant for row in keyset_rows)
+    assert [name for chunk in chunks for name in chunk['name']] == sorted(
+        row.name for row in keyset_rows)
+
+    if use_numpy is None:
+        assert isinstance(chunks[0]['tenant'], numpy.ndarray)
+    else:
+        assert isinstance(chunks[0]['tenant'], array.array)
+        assert isinstance(chunks[0]['value'], list)
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_column_iterator_all_fields(use_numpy):
+    from django.contrib.auth import models
+
+    models.User.objects.create(username='spam')
+    models.User.objects.create(username='eggs', is_staff=True)
+    queryset_ = models.User.objects.annotate(length=Length('username'))
+    chunks = list(queryset.queryset_column_iterator(
+        queryset_, use_numpy=use_numpy))
+    assert len(chunks) == 1
+    assert list(chunks[0]['is_staff']) == [False, True]
+
+    chunks = list(queryset.queryset_column_iterator(
+        queryset_, 'pk', 'length', use_numpy=use_numpy))
+    assert list(chunks[0]['length']) == [4, 4]
+
+
+@pytest.mark.django_db()
+def test_custom_getfunc(keyset_rows):
+    from tests.test_app import models
+
+    queryset_ = models.KeysetTest.objects.values('pk', 'tenant')
+    result = list(queryset.queryset_iterator(
+        queryset_, chunksize=4, getfunc=lambda row, key: row[key]))
+    assert result == list(queryset_.order_by('pk'))
+
+
+async def _collect(iterator, delay=0):
+    rows = []
+    async for row in iterator:
+        await asyncio.sleep(delay)
+        rows.append(row)
+
+    return rows
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('read_ahead', [0, 1, 3])
+@pytest.mark.parametrize('chunksize', [1, 4, 1000])
+def test_async_iterator(keyset_rows, read_ahead, chunksize):
+    from tests.test_app import models
+
+    queryset_ = models.KeysetTest.objects.order_by('name', '-value')
+    expected = list(queryset.queryset_iterator(queryset_))
+    result = asyncio.run(_collect(queryset.aqueryset_iterator(
+        queryset_, chunksize=chunksize, read_ahead=read_ahead)))
+    assert result == expected
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_iterator_read_ahead(keyset_rows):
+    from tests.test_app import models
+
+    fetched = []
+
+    def getfunc(row, key):
+        fetched.append(row)
+        return getattr(row, key)
+
+    async def consume():
+        iterator = queryset.aqueryset_chunk_iterator(
+            models.KeysetTest.objects.all(), chunksize=5, getfunc=getfunc,
+            read_ahead=2)
+        async for rows in iterator:
+            break
+
+        # Wait for the read ahead to finish, the rest should not be fetched
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+
+        await iterator.aclose()
+
+    asyncio.run(consume())
+
+    # The first chunk and 2 chunks read ahead
+    assert len(fetched) == 3
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_iterator_errors():
+    from tests.test_app import models
+
+    queryset_ = models.KeysetTest.objects.values('name')
+    with pytest.raises(ValueError):
+        asyncio.run(_collect(queryset.aqueryset_iterator(queryset_)))
+
+    queryset_ = models.KeysetTest.objects.extra(where=['spam'])
+    with pytest.raises(Exception):
+        asyncio.run(_collect(queryset.aqueryset_iterator(queryset_)))
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('gc_policy,expected', [
+    (queryset.GC_ALWAYS, [2, 2, 2, 2, 2, 2]),
+    (queryset.GC_NEVER, []),
+    (None, []),
+    (queryset.GC_GENERATION_0, [0, 0, 0, 0, 0, 0]),
+    (queryset.GCPolicy(generation=1, every=3), [1, 1]),
+])
+def test_gc_policy(monkeypatch, keyset_rows, gc_policy, expected):
+    from tests.test_app import models
+
+    collected = []
+    monkeypatch.setattr(queryset.gc, 'collect', collected.append)
+    rows = list(queryset.queryset_iterator(
+        models.KeysetTest.objects.all(), chunksize=4, gc_policy=gc_policy))
+    assert len(rows) == len(keyset_rows)
+    assert collected == expected
+    repr(gc_policy)
+
+
+@pytest.mark.django_db()
+def test_reset_queries(settings, keyset_rows):
+    from django.db import connection
+    from tests.test_app import models
+
+    settings.DEBUG = True
+    connection.queries_log.clear()
+    for _ in queryset.queryset_iterator(
+            models.KeysetTest.objects.all(), chunksize=4,
+            reset_queries=True):
+        assert len(connection.queries) <= 1
+
+
+def test_adaptive_chunk_size():
+    chunksize = queryset.AdaptiveChunkSize(
+        initial=100, target_time=1, minimum=20, maximum=300)
+    assert int(chunksize) == 100
+    repr(chunksize)
+
+    # Partial chunks don't change anything
+    assert chunksize.update([1] * 50, 10) == 100
+    # Fast queries grow by at most a factor 2
+    assert chunksize.update([1] * 100, 0) == 200
+    assert chunksize.update([1] * 200, 0.1) == 300
+    # Slow queries shrink by at most a factor 2
+    assert chunksize.update([1] * 300, 100) == 150
+    assert chunksize.update([1] * 150, 1.5) == 100
+    assert chunksize.update([1] * 100, 100) == 50
+    assert chunksize.update([1] * 50, 100) == 25
+    assert chunksize.update([1] * 25, 100) == 20
+
+    row = (1, 'spam', None)
+    row_size = sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row)
+    chunksize = queryset.AdaptiveChunkSize(
+        initial=100, target_time=None, max_memory=row_size * 150)
+    assert chunksize.update([row] * 100, 1) == 150
+    assert chunksize.update([dict(a=row)] * 150, 1) < 150
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('values', [
+    lambda qs: qs,
+    lambda qs: qs.values_list('pk', flat=True),
+])
+def test_adaptive_queryset(keyset_rows, values):
+    from tests.test_app import models
+
+    queryset_ = values(models.KeysetTest.objects.all())
+    chunksize = queryset.AdaptiveChunkSize(
+        initial=2, target_time=None, max_memory=2 ** 20, minimum=1)
+    chunks = list(queryset.queryset_chunk_iterator(queryset_, chunksize))
+    assert [len(chunk) for chunk in chunks] == [2, 4, 8, 11]
+    assert chunksize.size == 2
+
+    chunks = asyncio.run(_collect(queryset.aqueryset_chunk_iterator(
+        queryset_, chunksize)))
+    assert [len(chunk) for chunk in chunks] == [2, 4, 8, 11]
+
+
+@pytest.fixture
+def spams():
+    from tests.test_app import models
+
+    return [
+        models.Spam.objects.create(name=f'spam {i}', a=str(i % 3))
+        for i in range(10)
+    ]
+
+
+@pytest.mark.django_db()
+def test_bulk_writer_iterate(spams):
+    from tests.test_app import models
+
+    queryset_ = models.Spam.objects.all()
+    with CaptureQueriesContext(connection) as queries:
+        with queryset.BulkWriter(batch_size=4) as writer:
+            for spam in writer.iterate(queryset_):
+                if spam.a == '1':
+                    spam.name = spam.name.upper()
+                elif spam.a == '2':
+                    spam.a = 'two'
+
+    assert writer.updated == 6
+    assert not len(writer)
+    # A single update for every chunk of 4 rows
+    assert len([q for q in queries if 'UPDATE' in q['sql']]) == 3
+    assert len([q for q in queries if 'SELECT' in q['sql']]) == 3
+
+    for spam, original in zip(queryset_.order_by('pk'), spams):
+        if original.a == '1':
+            assert spam.name == original.name.upper()
+            assert spam.updated_at > original.updated_at
+        elif original.a == '2':
+            assert spam.a == 'two'
+            assert spam.updated_at > original.updated_at
+        else:
+            assert spam.name == original.name
+            assert spam.updated_at == original.updated_at
+
+
+@pytest.mark.django_db()
+def test_bulk_writer_auto_now_ordering(spams):
+    from tests.test_app import models
+
+    writer = queryset.BulkWriter()
+    with pytest.raises(ValueError):
+        next(writer.iterate(models.Spam.objects.order_by('updated_at')))
+
+    # Orderings on other fields are fine, also `auto_now_add` fields
+    rows = list(writer.iterate(models.Spam.objects.order_by('-created_at')))
+    assert len(rows) == len(spams)
+
+
+@pytest.mark.django_db()
+def test_bulk_writer_save_create(spams, keyset_rows):
+    from tests.test_app import models
+
+    with queryset.BulkWriter(batch_size=3) as writer:
+        for spam in spams[:4]:
+            spam.a = 'saved'
+            writer.save(spam, fields=['a'])
+
+        # Saving twice only updates once
+        writer.save(spams[0])
+        assert len(writer) == 2
+
+        writer.save(models.Spam(name='new', slug='new', a='new'))
+        writer.create(models.Spam(name='new 2', slug='new-2', a='new'))
+
+        keyset_rows[0].data['spam'] = ['eggs']
+        writer.track(keyset_rows[0])
+        keyset_rows[0].data['spam'].append('bacon')
+
+    assert writer.updated == 6
+    assert writer.created == 2
+    assert models.Spam.objects.filter(a='saved').count() == 4
+    assert models.Spam.objects.filter(a='new').count() == 2
+    keyset_rows[0].refresh_from_db()
+    assert keyset_rows[0].data == dict(spam=['eggs', 'bacon'])
+
+    with pytest.raises(RuntimeError):
+        with queryset.BulkWriter() as writer:
+            writer.create(models.Spam(name='not created', a='new'))
+            raise RuntimeError()
+
+    assert models.Spam.objects.filter(a='new').count() == 2
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('lookups', [
+    ('namedkeysettest_set',),
+    (Prefetch('namedkeysettest_set', to_attr='named'),),
+])
+def test_prefetch_related(keyset_rows, lookups):
+    from tests.test_app import models
+
+    queryset_ = models.KeysetTest.objects.prefetch_related(*lookups)
+    with CaptureQueriesContext(connection) as queries:
+        rows = []
+        for row in queryset.queryset_iterator(queryset_, chunksize=5):
+            if lookups[0] == 'namedkeysettest_set':
+                children = list(row.namedkeysettest_set.all())
+            else:
+                children = row.named
+
+            assert len(children) == (row in keyset_rows[1:10:2])
+            rows.append(row)
+
+    # 5 chunks + the empty chunk, each with a single prefetch query
+    assert len(queries) == 11
+    assert not hasattr(rows[0], '_prefetched_objects_cache')
+    assert not hasattr(rows[0], 'named')
+
+    rows = list(queryset.queryset_iterator(
+        queryset_, chunksize=5, release_prefetched=False))
+    assert hasattr(rows[0], lookups[0].to_attr if isinstance(
+        lookups[0], Prefetch) else '_prefetched_objects_cache')
+
+    columns = list(queryset.queryset_column_iterator(queryset_, 'tenant'))
+    assert len(columns[0]['tenant']) == len(keyset_rows)
+
+
+@pytest.mark.django_db()
+def test_select_prefetch_related(keyset_rows):
+    from tests.test_app import models
+
+    queryset_ = models.NamedKeysetTest.objects.select_related(
+        'parent').prefetch_related('parent__namedkeysettest_set')
+    with CaptureQueriesContext(connection) as queries:
+        for row in queryset.queryset_iterator(queryset_, chunksize=5):
+            if row.parent:
+                assert row in row.parent.namedkeysettest_set.all()
+
+    # Two chunks with a single prefetch query each and the empty chunk
+    assert len(queries) == 5
+    assert 'parent' not in row._state.fields_cache
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_prefetch_related(keyset_rows):
+    from tests.test_app import models
+
+    async def collect(queryset_):
+        rows = []
+        async for row in queryset.aqueryset_iterator(queryset_, chunksize=4):
+            assert row.parent_id is None or row.parent.pk == row.parent_id
+            rows.append(row)
+
+        return rows
+
+    rows = asyncio.run(collect(
+        models.NamedKeysetTest.objects.prefetch_related('parent')))
+    assert len(rows) == 10
+    assert 'parent' not in rows[-1]._state.fields_cache
+
+    queryset_ = models.KeysetTest.objects.prefetch_related(
+        'namedkeysettest_set')
+    pickled = pickle.loads(pickle.dumps(queryset._PickledQueryset(queryset_)))
+    assert pickled.restore()._prefetch_related_lookups == (
+        'namedkeysettest_set',)
+
+
+@pytest.mark.django_db()
+def test_observers(keyset_rows):
+    from tests.test_app import models
+
+    stats = []
+    queryset_ = models.KeysetTest.objects.prefetch_related(
+        'namedkeysettest_set')
+    for row in queryset.queryset_iterator(
+            queryset_, chunksize=10, observers=[stats.append]):
+        pass
+
+    assert [s.rows for s in stats] == [10, 10, 5]
+    assert [s.total_rows for s in stats] == [10, 20, 25]
+    assert [s.queries for s in stats] == [2, 2, 2]
+    assert stats[-1].last_pk == row.pk
+    for s in stats:
+        assert 0 < s.db_time <= s.fetch_time
+        assert s.hydration_time >= 0
+        assert s.consumer_time >= 0
+        assert s.rss_delta is not None
+        repr(s)
+
+
+@pytest.mark.django_db()
+def test_observers_without_rss(monkeypatch, keyset_rows):
+    from tests.test_app import models
+
+    stats = []
+    monkeypatch.setattr(queryset, '_get_rss', lambda: None)
+    list(queryset.queryset_iterator(
+        models.KeysetTest.objects.all(), observers=[stats.append]))
+    assert stats[0].rss_delta is None
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('ordering', [(), ('-pk',), ('a',)])
+def test_progress_reporter(caplog, spams, ordering):
+    from tests.test_app import models
+
+    queryset_ = models.Spam.objects.order_by(*ordering)
+    reporter = queryset.ProgressReporter(queryset_, interval=0)
+    with caplog.at_level(logging.INFO):
+        for row in queryset.queryset_iterator(
+                queryset_, chunksize=3, observers=[reporter]):
+            assert reporter.fraction < 1
+
+    assert reporter.fraction == 1
+    assert reporter.eta is not None
+    assert len(caplog.records) == 4
+
+
+@pytest.mark.django_db()
+def test_progress_reporter_edge_cases(spams):
+    from tests.test_app import models
+
+    stats = queryset.ChunkStats(1, 1, 1, 1, 0, 0, 0, spams[0].pk, None)
+
+    # A single row means the range can't be used
+    queryset_ = models.Spam.objects.filter(pk=spams[0].pk)
+    reporter = queryset.ProgressReporter(queryset_, interval=60)
+    reporter(stats)
+    assert reporter.fraction == 1
+
+    # Unknown progress
+    reporter = queryset.ProgressReporter(models.KeysetTest.objects.none())
+    reporter(queryset.ChunkStats(1, 0, 0, 1, 0, 0, 0, None, None))
+    assert reporter.eta is None
+    reporter(stats)
+
+
+@pytest.fixture
+def sharded_rows(keyset_rows):
+    from tests.test_app import models
+
+    rows = list(keyset_rows)
+    for i in range(15):
+        rows.append(models.KeysetTest.objects.using('other').create(
+            tenant=i % 2,
+            value=None if i % 3 == 0 else i % 4,
+            name=f'other {i % 5}',
+        ))
+
+    return rows
+
+
+@pytest.mark.django_db(transaction=True, databases=['default', 'other'])
+@pytest.mark.parametrize('chunksize', [1, 4, 1000])
+@pytest.mark.parametrize('ordering', [
+    (),
+    ('-pk',),
+    ('tenant', '-value'),
+    ('-value', 'name'),
+    (F('value').asc(nulls_first=True), '-tenant'),
+])
+def test_merge_iterator(sharded_rows, chunksize, ordering):
+    from tests.test_app import models
+
+    queryset_ = models.KeysetTest.objects.order_by(*ordering)
+    columns = queryset._get_keyset_columns(queryset_)
+    key = queryset._get_merge_key(columns, getattr)
+
+    result = list(queryset.queryset_merge_iterator(
+        queryset_, ['default', 'other'], chunksize=chunksize))
+    assert len(result) == len(sharded_rows)
+    assert result == sorted(sharded_rows, key=key)
+    assert {row._state.db for row in result} == {'default', 'other'}
+
+
+@pytest.mark.django_db(transaction=True, databases=['default', 'other'])
+def test_merge_iterator_values(sharded_rows):
+    from tests.test_app import models
+
+    queryset_ = models.KeysetTest.objects.values_list('name', 'pk')
+    result = list(queryset.queryset_merge_iterator(
+        queryset_.order_by('name'), ['default', 'other'], chunksize=3))
+    assert len(result) == len(sharded_rows)
+    assert result == sorted(result)
+
+
+@pytest.mark.django_db(transaction=True, databases=['default', 'other'])
+def test_merge_iterator_close(sharded_rows):
+    from tests.test_app import models
+
+    iterator = queryset.queryset_merge_iterator(
+        models.KeysetTest.objects.all(), ['default', 'other'], chunksize=1,
+        read_ahead=0)
+    next(iterator)
+    # Closing stops the threads which are waiting for a free queue slot
+    iterator.close()
+
+
+@pytest.mark.django_db(transaction=True, databases=['default', 'other'])
+def test_merge_iterator_errors(sharded_rows):
+    from tests.test_app import models
+
+    queryset_ = models.KeysetTest.objects.order_by(Length('name'))
+    with pytest.raises(ValueError):
+        list(queryset.queryset_merge_iterator(queryset_, ['default']))
+
+    # Errors in the threads are raised in the consumer
+    queryset_ = models.KeysetTest.objects.extra(where=['spam = 1'])
+    with pytest.raises(Exception):
+        list(queryset.queryset_merge_iterator(
+            queryset_, ['default', 'other']))
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('ordering', [(), ('-value', 'name')])
+def test_start_after(keyset_rows, ordering):
+    from tests.test_app import models
+
+    queryset_ = models.KeysetTest.objects.order_by(*ordering)
+    columns = queryset._get_keyset_columns(queryset_)
+    expected = list(queryset.queryset_iterator(queryset_))
+
+    row = expected[9]
+    start_after = [getattr(row, column.key) for column in columns]
+    result = list(queryset.queryset_iterator(
+        queryset_, chunksize=4, start_after=start_after))
+    assert result == expected[10:]
+
+    with pytest.raises(ValueError):
+        list(queryset.queryset_iterator(queryset_, start_after=[1, 2, 3, 4]))
+
+
+@pytest.mark.django_db()
+def test_change_feed(spams):
+    from tests.test_app import models
+
+    # Equal timestamps, the primary key breaks the ties
+    now = timezone.now()
+    models.Spam.objects.filter(pk__in=[s.pk for s in spams[:7]]).update(
+        updated_at=now - datetime.timedelta(minutes=1))
+
+    feed = queryset.ChangeFeed(models.Spam.objects.all(), chunksize=3)
+    assert feed.watermark is None
+    for i, rows in enumerate(feed.chunks()):
+        assert feed.watermark is None or feed.watermark.pk == rows[0].pk - 1
+        if i == 1:
+            break
+
+    assert feed.watermark.pk == spams[2].pk
+    assert [spam.pk for spam in feed] == [spam.pk for spam in spams[3:]]
+    watermark = feed.watermark
+    assert watermark.pk == spams[-1].pk
+    assert repr(feed)
+
+    # Nothing changed
+    feed = queryset.ChangeFeed(models.Spam.objects.all(), watermark)
+    assert not list(feed)
+    assert feed.watermark == watermark
+
+    # A changed row, the watermark can be a (deserialized) list
+    spams[1].save()
+    feed = queryset.ChangeFeed(models.Spam.objects.all(), list(watermark))
+    assert list(feed) == [spams[1]]
+    assert feed.watermark == (spams[1].updated_at, spams[1].pk)
+
+    # Rows changed after a timestamp
+    feed = queryset.ChangeFeed(models.Spam.objects.all(), now)
+    assert list(feed) == [spams[1]]
+
+    # The delay excludes the recent changes
+    feed = queryset.ChangeFeed(
+        models.Spam.objects.all(), delay=datetime.timedelta(seconds=30))
+    assert [spam.pk for spam in feed] == [spam.pk for spam in spams[:7]
+                                          if spam.pk != spams[1].pk]
+
+
+@pytest.mark.django_db()
+def test_change_feed_values(spams):
+    from tests.test_app import models
+
+    feed = queryset.ChangeFeed(
+        models.Spam.objects.values('pk', 'updated_at'), chunksize=4)
+    assert len(list(feed)) == len(spams)
+    assert feed.watermark == (spams[-1].updated_at, spams[-1].pk)
+
+
+@pytest.mark.django_db()
+def test_sample_boundaries(keyset_rows):
+    from tests.test_app import models
+
+    queryset_ = models.KeysetTest.objects.all()
+    with CaptureQueriesContext(connection) as queries:
+        values = queryset._get_shard_boundaries(queryset_, 5, 'sample')
+    assert len(queries) == 1
+    assert 'OFFSET' not in queries[0]['sql']
+
+    # The sample contains all rows so the shards are equally sized
+    pks = sorted(row.pk for row in keyset_rows)
+    assert values == [pks[5], pks[10], pks[15], pks[20]]
@@ -0,0 +1,82 @@
+import pytest
+from django.contrib.auth import models as auth_models
+from django.core import serializers as django_serializers
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+
+from django_utils import serializers
+from tests.test_app import models
+
+
+@pytest.fixture
+def data():
+    root = models.TreeNode.objects.create(name='root', currency='EUR')
+    for i in range(5):
+        models.TreeNode.objects.create(name=f'child {i}', parent=root)
+
+    parent = models.UUIDTreeNode.objects.create(currency='EUR')
+    models.UUIDTreeNode.objects.create(parent=parent)
+    for i in range(3):
+        keyset = models.KeysetTest.objects.create(
+            tenant=i, value=i or None, name=f'{i}', data={'i': [i]})
+        models.Eggs.objects.create(name=f'eggs {i}', a='a', b='b')
+
+        test = models.SerializerTest.objects.create()
+        test.keysets.add(keyset)
+        test.nodes.add(root)
+
+    groups = [
+        auth_models.Group.objects.create(name=f'group {i}')
+        for i in range(3)
+    ]
+    for i in range(4):
+        user = auth_models.User.objects.create(username=f'user {i}')
+        user.groups.set(groups[:i])
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('queryset, fields', [
+    (lambda: models.TreeNode.objects.order_by('pk'), None),
+    (lambda: models.TreeNode.objects.order_by('-name'), ['name', 'parent']),
+    (lambda: models.ProxyTreeNode.objects.order_by('pk'), None),
+    (lambda: models.UUIDTreeNode.objects.order_by('pk'), None),
+    (lambda: models.KeysetTest.objects.order_by('pk'), None),
+    (lambda: models.Eggs.objects.order_by('pk'), None),
+    (lambda: models.SerializerTest.objects.order_by('pk'), None),
+    (lambda: auth_models.User.objects.order_by('pk'), None),
+    (lambda: auth_models.User.objects.order_by('pk'), ['username']),
+    (lambda: auth_models.Permission.objects.all(), ['codename']),
+    (lambda: models.TreeNode.objects.order_by('pk')[1:4], None),
+    (lambda: models.TreeNode.objects.none(), None),
+    (lambda: models.TreeNode.objects.filter(parent=None).union(
+        models.TreeNode.objects.filter(name='child 3')).order_by('-pk'),
+        None),
+    (lambda: models.SerializerTest.objects.difference(
+        models.SerializerTest.objects.filter(pk=0)), ['keysets']),
+])
+def test_serialize(data, queryset, fields):
+    expected = django_serializers.serialize(
+        'python', queryset(), fields=fields)
+    assert serializers.serialize(queryset(), fields, chunksize=2) == expected
+
+
+@pytest.mark.django_db()
+def test_many_to_many_queries(data):
+    queryset = auth_models.User.objects.order_by('pk')
+    serializer = serializers.get_serializer(auth_models.User)
+    with CaptureQueriesContext(connection) as queries:
+        chunks = list(serializer.chunks(queryset, chunksize=2))
+
+    # A query for the rows and both many to many fields per chunk and the
+    # query for the (empty) last chunk
+    assert len(chunks) == 2
+    assert len(queries) == 2 * 3 + 1
+
+
+def test_get_serializer():
+    serializer = serializers.get_serializer(models.TreeNode, ['name'])
+    assert serializers.get_serializer(models.TreeNode, ('name',)) \
+        is serializer
+    assert serializers.get_serializer(models.TreeNode) is not serializer
+    assert serializer.columns == ['pk', 'name']
+    assert repr(serializer) == '<ModelSerializer test_app.treenode>'
@@ -1,14 +1,26 @@
 import sys
 import pytest
 import datetime
+import inspect
+import io
+import json
+import threading
 
+import django
+from asgiref import sync
 from django import template
 from django import http
 from django.contrib.contenttypes import models
 from django.contrib.auth import models as auth_models
+from django.contrib.sessions.backends import signed_cookies
+from django.core import serializers
+from django.core.handlers import wsgi as handlers_wsgi
+from django.middleware import csrf
+from django.test import client
 
 from django_utils import view_decorators
 from django_utils import utils
+from django_utils import serializers as serializer_utils
 
 
 class Request(object):
@@ -16,6 +28,8 @@ class Request(object):
     def __init__(self, ajax=False):
         self.user = auth_models.AnonymousUser()
         self.headers = {'x-requested-with': 'XMLHttpRequest'} if ajax else {}
+        self.META = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'} if ajax else {}
+        self.content_type = 'text/plain'
         self.REQUEST = dict()
         self.POST = dict()
         self.GET = dict()
@@ -57,7 +71,7 @@ def some_view(request, return_=None):
     request.redirect('admin:index')
     request.permanent_redirect('admin:index')
 
-    del request.redirect
+    assert isinstance(request, Request)
 
     return return_
 
@@ -99,6 +113,24 @@ def test_some_view():
     some_view(request)
 
 
+def test_request_properties():
+    request = Request()
+    some_view(request, return_='')
+    assert type(request) is Request
+    assert not hasattr(request, 'redirect')
+    assert not hasattr(request, 'context')
+    assert not hasattr(request, 'template')
+
+    @view_decorators.env
+    def nested_view(request):
+        assert some_view(request, return_='spam').content == b'spam'
+        return request.redirect('/')
+
+    assert nested_view(request).status_code == 302
+    assert repr(view_decorators._View(nested_view, http.HttpResponse)) \
+        == '<_View tests.nested_view>'
+
+
 def test_import():
     if sys.version_info[0] == 2:
         import __builtin__ as builtins
@@ -116,3 +148,385 @@ def test_import():
 
     for name, module in removed_modules.items():
         sys.modules[name] = module
+
+
+def stream(response):
+    assert isinstance(response, http.StreamingHttpResponse)
+    return b''.join(response.streaming_content).decode()
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('queryset', [
+    lambda: models.ContentType.objects.all(),
+    lambda: models.ContentType.objects.order_by('-model'),
+    lambda: auth_models.Permission.objects.all(),
+    lambda: auth_models.Permission.objects.order_by('?'),
+    lambda: models.ContentType.objects.order_by('pk')[2:9],
+    lambda: models.ContentType.objects.filter(pk__lt=5).union(
+        models.ContentType.objects.filter(pk__gt=8)).order_by('pk'),
+    lambda: models.ContentType.objects.intersection(
+        models.ContentType.objects.filter(pk__gt=2)),
+])
+def test_stream_queryset(monkeypatch, queryset):
+    monkeypatch.setattr(view_decorators, 'QUERYSET_CHUNKSIZE', 3)
+    response = some_view(Request(ajax=True), return_=queryset())
+    expected = json.loads(serializers.serialize('json', queryset()))
+    output = json.loads(stream(response))
+    if '?' in queryset().query.order_by:
+        expected.sort(key=lambda row: row['pk'])
+        output.sort(key=lambda row: row['pk'])
+
+    assert output == expected
+    chunks = serializer_utils._get_queryset_chunks(queryset(), 3)
+    assert len(list(chunks)) > 1
+
+
+@pytest.mark.django_db()
+def test_stream_values_queryset():
+    request = Request(ajax=True)
+    request.GET['callback'] = 'call_me'
+    queryset = models.ContentType.objects.values_list('pk', 'model')
+    output = stream(some_view(request, return_=queryset))
+    assert output.startswith('call_me([') and output.endswith('])')
+    assert json.loads(output[8:-1]) == [list(row) for row in queryset]
+
+    queryset = models.ContentType.objects.values_list('pk', 'model')
+    queryset = queryset.filter(pk__lt=3).union(queryset.filter(pk__gt=5))
+    output = stream(some_view(Request(ajax=True), return_=queryset))
+    assert json.loads(output) == [list(row) for row in queryset]
+
+    queryset = models.ContentType.objects.none()
+    assert stream(some_view(Request(ajax=True), return_=queryset)) == '[]'
+
+
+@pytest.mark.django_db()
+def test_stream_queryset_debug():
+    request = Request(ajax=True)
+    request.GET['debug'] = 'debug'
+    response = some_view(
+        request, return_=models.ContentType.objects.all())
+    assert not isinstance(response, http.StreamingHttpResponse)
+
+
+@view_decorators.env
+def ajax_view(request, read_post=False):
+    if read_post:
+        request.POST
+    return {'ajax': request.ajax}
+
+
+@view_decorators.env(stream_upload=True)
+def upload_view(request):
+    return str(len(request.read()))
+
+
+def is_ajax(response):
+    return response['content-type'].startswith('text/plain')
+
+
+def test_lazy_ajax():
+    factory = client.RequestFactory()
+    assert is_ajax(ajax_view(factory.get('/', {'ajax': 1})))
+    assert is_ajax(ajax_view(
+        factory.get('/', HTTP_X_REQUESTED_WITH='XMLHttpRequest')))
+    assert is_ajax(ajax_view(factory.post(
+        '/', 'ajax=1', content_type='application/x-www-form-urlencoded')))
+
+    request = factory.post('/', {'ajax': 1, 'upload': io.StringIO('spam')})
+    with pytest.raises(template.TemplateDoesNotExist):
+        ajax_view(request)
+    assert '_post' not in request.__dict__
+    assert request.ajax is False
+
+    request = factory.post('/', {'ajax': 1, 'upload': io.StringIO('spam')})
+    assert is_ajax(ajax_view(request, read_post=True))
+
+
+def test_stream_upload():
+    factory = client.RequestFactory()
+    request = factory.post(
+        '/', 'ajax=1', content_type='application/x-www-form-urlencoded')
+    response = upload_view(request)
+    assert response.content == b'6'
+    assert not request.ajax
+
+    request = factory.post('/?ajax=1', {'upload': io.StringIO('spam')})
+    assert is_ajax(upload_view(request))
+
+
+@view_decorators.env
+async def async_view(request, return_=None):
+    assert request.redirect('/').status_code == 302
+    return return_
+
+
+async def _read(response):
+    return ''.join([chunk.decode() async for chunk in response])
+
+
+@pytest.mark.skipif(
+    django.VERSION < (4, 2), reason='Async streaming requires Django 4.2')
+@pytest.mark.django_db(transaction=True)
+def test_async_view(monkeypatch):
+    factory = client.RequestFactory()
+    view = sync.async_to_sync(async_view)
+    assert inspect.iscoroutinefunction(async_view)
+
+    request = factory.get('/', {'ajax': 1})
+    assert view(request, return_={'spam': 1}).content == b'{"spam":1}'
+    assert view(request, return_='spam').content == b'spam'
+    assert not hasattr(request, 'context')
+    assert type(request) is handlers_wsgi.WSGIRequest
+
+    threads = []
+
+    def render_to_string(template, context, request):
+        threads.append(threading.current_thread())
+        return template
+
+    monkeypatch.setattr(
+        view_decorators.django_loader, 'render_to_string', render_to_string)
+    assert view(factory.get('/'), return_={}).content \
+        == b'tests/async_view.html'
+    assert view(factory.get('/')).content == b'tests/async_view.html'
+    assert len(threads) == 2
+
+    queryset = models.ContentType.objects.order_by('pk')
+    response = view(request, return_=queryset)
+    assert response.is_async
+    assert json.loads(sync.async_to_sync(_read)(response)) \
+        == json.loads(serializers.serialize('json', queryset))
+
+    request = factory.get('/', {'ajax': 1, 'debug': 1})
+    response = view(request, return_=queryset)
+    assert not isinstance(response, http.StreamingHttpResponse)
+
+    with pytest.raises(view_decorators.UnknownViewResponseError):
+        view(factory.get('/'), return_=object())
+
+
+@pytest.mark.skipif(
+    django.VERSION < (5, 1),
+    reason='`login_required` for async views requires Django 5.1')
+def test_async_login_required():
+    @view_decorators.env(login_required=True)
+    async def async_logged_in_view(request):
+        return ''
+
+    request = client.RequestFactory().get('/')
+    request.user = auth_models.AnonymousUser()
+
+    async def auser():
+        return request.user
+
+    request.auser = auser
+    response = sync.async_to_sync(async_logged_in_view)(request)
+    assert response.status_code == 302
+
+
+calls = []
+
+
+@view_decorators.env(cache_timeout=60, vary_on=['page'])
+def cached_view(request, spam, return_=''):
+    calls.append(spam)
+    if isinstance(return_, str):
+        return f'{spam} {return_} {request.GET.get("page")}'
+    else:
+        return return_
+
+
+def test_cache():
+    factory = client.RequestFactory()
+    calls.clear()
+    cached_view.invalidate_cache()
+    info = cached_view.cache_info()
+
+    def get(*args, path='/', **kwargs):
+        return cached_view(factory.get(path, **kwargs), *args).content
+
+    assert get(1, path='/?page=1') == b'1  1'
+    assert get(1, path='/?page=1&other=1') == b'1  1'
+    assert get(2, path='/?page=1') == b'2  1'
+    assert get(1, path='/?page=2') == b'1  2'
+    assert get(1, path='/?page=1', HTTP_X_REQUESTED_WITH='XMLHttpRequest') \
+        == b'1  1'
+    assert calls == [1, 2, 1, 1]
+    assert cached_view.cache_info() == view_decorators.CacheInfo(
+        info.hits + 1, info.misses + 4)
+
+    request = factory.get('/?page=1')
+    request.user = auth_models.User(pk=1)
+    assert cached_view(request, 1).content == b'1  1'
+    assert calls == [1, 2, 1, 1, 1]
+
+    cached_view.invalidate_cache()
+    assert get(1, path='/?page=1') == b'1  1'
+    assert calls == [1, 2, 1, 1, 1, 1]
+
+
+def test_cache_uncacheable():
+    factory = client.RequestFactory()
+    calls.clear()
+    cached_view(factory.post('/'), 1)
+    cached_view(factory.post('/'), 1)
+    cached_view(factory.get('/', {'debug': 1}), 2)
+    cached_view(factory.get('/', {'debug': 1}), 2)
+    response = http.HttpResponse('spam')
+    cached_view(factory.get('/'), 3, return_=response)
+    cached_view(factory.get('/'), 3, return_=response)
+    response = http.HttpResponseNotFound('spam')
+    cached_view(factory.get('/'), 4, return_=response)
+    assert calls == [1, 1, 2, 2, 3, 3, 4]
+
+
+def test_cache_visitor_specific():
+    @view_decorators.env(cache_timeout=60)
+    def csrf_view(request, session=False):
+        calls.append(session)
+        if session:
+            return str(request.session.get('spam'))
+        else:
+            return csrf.get_token(request)
+
+    factory = client.RequestFactory()
+    calls.clear()
+    csrf_view.invalidate_cache()
+    assert csrf_view(factory.get('/')).content \
+        != csrf_view(factory.get('/')).content
+
+    request = factory.get('/')
+    request.session = signed_cookies.SessionStore()
+    assert csrf_view(request, session=True).content == b'None'
+    request = factory.get('/')
+    request.session = signed_cookies.SessionStore()
+    csrf_view(request, session=True)
+    assert calls == [False, False, True, True]
+    assert csrf_view.cache_info().hits == 0
+
+
+@pytest.mark.skipif(
+    django.VERSION < (4, 0),
+    reason='`cache_timeout` for async views requires Django 4.0')
+def test_async_cache():
+    @view_decorators.env(cache_timeout=60)
+    async def async_cached_view(request, spam):
+        calls.append(spam)
+        if not spam:
+            return http.HttpResponseNotFound()
+
+        return {'spam': spam, 'page': request.GET.get('page')}
+
+    factory = client.RequestFactory()
+    calls.clear()
+    async_cached_view.invalidate_cache()
+    view = sync.async_to_sync(async_cached_view)
+    request = factory.get('/', {'page': 1, 'ajax': 1})
+    assert view(request, 1).content == b'{"spam":1,"page":"1"}'
+    assert view(request, 1).content == b'{"spam":1,"page":"1"}'
+    assert view(factory.get('/', {'page': 2, 'ajax': 1}), 1).content \
+        == b'{"spam":1,"page":"2"}'
+    assert view(factory.post('/?ajax=1'), 1).content \
+        == b'{"spam":1,"page":null}'
+    assert calls == [1, 1, 1]
+    assert async_cached_view.cache_info().hits >= 1
+
+    assert view(request, 0).status_code == 404
+    assert view(request, 0).status_code == 404
+    assert calls == [1, 1, 1, 0, 0]
+
+
+@view_decorators.env(etag='strong')
+def strong_etag_view(request, return_='spam'):
+    return return_
+
+
+@view_decorators.env(etag='weak')
+def weak_etag_view(request):
+    return 'spam'
+
+
+def last_modified(request, spam):
+    return datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc)
+
+
+@view_decorators.env(
+    etag_func=lambda request, spam: spam, last_modified_func=last_modified)
+def conditional_view(request, spam):
+    calls.append(spam)
+    return spam
+
+
+@view_decorators.env(last_modified_func=last_modified)
+def last_modified_view(request, spam):
+    return spam
+
+
+async def aetag(request, spam):
+    return spam
+
+
+@view_decorators.env(etag_func=aetag, last_modified_func=last_modified)
+async def async_conditional_view(request, spam):
+    calls.append(spam)
+    return spam
+
+
+def test_etag():
+    factory = client.RequestFactory()
+    response = strong_etag_view(factory.get('/'))
+    etag = response['ETag']
+    assert etag.startswith('"') and response.content == b'spam'
+    response = strong_etag_view(factory.get('/', HTTP_IF_NONE_MATCH=etag))
+    assert response.status_code == 304
+    response = strong_etag_view(factory.get('/', HTTP_IF_NONE_MATCH='"x"'))
+    assert response.status_code == 200
+
+    response = weak_etag_view(factory.get('/'))
+    assert response['ETag'].startswith('W/"')
+    response = weak_etag_view(
+        factory.get('/', HTTP_IF_NONE_MATCH=response['ETag']))
+    assert response.status_code == 304
+
+    assert not strong_etag_view(factory.post('/')).has_header('ETag')
+    response = strong_etag_view(
+        factory.get('/'), return_=http.HttpResponseNotFound())
+    assert not response.has_header('ETag')
+
+    response = http.HttpResponse(headers={'ETag': '"eggs"'})
+    request = factory.get('/', HTTP_IF_NONE_MATCH='"eggs"')
+    assert strong_etag_view(request, return_=response).status_code == 304
+
+    with pytest.raises(ValueError):
+        view_decorators.env(etag='spam')(simple_view)
+
+
+def test_conditional():
+    factory = client.RequestFactory()
+    calls.clear()
+    response = conditional_view(factory.get('/'), 'spam')
+    assert response['ETag'] == '"spam"'
+    assert response['Last-Modified'] == 'Thu, 02 Jan 2020 00:00:00 GMT'
+
+    response = conditional_view(
+        factory.get('/', HTTP_IF_NONE_MATCH='"spam"'), 'spam')
+    assert response.status_code == 304
+    response = conditional_view(factory.get(
+        '/', HTTP_IF_MODIFIED_SINCE='Thu, 02 Jan 2020 00:00:00 GMT'), 'spam')
+    assert response.status_code == 304
+    response = conditional_view(
+        factory.post('/', HTTP_IF_MATCH='"eggs"'), 'spam')
+    assert response.status_code == 412
+    assert calls == ['spam']
+
+    response = last_modified_view(factory.get('/'), 'spam')
+    assert response.has_header('Last-Modified')
+    assert not response.has_header('ETag')
+
+    response = sync.async_to_sync(async_conditional_view)(
+        factory.get('/', HTTP_IF_NONE_MATCH='"spam"'), 'spam')
+    assert response.status_code == 304
+    response = sync.async_to_sync(async_conditional_view)(
+        factory.get('/'), 'spam')
+    assert response['ETag'] == '"spam"'
+    assert calls == ['spam', 'spam']